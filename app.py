@@ -1,57 +1,85 @@
 import streamlit as st
-import fitz  # PyMuPDF
-import pytesseract
-from PIL import Image
 import os
-import tempfile
+import html
 import base64
+import hashlib
+import threading
 from datetime import datetime
-import zipfile
-import io
-import subprocess
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 import time
 
-# ==================== КОНФИГУРАЦИЯ TESSERACT И ОПТИМИЗАЦИЯ ====================
-TESSERACT_CONFIG_FAST = '--oem 1 --psm 3 -c tessedit_do_invert=0'
+from ocr_engine import (
+    ROUTE_NATIVE,
+    ROUTE_OCR,
+    ROUTE_BOTH,
+    ROUTE_BLANK,
+    ROUTE_LABELS,
+    ENGINE_AUTO,
+    ENGINE_API,
+    ENGINE_CLI,
+    ENGINE_LABELS,
+    MODE_DPI,
+    MODE_ADAPTIVE,
+    LANG_AUTO,
+    is_auto_language,
+    is_api_engine_available,
+    probe_tesseract,
+    get_warm_up_lang,
+    warm_up_ocr,
+    read_document_info,
+    make_ocr_options,
+    get_worker_count,
+    summarize_routes,
+    count_escalated,
+    blank_page_numbers,
+    parse_page_range,
+    PREVIEW_FIRST_PAGES,
+    PAGE_TIMEOUT,
+    OCRCancelled,
+)
+from ocr_engine import extract_text_from_pdf_optimized as run_ocr_pipeline
+from ocr_server import client_submit, client_status, client_fetch_result, client_cancel, client_download_to
+from ocr_formats import FORMATS, format_path, build_format_file
+from ocr_metrics import STAGES, STAGE_LABELS, summarize_stage_timings, render_prometheus
+from ocr_preprocess import is_preprocess_available
+from ocr_cache import cache_stats, clear_cache
+from ocr_journal import cleanup_journals
+from ocr_estimate import estimate_processing_time, live_eta, format_duration, load_timing_model
+from ocr_results import (
+    PREVIEW_CHARS,
+    create_result_dir,
+    remove_result_dir,
+    cleanup_result_dirs,
+    spool_upload,
+    cleanup_uploads,
+    full_text_path,
+    pages_zip_path,
+    build_pages_zip,
+    read_text_prefix,
+)
 
-def setup_tesseract():
-    possible_paths = [
-        '/usr/bin/tesseract',
-        '/usr/local/bin/tesseract',
-        '/bin/tesseract',
-        '/nix/store/*/bin/tesseract',
-    ]
+st.set_page_config(page_title="📄 PDF OCR Extractor", 
+                   page_icon="https://cdn1.ozone.ru/s3/common-image-storage/bx/char_cat-box-four_m.png",
+                   layout="wide",
+                   initial_sidebar_state="expanded")
 
-    for path in possible_paths:
-        if os.path.exists(path):
-            return path
+# ==================== КОНФИГУРАЦИЯ TESSERACT ====================
+# Путь, версия и языки Tesseract проверяются один раз на процесс (probe_tesseract), а не при
+# каждом перезапуске скрипта; PyMuPDF и pytesseract загружаются при первой обработке
 
+def run_warm_up(lang):
     try:
-        result = subprocess.run(['which', 'tesseract'],
-                                capture_output=True,
-                                text=True)
-        if result.returncode == 0:
-            return result.stdout.strip()
-    except:
+        warm_up_ocr(lang)
+    except Exception:
+        # Прогрев только ускоряет первое задание: при сбое пул поднимется при обработке
         pass
 
-    return None
-
-tesseract_path = setup_tesseract()
-if tesseract_path:
-    pytesseract.pytesseract.tesseract_cmd = tesseract_path
-    st.session_state.tesseract_available = True
-    st.session_state.tesseract_path = tesseract_path
-else:
-    st.session_state.tesseract_available = False
-    st.session_state.tesseract_path = None
-
-st.set_page_config(page_title="📄 PDF OCR Extractor", 
-                   page_icon="https://cdn1.ozone.ru/s3/common-image-storage/bx/char_cat-box-four_m.png",
-                   layout="wide",
-                   initial_sidebar_state="expanded")
+@st.cache_resource(show_spinner=False)
+def start_warm_up():
+    # Один раз на процесс (OCR_WARMUP): модели и пул грузятся в фоне, пока посетитель выбирает файл
+    lang = get_warm_up_lang()
+    if lang:
+        threading.Thread(target=run_warm_up, args=(lang,), name="ocr-warm-up", daemon=True).start()
+    return lang
 
 # ==================== СТИЛИ OZON ====================
 def apply_ozon_style():
@@ -293,8 +321,8 @@ apply_ozon_style()
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
 if 'processing' not in st.session_state:
     st.session_state.processing = False
-if 'result_text' not in st.session_state:
-    st.session_state.result_text = ""
+if 'result_dir' not in st.session_state:
+    st.session_state.result_dir = None
 if 'total_pages' not in st.session_state:
     st.session_state.total_pages = 0
 if 'processed_files' not in st.session_state:
@@ -306,130 +334,205 @@ if 'processing_time' not in st.session_state:
 
 # ==================== ОПТИМИЗИРОВАННЫЕ ФУНКЦИИ OCR ====================
 
-def process_single_page(args):
-    page_num, page, dpi, lang, use_fast_mode = args
-
-    try:
-        pix = page.get_pixmap(dpi=dpi)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-        if use_fast_mode:
-            img = img.convert('L')
-
-        config = TESSERACT_CONFIG_FAST if use_fast_mode else '--oem 1 --psm 3'
-        text = pytesseract.image_to_string(img, lang=lang, config=config)
-        return page_num, text, None
-
-    except Exception as e:
-        return page_num, "", str(e)
-
-def extract_text_from_pdf_parallel(pdf_path, dpi=200, lang="rus+eng", use_fast_mode=True, progress_callback=None):
-    extracted_text = ""
-    page_texts = []
-
-    try:
-        pdf = fitz.open(pdf_path)
-        total_pages = len(pdf)
-        st.session_state.total_pages = total_pages
-
-        tasks = []
-        for page_num in range(total_pages):
-            page = pdf.load_page(page_num)
-            tasks.append((page_num, page, dpi, lang, use_fast_mode))
-
-        page_texts = [""] * total_pages
-        extracted_parts = [""] * total_pages
-
-        max_workers = min(3, total_pages)
-
-        completed = 0
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_page = {executor.submit(process_single_page, task): task[0] for task in tasks}
+# Как часто обновлять предпросмотр во время обработки
+LIVE_UPDATE_INTERVAL = 2.0
 
-            for future in concurrent.futures.as_completed(future_to_page):
-                page_num, text, error = future.result()
+# Адрес сервиса заданий (ocr_server.py); если задан, OCR выполняется в нем
+OCR_API_URL = os.environ.get("OCR_API_URL")
 
-                if error:
-                    page_texts[page_num] = ""
-                    extracted_parts[page_num] = f"\n{'='*50}\n📄 СТРАНИЦА {page_num + 1} - ОШИБКА\n{'='*50}\n\n{error}\n"
-                else:
-                    page_texts[page_num] = text
-                    extracted_parts[page_num] = f"\n{'='*50}\n📄 СТРАНИЦА {page_num + 1}\n{'='*50}\n\n{text}\n"
-
-                completed += 1
-                if progress_callback:
-                    progress_callback(completed, total_pages)
-
-        pdf.close()
-        extracted_text = "".join(extracted_parts)
-        return extracted_text, page_texts
-
-    except Exception as e:
-        return f"❌ Ошибка при обработке PDF: {e}", []
-
-def extract_text_from_pdf_optimized(pdf_path, dpi=200, lang="rus+eng", use_parallel=True, use_fast_mode=True, progress_bar=None, status_text=None):
+def extract_text_from_pdf_optimized(pdf_path, dpi=200, lang="rus+eng", use_parallel=True, use_fast_mode=True, progress_bar=None, status_text=None, use_text_layer=True, max_workers=None, engine=ENGINE_AUTO, use_cache=True, on_update=None, adaptive=False, preprocess=False, skip_blank=True, doc_hash=None, total_pages=None, use_journal=True, page_numbers=None, preview_first=False, page_timeout=PAGE_TIMEOUT, word_boxes=False, estimated_time=None):
+    cancel_event = threading.Event()
     start_time = time.time()
 
-    if use_parallel and st.session_state.total_pages > 1:
-        def progress_callback(completed, total):
+    def update(result_dir, snapshot):
+        try:
             if progress_bar:
-                progress_bar.progress(completed / total)
+                progress_bar.progress(snapshot["completed"] / snapshot["total"])
             if status_text:
-                status_text.text(f"📄 Обработка страницы {completed} из {total}")
-
-        result = extract_text_from_pdf_parallel(pdf_path, dpi, lang, use_fast_mode, progress_callback)
-    else:
-        extracted_text = ""
-        page_texts = []
-
+                status_text.text(format_progress(snapshot["completed"], snapshot["total"],
+                                                 live_eta(estimated_time, time.time() - start_time,
+                                                          snapshot["completed"], snapshot["total"])))
+            if on_update:
+                on_update(result_dir, snapshot)
+        except BaseException:
+            # Скрипт прерван (кнопка остановки или новый запуск): страницы в работе больше не нужны
+            cancel_event.set()
+            raise
+
+    def on_queue(status):
+        # Все слоты OCR заняты другими пользователями: показываем очередь
         try:
-            pdf = fitz.open(pdf_path)
-            total_pages = len(pdf)
-            st.session_state.total_pages = total_pages
-
-            for page_num in range(total_pages):
-                if progress_bar:
-                    progress_bar.progress((page_num + 1) / total_pages)
-                if status_text:
-                    status_text.text(f"📄 Обработка страницы {page_num + 1} из {total_pages}")
-
-                try:
-                    page = pdf.load_page(page_num)
-                    pix = page.get_pixmap(dpi=dpi)
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-                    if use_fast_mode:
-                        img = img.convert('L')
-                        config = TESSERACT_CONFIG_FAST
-                    else:
-                        config = '--oem 1 --psm 3'
-
-                    text = pytesseract.image_to_string(img, lang=lang, config=config)
-                    page_texts.append(text)
-                    extracted_text += f"\n{'='*50}\n📄 СТРАНИЦА {page_num + 1}\n{'='*50}\n\n{text}\n"
-
-                except Exception as page_error:
-                    page_texts.append("")
-                    extracted_text += f"\n{'='*50}\n📄 СТРАНИЦА {page_num + 1} - ОШИБКА\n{'='*50}\n\n{page_error}\n"
-                    continue
-
-            pdf.close()
-            result = (extracted_text, page_texts)
-
-        except Exception as e:
-            result = (f"❌ Ошибка при обработке PDF: {e}", [])
-
-    st.session_state.processing_time = time.time() - start_time
+            if status_text:
+                status_text.text(format_queue_status(status))
+        except BaseException:
+            cancel_event.set()
+            raise
+
+    result = run_ocr_pipeline(pdf_path,
+                              dpi=dpi,
+                              lang=lang,
+                              use_parallel=use_parallel,
+                              use_fast_mode=use_fast_mode,
+                              use_text_layer=use_text_layer,
+                              max_workers=max_workers,
+                              engine=engine,
+                              use_cache=use_cache,
+                              on_update=update,
+                              adaptive=adaptive,
+                              preprocess=preprocess,
+                              skip_blank=skip_blank,
+                              doc_hash=doc_hash,
+                              total_pages=total_pages,
+                              use_journal=use_journal,
+                              page_numbers=page_numbers,
+                              preview_first=preview_first,
+                              page_timeout=page_timeout,
+                              cancel_event=cancel_event,
+                              word_boxes=word_boxes,
+                              on_queue=on_queue)
+
+    # Число страниц берем из текущего файла, а не из прошлой обработки
+    st.session_state.total_pages = result["total_pages"]
+    st.session_state.processing_time = result["processing_time"]
     return result
 
-def create_zip_archive(page_texts):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for i, text in enumerate(page_texts):
-            filename = f"страница_{i+1:03d}.txt"
-            zip_file.writestr(filename, text)
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+def format_progress(completed, total, eta):
+    text = f"📄 Обработка страницы {completed} из {total}"
+    return f"{text}, осталось {format_duration(eta)}" if eta is not None and completed < total else text
+
+def format_queue_status(status):
+    return (f"⏳ Сервер занят ({status['sessions']} в работе): позиция в очереди {status['position']}, "
+            f"ожидание ~{status['eta']:.0f} с")
+
+def extract_text_via_service(job_id, progress_bar=None, status_text=None, estimated_time=None):
+    # Задание живет в сервисе: при обрыве соединения его можно продолжить по job_id
+    while True:
+        status = client_status(OCR_API_URL, job_id)
+        total = max(1, status["pages_total"])
+
+        if progress_bar:
+            progress_bar.progress(status["pages_done"] / total)
+        if status_text:
+            if status["status"] == "queued":
+                status_text.text(f"⏳ Задание в очереди, позиция {status['queue_position']}")
+            elif status.get("slot_queue"):
+                status_text.text(format_queue_status(status["slot_queue"]))
+            else:
+                elapsed = time.time() - status["started"] if status["started"] else 0.0
+                status_text.text(format_progress(status["pages_done"], status["pages_total"],
+                                                 live_eta(estimated_time, elapsed, status["pages_done"], total)))
+
+        if status["status"] == "failed":
+            raise RuntimeError(status["error"])
+        if status["status"] == "cancelled":
+            raise OCRCancelled("Задание остановлено")
+        if status["status"] == "done":
+            break
+        time.sleep(1)
+
+    result_dir = create_result_dir()
+    page_details = client_fetch_result(OCR_API_URL, job_id, result_dir)
+    st.session_state.total_pages = status["document_pages"]
+    st.session_state.processing_time = status["finished"] - status["started"]
+
+    return {
+        "result_dir": result_dir,
+        "job_id": job_id,
+        "word_boxes": status["options"].get("word_boxes", False),
+        "lang": (status.get("language") or {}).get("lang", status["options"]["lang"]),
+        "language": status.get("language"),
+        "page_numbers": [details["page"] - 1 for details in page_details],
+        "page_details": page_details,
+        "chars": status["chars"],
+        "words": status["words"],
+        "peak_rss_mb": status.get("peak_rss_mb"),
+    }
+
+def inspect_upload(uploaded_file):
+    # Загрузка читается, хэшируется и открывается один раз: при перезапусках скрипта
+    # берутся запомненные число страниц, метаданные и путь к единственной копии на диске
+    upload_key = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    upload = st.session_state.get("upload")
+    if upload and upload["key"] == upload_key and os.path.exists(upload["path"]):
+        return upload
+
+    data = uploaded_file.getvalue()
+    upload_hash = hashlib.sha256(data).hexdigest()
+    try:
+        info = read_document_info(data)
+    except Exception:
+        # Если не получилось открыть, используем приблизительную оценку
+        info = {"pages": max(1, uploaded_file.size // 100000), "metadata": {}, "error": True}
+
+    cleanup_uploads()
+    upload = {"key": upload_key, "hash": upload_hash, "path": spool_upload(data, upload_hash), **info}
+    st.session_state.upload = upload
+    return upload
+
+def read_artifact(path):
+    # Файл результата читается с диска один раз: байты живут в сессии вместе с результатом
+    # (не в общем кэше процесса) и уходят с ним; mtime отличает пересобранный файл
+    stat = os.stat(path)
+    artifacts = st.session_state.setdefault("artifacts", {})
+    cached = artifacts.get(path)
+    if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+        with open(path, "rb") as f:
+            cached = artifacts[path] = ((stat.st_mtime_ns, stat.st_size), f.read())
+    return cached[1]
+
+def stop_processing():
+    # Сам запуск прерывается перезапуском скрипта после нажатия; задание сервиса отменяем явно
+    st.session_state.ocr_stopped = True
+    job_id = st.session_state.get("running_job")
+    if OCR_API_URL and job_id:
+        try:
+            client_cancel(OCR_API_URL, job_id)
+        except Exception:
+            pass
+        if "job" in st.query_params:
+            del st.query_params["job"]
+
+def partial_download_link(result_dir, file_name, pages, total):
+    # Ссылка с готовым префиксом прямо в странице: в отличие от st.download_button,
+    # нажатие не перезапускает скрипт и не прерывает обработку
+    with open(full_text_path(result_dir), "rb") as f:
+        data = base64.b64encode(f.read()).decode()
+    return (f'<a class="tool-link" download="{html.escape(file_name)}" '
+            f'href="data:text/plain;charset=utf-8;base64,{data}">'
+            f'📥 Скачать готовую часть ({pages} из {total} стр.)</a>')
+
+def store_result(result, name):
+    st.session_state.artifacts = {}
+    st.session_state.result_name = name
+    st.session_state.result_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    st.session_state.processed_files += 1
+    st.session_state.total_pages_processed += len(result["page_numbers"])
+    st.session_state.result_dir = result["result_dir"]
+    st.session_state.result_pages = result["page_numbers"]
+    st.session_state.result_chars = result["chars"]
+    st.session_state.result_words = result["words"]
+    st.session_state.page_details = result["page_details"]
+    # Источник для форматов с координатами слов: исходный PDF или задание сервиса
+    st.session_state.result_source = result.get("pdf_path")
+    st.session_state.result_job = result.get("job_id")
+    st.session_state.result_has_words = result["word_boxes"]
+    st.session_state.result_language = result.get("language")
+    st.session_state.result_lang = result["lang"]
+    st.session_state.result_peak_rss = result.get("peak_rss_mb")
+
+def prepare_format_file(fmt):
+    # Файл формата собирается локально из сохраненных слов или скачивается из сервиса
+    path = format_path(st.session_state.result_dir, fmt)
+    if st.session_state.get("result_job"):
+        client_download_to(OCR_API_URL, st.session_state.result_job, FORMATS[fmt]["resource"], path + ".part")
+        os.replace(path + ".part", path)
+        return path
+
+    source = st.session_state.get("result_source")
+    if not source or not os.path.exists(source):
+        raise FileNotFoundError("исходный PDF больше недоступен, загрузите файл заново")
+    return build_format_file(st.session_state.result_dir, fmt, source,
+                             st.session_state.result_pages, st.session_state.page_details)
 
 # ==================== ОСНОВНОЙ ИНТЕРФЕЙС ====================
 def main():
@@ -480,16 +583,24 @@ def main():
             [
                 "⚡ Максимальная скорость (200 DPI)",
                 "⚖️ Сбалансированный (250 DPI)", 
-                "🎯 Максимальная точность (300 DPI)"
+                "🎯 Максимальная точность (300 DPI)",
+                "🧠 Адаптивный (200 DPI + точный повтор)"
             ],
             index=0,
-            help="Быстрый режим работает в 2-3 раза быстрее"
+            help="Быстрый режим работает в 2-3 раза быстрее. Адаптивный распознает все быстро "
+                 "и повторяет с 300 DPI только страницы и строки, в которых Tesseract не уверен"
         )
 
+        adaptive = "Адаптивный" in speed_mode
+
         if "Максимальная скорость" in speed_mode:
             dpi = 200
             use_fast_mode = True
             speed_badge = "<span class='speed-badge'>3x быстрее</span>"
+        elif adaptive:
+            dpi = MODE_DPI[MODE_ADAPTIVE]
+            use_fast_mode = True
+            speed_badge = "<span class='speed-badge'>точность по требованию</span>"
         elif "Сбалансированный" in speed_mode:
             dpi = 250
             use_fast_mode = True
@@ -505,10 +616,85 @@ def main():
             help="Ускоряет обработку в 2-4 раза (рекомендуется для 2+ страниц)"
         )
 
+        max_workers = st.number_input(
+            "Количество процессов OCR",
+            min_value=1,
+            max_value=64,
+            value=get_worker_count(),
+            disabled=not use_parallel,
+            help="Сколько страниц этого документа распознается одновременно. Общее число слотов "
+                 "на сервер - по числу ядер CPU; при нескольких пользователях они делятся поровну"
+        )
+
+        page_timeout = st.number_input(
+            "Лимит времени на страницу, с",
+            min_value=0,
+            max_value=3600,
+            value=PAGE_TIMEOUT,
+            step=10,
+            help="Страница, не уложившаяся в лимит, повторяется с меньшим DPI, а затем помечается ошибкой. "
+                 "0 - без ограничения"
+        )
+
+        use_text_layer = st.checkbox(
+            "Использовать текстовый слой PDF",
+            value=True,
+            help="Страницы с готовым текстом извлекаются без OCR, сканы распознаются Tesseract"
+        )
+
+        skip_blank = st.checkbox(
+            "Пропускать пустые страницы",
+            value=True,
+            help="Разделители, пустые обороты и страницы только с печатью определяются до OCR и не распознаются"
+        )
+
+        preprocess = st.checkbox(
+            "Предобработка сканов (OpenCV)",
+            value=False,
+            disabled=not is_preprocess_available(),
+            help="Выравнивание наклона, бинаризация, удаление шума и обрезка полей перед OCR. "
+                 "Помогает для кривых и зашумленных фотографий страниц"
+        )
+
+        word_boxes = st.checkbox(
+            "Координаты слов (TSV, hOCR, ALTO, PDF с текстом)",
+            value=False,
+            help="Сохранять рамки и уверенность каждого слова из того же прохода OCR: "
+                 "после обработки можно скачать TSV, hOCR, ALTO XML и PDF с невидимым текстовым слоем"
+        )
+
+        engine_options = [ENGINE_AUTO, ENGINE_API, ENGINE_CLI] if is_api_engine_available() else [ENGINE_CLI]
+        engine = st.selectbox(
+            "Движок OCR",
+            engine_options,
+            index=0,
+            format_func=lambda value: ENGINE_LABELS[value],
+            help="Tesseract API держит языковые модели загруженными и не запускает процесс на каждую страницу"
+        )
+
         language = st.selectbox("Язык распознавания",
                                 ["rus+eng", "rus", "eng", "fra", "deu", "spa"],
                                 index=0)
 
+        auto_language = st.checkbox(
+            "Определять язык и поворот по документу",
+            value=False,
+            help="По уменьшенным копиям нескольких страниц определяются поворот скана и письменности текста. "
+                 "Из выбранного набора убираются языки письменностей, которых в документе нет: "
+                 "один язык вместо двух ускоряет распознавание"
+        )
+        if auto_language:
+            language = f"{LANG_AUTO}:{language}"
+
+        use_cache = st.checkbox(
+            "Кэш результатов OCR",
+            value=True,
+            help="Повторно загруженные документы берутся из кэша без распознавания. "
+                 "Кэш общий для всех сессий, его лимит задается переменной OCR_CACHE_MAX_MB"
+        )
+
+        cache_info = cache_stats()
+
         st.markdown(f'''
         <div class="ozon-card">
             <div class="card-header">
@@ -518,12 +704,18 @@ def main():
             <div class="ozon-status">
                 <strong>Обработано файлов:</strong> {st.session_state.processed_files}<br>
                 <strong>Всего страниц:</strong> {st.session_state.total_pages_processed}<br>
-                <strong>Последняя обработка:</strong> {st.session_state.processing_time:.1f}с
+                <strong>Последняя обработка:</strong> {st.session_state.processing_time:.1f}с<br>
+                <strong>Кэш:</strong> {cache_info["hits"]} попаданий / {cache_info["misses"]} промахов<br>
+                <strong>Размер кэша:</strong> {cache_info["entries"]} стр., {cache_info["size_mb"]:.1f} из {cache_info["limit_mb"]:.0f} МБ
             </div>
         </div>
         ''',
                     unsafe_allow_html=True)
 
+        if st.button("🗑️ Очистить кэш", disabled=not cache_info["entries"]):
+            clear_cache()
+            st.rerun()
+
         with st.expander("⚠️ Ограничения бесплатного хостинга"):
             st.markdown("""
             **На бесплатном хостинге:**
@@ -569,11 +761,13 @@ def main():
         ''',
                     unsafe_allow_html=True)
 
-    return dpi, language, use_parallel, use_fast_mode, speed_badge
+    return dpi, language, use_parallel, use_fast_mode, speed_badge, use_text_layer, max_workers, engine, use_cache, adaptive, preprocess, skip_blank, page_timeout, word_boxes
 
 # ==================== ОСНОВНАЯ ЛОГИКА ====================
 def run_app():
-    dpi, language, use_parallel, use_fast_mode, speed_badge = main()
+    # Не при импорте: рабочие процессы пула импортируют этот скрипт заново и не должны запускать прогрев
+    start_warm_up()
+    dpi, language, use_parallel, use_fast_mode, speed_badge, use_text_layer, max_workers, engine, use_cache, adaptive, preprocess, skip_blank, page_timeout, word_boxes = main()
 
     # Заголовок сайта
     st.markdown('<div style="display: flex; align-items: center; justify-content: center; gap: 12px;"><img src="https://cdn1.ozone.ru/s3/common-image-storage/bx/char_cat-box-four_m.png" alt="Коробка Ozon" style="height: 80px; width: 80px; object-fit: contain;"><h1 style="color: #005BFF; font-size: 2.5rem; text-align: center; font-weight: 800; margin: 0; line-height: 1;">Text Extractor PDF OCR </h1></div>', unsafe_allow_html=True)
@@ -583,7 +777,9 @@ def run_app():
         unsafe_allow_html=True)
 
     speed_info = ""
-    if dpi == 200:
+    if adaptive:
+        speed_info = "🧠 **Режим:** Адаптивный (200 DPI, точный повтор при низкой уверенности)"
+    elif dpi == 200:
         speed_info = "⚡ **Режим:** Максимальная скорость (200 DPI)"
     elif dpi == 250:
         speed_info = "⚖️ **Режим:** Сбалансированный (250 DPI)"
@@ -591,11 +787,15 @@ def run_app():
         speed_info = "🎯 **Режим:** Максимальная точность (300 DPI)"
 
     if use_parallel:
-        speed_info += " | **Параллельная обработка:** включена"
+        speed_info += f" | **Параллельная обработка:** {max_workers} проц."
+    if use_text_layer:
+        speed_info += " | **Текстовый слой:** используется"
+    if preprocess:
+        speed_info += " | **Предобработка:** включена"
 
     st.info(speed_info)
 
-    if not st.session_state.tesseract_available:
+    if not probe_tesseract()["path"]:
         st.error("""
         ## ⚠️ Tesseract не установлен!
 
@@ -624,31 +824,80 @@ def run_app():
 
         uploaded_file = st.file_uploader("Выберите PDF файл", type=['pdf'])
 
-        if uploaded_file:
-            # Определяем реальное количество страниц
-            real_page_count = 0
+        ocr_stopped = st.session_state.pop("ocr_stopped", False)
+        if ocr_stopped:
+            st.warning("⏹️ Обработка остановлена. Готовые страницы сохранены: "
+                       "повторный запуск с теми же настройками продолжит с них.")
+
+        # Готовая часть остановленной обработки; во время работы она скачивается по ссылке под предпросмотром
+        partial_dir = st.session_state.pop("partial_result", None)
+        if ocr_stopped and partial_dir and uploaded_file and os.path.exists(full_text_path(partial_dir)):
+            st.download_button("📥 Скачать готовую часть",
+                               read_artifact(full_text_path(partial_dir)),
+                               file_name=f"{uploaded_file.name.replace('.pdf', '')}_часть.txt",
+                               mime="text/plain")
+
+        # Продолжение задания сервиса после перезагрузки страницы или обрыва соединения
+        pending_job = st.query_params.get("job") if OCR_API_URL else None
+        if pending_job and st.session_state.get("remote_job") != pending_job:
+            st.session_state.remote_job = pending_job
+            progress_bar = st.progress(0)
+            status_text = st.empty()
             try:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-                    tmp.write(uploaded_file.getvalue())
-                    tmp_path = tmp.name
-
-                pdf = fitz.open(tmp_path)
-                real_page_count = len(pdf)
-                pdf.close()
-                os.unlink(tmp_path)
-
-            except:
-                # Если не получилось определить, используем приблизительную оценку
-                real_page_count = max(1, uploaded_file.size // 100000)  # Более точная оценка
+                result = extract_text_via_service(pending_job, progress_bar, status_text)
+                store_result(result, client_status(OCR_API_URL, pending_job)["name"])
+                status_text.text(f"✅ Задание завершено за {st.session_state.processing_time:.1f} секунд")
+            except Exception as e:
+                status_text.empty()
+                st.error(f"❌ Не удалось получить результат задания: {e}")
+            finally:
+                progress_bar.empty()
 
-            # Время обработки на хостинге (дольше чем локально)
-            estimated_time = real_page_count * (5 if dpi == 200 else 7 if dpi == 250 else 10)
+        if uploaded_file:
+            upload = inspect_upload(uploaded_file)
+            real_page_count = upload["pages"]
+            document_title = upload["metadata"].get("title")
+
+            page_spec = st.text_input(
+                "Страницы",
+                placeholder="все, например 1-5,12,40-",
+                help="Номера и диапазоны страниц через запятую; открытый диапазон 40- - до конца документа"
+            )
+            try:
+                page_numbers = parse_page_range(page_spec, real_page_count)
+            except ValueError as e:
+                page_numbers = []
+                st.error(f"❌ {e}")
+
+            preview_first = st.checkbox(
+                "Сначала первые страницы",
+                value=True,
+                help=f"Первые {PREVIEW_FIRST_PAGES} стр. распознаются сразу, и предпросмотр появляется через "
+                     "несколько секунд, пока остальные страницы обрабатываются"
+            )
+
+            # Оценка по размеру страниц, доле сканов и замерам прошлых заданий на этом сервере
+            page_areas = upload.get("page_areas") or []
+            estimated_time = estimate_processing_time(
+                [page_areas[page_num] if page_num < len(page_areas) else None for page_num in page_numbers],
+                upload.get("ocr_share", 1.0),
+                make_ocr_options(dpi=dpi, use_fast_mode=use_fast_mode, use_text_layer=use_text_layer,
+                                 adaptive=adaptive, preprocess=preprocess, skip_blank=skip_blank),
+                max_workers if use_parallel else 1,
+                upload.get("blank_share", 0.0))
+            timing_jobs = load_timing_model()["jobs"]
+            calibration = (f"Оценка по замерам {timing_jobs} прошлых заданий на этом сервере" if timing_jobs
+                           else "Оценка уточнится после первых заданий на этом сервере")
 
             file_info = f"""
             **📎 Файл:** {uploaded_file.name}<br>
             **📊 Размер:** {uploaded_file.size/1024:.1f} KB<br>
             **📄 Количество страниц:** {real_page_count}
             """
+            if page_spec.strip() and page_numbers:
+                file_info += f"<br>**✂️ Выбрано страниц:** {len(page_numbers)}"
+            if document_title:
+                file_info += f"<br>**🏷️ Название:** {document_title}"
 
             st.markdown(f'<div class="uploaded-file-info">{file_info}</div>',
                         unsafe_allow_html=True)
@@ -657,38 +906,125 @@ def run_app():
             st.markdown(f'''
             <div class="warning-note">
                 ⚠️ **На бесплатном хостинге:**<br>
-                • Примерное время обработки: ~{estimated_time} секунд<br>
-                • Фактическое время может отличаться из-за ограничений хостинга<br>
+                • Примерное время обработки: {format_duration(estimated_time)}<br>
+                • {calibration}<br>
                 • Для больших файлов рекомендуется локальная обработка
             </div>
             ''', unsafe_allow_html=True)
 
-            if st.button("🚀 Начать обработку OCR", use_container_width=True):
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-                    tmp.write(uploaded_file.getvalue())
-                    pdf_path = tmp.name
+            if st.button("🚀 Начать обработку OCR", use_container_width=True, disabled=not page_numbers):
+                pdf_path = upload["path"]
+
+                # Результаты прошлой обработки больше не нужны
+                remove_result_dir(st.session_state.result_dir)
+                st.session_state.result_dir = None
+                st.session_state.artifacts = {}
+                cleanup_result_dirs()
+                cleanup_journals()
 
                 try:
                     progress_bar = st.progress(0)
                     status_text = st.empty()
-
-                    status_text.text("🔄 Начинаю обработку на хостинге...")
-
-                    extracted_text, page_texts = extract_text_from_pdf_optimized(
-                        pdf_path,
-                        dpi=dpi,
-                        lang=language,
-                        use_parallel=use_parallel,
-                        use_fast_mode=use_fast_mode,
-                        progress_bar=progress_bar,
-                        status_text=status_text)
-
-                    st.session_state.processed_files += 1
-                    st.session_state.total_pages_processed += len(page_texts)
-                    st.session_state.result_text = extracted_text
-                    st.session_state.page_texts = page_texts
+                    stop_button = st.empty()
+                    stop_button.button("⏹️ Остановить обработку", on_click=stop_processing, key="stop_ocr")
+                    live_preview = st.empty()
+                    partial_link = st.empty()
+                    last_update = 0.0
+                    shown_prefix = 0
+                    linked_prefix = 0
+
+                    if is_auto_language(language):
+                        status_text.text("🔄 Определяю язык и поворот страниц...")
+                    else:
+                        status_text.text("🔄 Начинаю обработку на хостинге...")
+
+                    def show_partial_result(result_dir, snapshot):
+                        # Растущий префикс документа: готовые подряд страницы с начала
+                        nonlocal last_update, shown_prefix, linked_prefix
+                        now = time.time()
+                        # Первые страницы в режиме предпросмотра показываем сразу, без паузы
+                        preview_ready = (preview_first and shown_prefix < snapshot["prefix_pages"]
+                                         and shown_prefix < PREVIEW_FIRST_PAGES)
+                        if (now - last_update < LIVE_UPDATE_INTERVAL and snapshot["completed"] < snapshot["total"]
+                                and not preview_ready):
+                            return
+                        last_update = now
+                        shown_prefix = snapshot["prefix_pages"]
+
+                        with live_preview.container():
+                            st.caption(f"Готово подряд с начала: {snapshot['prefix_pages']} из {snapshot['total']} стр.")
+                            st.text_area("Предпросмотр",
+                                         read_text_prefix(result_dir, PREVIEW_CHARS),
+                                         height=200,
+                                         label_visibility="collapsed")
+
+                        # Ссылка пересобирается, только когда префикс вырос; остановка - отдельной кнопкой
+                        if snapshot["prefix_pages"] > linked_prefix:
+                            linked_prefix = snapshot["prefix_pages"]
+                            st.session_state.partial_result = result_dir
+                            partial_link.markdown(
+                                partial_download_link(result_dir,
+                                                      f"{uploaded_file.name.replace('.pdf', '')}_часть.txt",
+                                                      linked_prefix, snapshot["total"]),
+                                unsafe_allow_html=True)
+
+                    if OCR_API_URL:
+                        if adaptive:
+                            mode = MODE_ADAPTIVE
+                        else:
+                            mode = {value: key for key, value in MODE_DPI.items() if key != MODE_ADAPTIVE}[dpi]
+                        job_id = client_submit(OCR_API_URL,
+                                               uploaded_file.getvalue(),
+                                               uploaded_file.name,
+                                               mode=mode,
+                                               lang=language,
+                                               use_text_layer=use_text_layer,
+                                               engine=engine,
+                                               use_cache=use_cache,
+                                               preprocess=preprocess,
+                                               skip_blank=skip_blank,
+                                               pages=page_spec.strip() or None,
+                                               preview_first=preview_first,
+                                               page_timeout=page_timeout,
+                                               word_boxes=word_boxes)
+                        # Номер задания в адресе: после перезагрузки страницы результат не теряется
+                        st.query_params["job"] = job_id
+                        st.session_state.running_job = job_id
+                        result = extract_text_via_service(job_id, progress_bar, status_text, estimated_time)
+                        st.session_state.remote_job = job_id
+                    else:
+                        result = extract_text_from_pdf_optimized(
+                            pdf_path,
+                            dpi=dpi,
+                            lang=language,
+                            use_parallel=use_parallel,
+                            use_fast_mode=use_fast_mode,
+                            progress_bar=progress_bar,
+                            status_text=status_text,
+                            use_text_layer=use_text_layer,
+                            max_workers=max_workers,
+                            engine=engine,
+                            use_cache=use_cache,
+                            on_update=show_partial_result,
+                            adaptive=adaptive,
+                            preprocess=preprocess,
+                            skip_blank=skip_blank,
+                            doc_hash=upload["hash"],
+                            total_pages=upload["pages"] if not upload.get("error") else None,
+                            page_numbers=page_numbers,
+                            preview_first=preview_first,
+                            page_timeout=page_timeout,
+                            word_boxes=word_boxes,
+                            estimated_time=estimated_time)
+
+                    page_count = len(result["page_numbers"])
+                    store_result(result, uploaded_file.name)
 
                     progress_bar.empty()
+                    stop_button.empty()
+                    live_preview.empty()
+                    partial_link.empty()
+                    st.session_state.pop("partial_result", None)
 
                     status_text.text(f"✅ Обработка завершена за {st.session_state.processing_time:.1f} секунд")
 
@@ -701,14 +1037,14 @@ def run_app():
                         """)
                     else:
                         st.success(
-                            f"✅ Распознано {len(page_texts)} страниц за {st.session_state.processing_time:.1f} секунд"
+                            f"✅ Распознано {page_count} страниц за {st.session_state.processing_time:.1f} секунд"
                         )
 
+                except OCRCancelled:
+                    stop_button.empty()
+                    st.warning("⏹️ Обработка остановлена")
                 except Exception as e:
                     st.error(f"❌ Ошибка: {e}")
-                finally:
-                    if os.path.exists(pdf_path):
-                        os.unlink(pdf_path)
 
     with col2:
         st.markdown('''
@@ -718,23 +1054,90 @@ def run_app():
         ''',
                     unsafe_allow_html=True)
 
-        if st.session_state.result_text:
-            total_chars = len(st.session_state.result_text)
-            total_words = len(st.session_state.result_text.split())
+        if st.session_state.result_dir and os.path.isdir(st.session_state.result_dir):
+            total_chars = st.session_state.result_chars
+            processed_pages = len(st.session_state.get('result_pages', []))
+            page_summary = str(st.session_state.total_pages)
+            if processed_pages != st.session_state.total_pages:
+                page_summary = f"{processed_pages} из {st.session_state.total_pages}"
+            total_words = st.session_state.result_words
+            route_counts = summarize_routes(st.session_state.get('page_details', []))
+            escalated_pages = count_escalated(st.session_state.get('page_details', []))
+            extra_info = f"<br><strong>🧠 Повторено точно:</strong> {escalated_pages} стр." if escalated_pages else ""
+            resumed_pages = sum(1 for d in st.session_state.get('page_details', []) if d and d.get("resumed"))
+            if resumed_pages:
+                extra_info += f"<br><strong>♻️ Восстановлено из журнала:</strong> {resumed_pages} стр."
+            language_info = st.session_state.get('result_lang', language)
+            detection = st.session_state.get('result_language')
+            if detection:
+                # Стоимость определения языка: проба нескольких страниц до распознавания
+                cost = "из кэша" if detection.get("cached") else f"{detection['seconds']:.1f} с"
+                language_info += f" (авто, {cost})"
+                if detection["rotation"]:
+                    extra_info += f"<br><strong>🔄 Поворот сканов:</strong> {detection['rotation']}°"
+            capped_pages = sum(1 for d in st.session_state.get('page_details', []) if d and d.get("dpi_capped"))
+            if capped_pages:
+                extra_info += f"<br><strong>📐 Уменьшен DPI (крупный формат):</strong> {capped_pages} стр."
+            if st.session_state.get('result_peak_rss'):
+                extra_info += f"<br><strong>💾 Пик памяти:</strong> {st.session_state.result_peak_rss:.0f} МБ"
+            stage_totals = summarize_stage_timings(st.session_state.get('page_details', []))
+            if stage_totals["preprocess"]:
+                extra_info += (f"<br><strong>🧹 Предобработка:</strong> {stage_totals['preprocess']:.1f} с"
+                                   f" (OCR: {stage_totals['ocr']:.1f} с)")
 
             st.markdown(f'''
             <div class="stats-card">
                 <h4>📊 Статистика обработки:</h4>
-                <strong>📄 Страниц:</strong> {st.session_state.total_pages}<br>
+                <strong>📄 Страниц:</strong> {page_summary}<br>
                 <strong>⏱️ Время:</strong> {st.session_state.processing_time:.1f} сек<br>
                 <strong>🔤 Символов:</strong> {total_chars:,}<br>
                 <strong>📝 Слов:</strong> {total_words:,}<br>
                 <strong>⚡ DPI:</strong> {dpi}<br>
-                <strong>🌐 Язык:</strong> {language}
+                <strong>🌐 Язык:</strong> {language_info}<br>
+                <strong>📑 Текстовый слой:</strong> {route_counts[ROUTE_NATIVE]} стр.<br>
+                <strong>🔍 OCR:</strong> {route_counts[ROUTE_OCR]} стр.<br>
+                <strong>🔀 Текст + OCR:</strong> {route_counts[ROUTE_BOTH]} стр.<br>
+                <strong>⬜ Пустых:</strong> {route_counts[ROUTE_BLANK]} стр.{extra_info}
             </div>
             ''',
                         unsafe_allow_html=True)
 
+            if st.session_state.get('page_details'):
+                with st.expander("🧭 Маршрут обработки по страницам"):
+                    st.dataframe(
+                        [{"Страница": d["page"],
+                          "Маршрут": ROUTE_LABELS[d["route"]],
+                          "Символов в слое": d.get("glyphs", "—"),
+                          "Доля изображений": d.get("image_ratio", "—"),
+                          "Движок": ENGINE_LABELS.get(d.get("engine"), "—"),
+                          "DPI изображения": d.get("image_dpi", d.get("dpi_capped", "—")),
+                          "Наклон, °": d.get("skew", "—"),
+                          "Уверенность": d.get("confidence_final", d.get("confidence", "—")),
+                          "Повтор": {"page": "страница", "regions": f"строк: {d.get('escalated_regions')}"}.get(d.get("escalated"))
+                                    or (f"лимит времени, {d['timeout_retry_dpi']} DPI" if d.get("timeout_retry_dpi") else ""),
+                          "Из кэша": "да" if d.get("cached") else ("журнал" if d.get("resumed") else ""),
+                          "Ошибка": d.get("error", "")}
+                         for d in st.session_state.page_details if d],
+                        use_container_width=True,
+                        hide_index=True)
+
+                with st.expander("⏱️ Время по этапам"):
+                    st.markdown(" · ".join(
+                        f"**{STAGE_LABELS.get(stage, 'Очередь')}:** {seconds:.2f} с"
+                        for stage, seconds in stage_totals.items() if seconds))
+                    st.dataframe(
+                        [{"Страница": d["page"],
+                          "Процесс": d.get("worker", "—"),
+                          "Очередь, с": d.get("queue_wait", 0.0),
+                          **{f"{STAGE_LABELS[stage]}, с": d.get("timings", {}).get(stage, 0.0) for stage in STAGES},
+                          "Всего, с": d.get("seconds", 0.0)}
+                         for d in st.session_state.page_details if d and not d.get("cached") and not d.get("resumed")],
+                        use_container_width=True,
+                        hide_index=True)
+
+                with st.expander("📈 Метрики (Prometheus)"):
+                    st.code(render_prometheus(), language="text")
+
             st.markdown('''
             <div class="section-header">
                 <span class="step-number">3</span> Скачать результат
@@ -742,38 +1145,58 @@ def run_app():
             ''',
                         unsafe_allow_html=True)
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            base_name = uploaded_file.name.replace('.pdf', '')
-
-            full_filename = f"{base_name}_текст_{timestamp}.txt"
-            b64_full = base64.b64encode(
-                st.session_state.result_text.encode()).decode()
-            st.markdown(f'''
-            <a href="data:text/plain;base64,{b64_full}" download="{full_filename}" style="text-decoration: none;">
-                <button style="background: linear-gradient(135deg, #005BFF, #004ACC); color: white; border: none; padding: 10px; border-radius: 8px; width: 100%; margin: 5px 0; cursor: pointer;">
-                    📥 Скачать полный текст
-                </button>
-            </a>
-            ''',
-                        unsafe_allow_html=True)
-
-            if hasattr(st.session_state, 'page_texts'):
-                zip_data = create_zip_archive(st.session_state.page_texts)
-                zip_filename = f"{base_name}_страницы_{timestamp}.zip"
-                b64_zip = base64.b64encode(zip_data).decode()
-                st.markdown(f'''
-                <a href="data:application/zip;base64,{b64_zip}" download="{zip_filename}" style="text-decoration: none;">
-                    <button style="background: linear-gradient(135deg, #FF6B00, #FF8C00); color: white; border: none; padding: 10px; border-radius: 8px; width: 100%; margin: 5px 0; cursor: pointer;">
-                        📦 Скачать по страницам (ZIP)
-                    </button>
-                </a>
-                ''',
-                            unsafe_allow_html=True)
+            timestamp = st.session_state.get('result_timestamp') or datetime.now().strftime("%Y%m%d_%H%M%S")
+            base_name = st.session_state.result_name.replace('.pdf', '')
+
+            # Файлы отдаются настоящими загрузками, а не data-ссылками в HTML страницы
+            full_path = full_text_path(st.session_state.result_dir)
+            st.download_button("📥 Скачать полный текст",
+                               read_artifact(full_path),
+                               file_name=f"{base_name}_текст_{timestamp}.txt",
+                               mime="text/plain",
+                               use_container_width=True)
+
+            if st.session_state.get('result_pages'):
+                # Архив собирается на диске только по запросу и один раз на результат
+                zip_path = pages_zip_path(st.session_state.result_dir)
+                if not os.path.exists(zip_path):
+                    if st.button("📦 Подготовить архив по страницам (ZIP)", use_container_width=True):
+                        with st.spinner("Собираю архив..."):
+                            build_pages_zip(st.session_state.result_dir,
+                                            st.session_state.result_pages,
+                                            blank_page_numbers(st.session_state.get('page_details', [])))
+
+                if os.path.exists(zip_path):
+                    st.download_button("📦 Скачать по страницам (ZIP)",
+                                       read_artifact(zip_path),
+                                       file_name=f"{base_name}_страницы_{timestamp}.zip",
+                                       mime="application/zip",
+                                       use_container_width=True)
+
+            if st.session_state.get('result_has_words'):
+                word_format = st.selectbox("Формат с координатами слов",
+                                           list(FORMATS),
+                                           format_func=lambda value: FORMATS[value]["label"])
+                format_file = format_path(st.session_state.result_dir, word_format)
+                if not os.path.exists(format_file):
+                    if st.button(f"🗂️ Подготовить {FORMATS[word_format]['label']}", use_container_width=True):
+                        with st.spinner("Собираю файл..."):
+                            try:
+                                prepare_format_file(word_format)
+                            except Exception as e:
+                                st.error(f"❌ Не удалось подготовить файл: {e}")
+
+                if os.path.exists(format_file):
+                    st.download_button(f"🗂️ Скачать {FORMATS[word_format]['label']}",
+                                       read_artifact(format_file),
+                                       file_name=f"{base_name}_{timestamp}_{FORMATS[word_format]['file']}",
+                                       mime=FORMATS[word_format]["mime"],
+                                       use_container_width=True)
 
             with st.expander("👁️ Предпросмотр текста"):
-                preview = st.session_state.result_text[:2000] + "..." if len(
-                    st.session_state.result_text
-                ) > 2000 else st.session_state.result_text
+                preview = read_text_prefix(st.session_state.result_dir, PREVIEW_CHARS)
+                if total_chars > PREVIEW_CHARS:
+                    preview += "..."
                 st.text_area("",
                             preview,
                             height=300,
@@ -0,0 +1,308 @@
+import io
+import os
+import sys
+import json
+import random
+import difflib
+import argparse
+import platform
+import tempfile
+import itertools
+import statistics
+from datetime import datetime
+
+import fitz  # PyMuPDF
+import pytesseract
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+from ocr_engine import (
+    setup_tesseract,
+    get_worker_count,
+    reset_process_pool,
+    warm_process_pool,
+    extract_text_from_pdf_optimized,
+)
+from ocr_scheduler import set_slot_capacity
+from ocr_results import read_page_text, remove_result_dir
+from ocr_metrics import reset_peak_rss, read_peak_rss_mb
+
+# ==================== БЕНЧМАРК ПРОИЗВОДИТЕЛЬНОСТИ OCR ====================
+# Синтетические «сканы» с известным текстом: скорость, задержка, память и точность.
+#
+#   python benchmark.py -o bench.json
+#   python benchmark.py -o new.json --baseline bench.json --tolerance 0.15
+#
+# Код возврата 1, если относительно базового прогона упала скорость или точность.
+# Страницы рендерятся с DPI каждого режима; --native-image оставляет обычный путь,
+# где встроенный скан уходит в OCR как есть и все уровни DPI дают одно и то же изображение.
+
+SAMPLE_LINES = [
+    "Договор поставки № 17/2024 от 12 марта 2024 года",
+    "Поставщик обязуется передать товар в собственность Покупателя",
+    "Сумма договора составляет 1 250 000 рублей, включая НДС 20%",
+    "Срок исполнения обязательств - тридцать календарных дней",
+    "Акт приема-передачи подписывается обеими сторонами",
+    "The supplier shall deliver the goods within 30 days",
+    "Invoice total: 4,815.16 EUR, payment due on receipt",
+    "Quality control report, batch number QX-2291-B",
+    "Съешь же ещё этих мягких французских булок, да выпей чаю",
+    "The quick brown fox jumps over the lazy dog 0123456789",
+]
+
+# Размер страницы в пунктах PDF
+PAGE_SIZES = {
+    "A4": (595, 842),
+    "A5": (420, 595),
+    "Letter": (612, 792),
+}
+
+DOCUMENT_PROFILES = [
+    {"name": "a4_clean", "pages": 4, "size": "A4", "scan_dpi": 300, "noise": 0.0},
+    {"name": "a4_noisy", "pages": 4, "size": "A4", "scan_dpi": 200, "noise": 0.04},
+    {"name": "a5_clean", "pages": 2, "size": "A5", "scan_dpi": 300, "noise": 0.0},
+    {"name": "letter_long", "pages": 12, "size": "Letter", "scan_dpi": 200, "noise": 0.02},
+]
+
+QUICK_PROFILES = ["a4_clean", "a4_noisy"]
+
+# (DPI, быстрый режим) - уровни качества интерфейса и их перекрестные варианты
+CONFIGURATIONS = [(dpi, fast) for dpi in (200, 250, 300) for fast in (True, False)]
+QUICK_CONFIGURATIONS = [(200, True), (300, False)]
+
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+]
+
+# ==================== СИНТЕТИЧЕСКИЕ ДОКУМЕНТЫ ====================
+
+def load_font(size):
+    for path in FONT_CANDIDATES:
+        if os.path.exists(path):
+            return ImageFont.truetype(path, size)
+    # Встроенный шрифт PyMuPDF содержит кириллицу и есть всегда
+    return ImageFont.truetype(io.BytesIO(fitz.Font("helv").buffer), size)
+
+def render_scan_page(lines, size_pt, scan_dpi, noise, rng):
+    width = int(size_pt[0] / 72 * scan_dpi)
+    height = int(size_pt[1] / 72 * scan_dpi)
+    img = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(img)
+
+    font_size = int(scan_dpi * 11 / 72)
+    font = load_font(font_size)
+    margin = int(scan_dpi * 0.8)
+    y = margin
+    for line in lines:
+        draw.text((margin, y), line, fill=0, font=font)
+        y += int(font_size * 1.6)
+
+    if noise:
+        # Шум «соль-перец» и легкое размытие, как у дешевого сканера
+        pixels = img.load()
+        for _ in range(int(width * height * noise)):
+            pixels[rng.randrange(width), rng.randrange(height)] = rng.choice((0, 255))
+        img = img.filter(ImageFilter.GaussianBlur(0.6))
+
+    return img
+
+def build_document(profile, path, seed):
+    rng = random.Random(seed)
+    size_pt = PAGE_SIZES[profile["size"]]
+    lines_per_page = max(4, int(size_pt[1] / 842 * 14))
+
+    doc = fitz.open()
+    ground_truth = []
+    for _ in range(profile["pages"]):
+        lines = [rng.choice(SAMPLE_LINES) for _ in range(lines_per_page)]
+        img = render_scan_page(lines, size_pt, profile["scan_dpi"], profile["noise"], rng)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        page = doc.new_page(width=size_pt[0], height=size_pt[1])
+        page.insert_image(page.rect, stream=buffer.getvalue())
+        ground_truth.append("\n".join(lines))
+
+    doc.save(path)
+    doc.close()
+    return ground_truth
+
+# ==================== МЕТРИКИ ====================
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+def char_accuracy(recognized, truth):
+    truth = normalize_text(truth)
+    if not truth:
+        return 1.0
+    matcher = difflib.SequenceMatcher(None, normalize_text(recognized), truth, autojunk=False)
+    matched = sum(block.size for block in matcher.get_matching_blocks())
+    return matched / len(truth)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def run_case(pdf_path, ground_truth, dpi, use_fast_mode, use_parallel, workers, lang, preprocess=False, native_image=False):
+    reset_process_pool()
+    set_slot_capacity(workers)
+    if use_parallel:
+        warm_process_pool(workers)
+    reset_peak_rss()
+
+    result = extract_text_from_pdf_optimized(
+        pdf_path,
+        dpi=dpi,
+        lang=lang,
+        use_parallel=use_parallel,
+        use_fast_mode=use_fast_mode,
+        use_text_layer=False,
+        max_workers=workers,
+        use_cache=False,
+        preprocess=preprocess,
+        native_image=native_image)
+
+    main_rss = read_peak_rss_mb()
+    # Рабочие процессы считают пик на каждую страницу: пик процесса - максимум по его страницам
+    worker_peaks = {}
+    for details in result["page_details"]:
+        if details and "peak_rss_mb" in details:
+            worker_peaks[details["worker"]] = max(worker_peaks.get(details["worker"], 0.0), details["peak_rss_mb"])
+    worker_rss = list(worker_peaks.values())
+
+    latencies = [d["seconds"] for d in result["page_details"] if d and "seconds" in d]
+    accuracies = [char_accuracy(read_page_text(result["result_dir"], page_num), truth)
+                  for page_num, truth in enumerate(ground_truth)]
+    errors = sum(1 for d in result["page_details"] if d and d.get("error"))
+    # Страницы, где OCR получил встроенный скан как есть: DPI на них не влиял
+    native_pages = sum(1 for d in result["page_details"] if d and d.get("source") == "image")
+    remove_result_dir(result["result_dir"])
+
+    elapsed = result["processing_time"]
+    return {
+        "pages": result["total_pages"],
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(result["total_pages"] / max(elapsed, 1e-9), 3),
+        "latency_p50": round(percentile(latencies, 0.5), 3),
+        "latency_p95": round(percentile(latencies, 0.95), 3),
+        "peak_rss_mb": round(main_rss + sum(worker_rss), 1),
+        "peak_rss_main_mb": round(main_rss, 1),
+        "peak_rss_worker_max_mb": round(max(worker_rss, default=0.0), 1),
+        "char_accuracy": round(statistics.mean(accuracies), 4) if accuracies else 0.0,
+        "errors": errors,
+        "native_image_pages": native_pages,
+    }
+
+def config_key(result):
+    mode = "fast" if result["fast"] else "accurate"
+    scheduling = "parallel" if result["parallel"] else "sequential"
+    suffix = "/preprocess" if result.get("preprocess") else ""
+    if result.get("native_image"):
+        suffix += "/native"
+    return f"{result['document']}/{result['dpi']}dpi/{mode}/{scheduling}{suffix}"
+
+# ==================== СРАВНЕНИЕ С БАЗОВЫМ ПРОГОНОМ ====================
+
+def compare_with_baseline(results, baseline_path, tolerance, accuracy_tolerance):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {config_key(r): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        old = baseline.get(config_key(result))
+        if old is None:
+            continue
+        if result["pages_per_sec"] < old["pages_per_sec"] * (1 - tolerance):
+            regressions.append(f"{config_key(result)}: скорость {old['pages_per_sec']} -> {result['pages_per_sec']} стр/с")
+        if result["char_accuracy"] < old["char_accuracy"] - accuracy_tolerance:
+            regressions.append(f"{config_key(result)}: точность {old['char_accuracy']} -> {result['char_accuracy']}")
+    return regressions
+
+def collect_metadata(workers):
+    try:
+        tesseract_version = str(pytesseract.get_tesseract_version())
+    except Exception:
+        tesseract_version = None
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workers": workers,
+        "pymupdf": fitz.VersionBind,
+        "tesseract": tesseract_version,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк производительности OCR на синтетических сканах")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="Файл JSON с результатами")
+    parser.add_argument("--lang", default="rus+eng")
+    parser.add_argument("--workers", type=int, help="Процессов для параллельного режима")
+    parser.add_argument("--quick", action="store_true", help="Сокращенный набор документов и режимов")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--preprocess", action="store_true",
+                        help="Дополнительно прогнать каждый режим с предобработкой OpenCV")
+    parser.add_argument("--native-image", action="store_true",
+                        help="Брать встроенный скан без рендера, как в обычной работе (уровни DPI тогда не различаются)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Допустимое падение скорости (доля)")
+    parser.add_argument("--accuracy-tolerance", type=float, default=0.02, help="Допустимое падение точности")
+    args = parser.parse_args(argv)
+
+    tesseract_path = setup_tesseract()
+    if not tesseract_path:
+        print("❌ Tesseract не найден", file=sys.stderr)
+        return 2
+    pytesseract.pytesseract.tesseract_cmd = tesseract_path
+
+    workers = get_worker_count(args.workers)
+    profiles = [p for p in DOCUMENT_PROFILES if not args.quick or p["name"] in QUICK_PROFILES]
+    configurations = QUICK_CONFIGURATIONS if args.quick else CONFIGURATIONS
+    preprocess_options = (False, True) if args.preprocess else (False,)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ocr_bench_") as temp_dir:
+        for index, profile in enumerate(profiles):
+            pdf_path = os.path.join(temp_dir, f"{profile['name']}.pdf")
+            ground_truth = build_document(profile, pdf_path, args.seed + index)
+
+            for dpi, use_fast_mode in configurations:
+                for use_parallel, preprocess in itertools.product((False, True), preprocess_options):
+                    metrics = run_case(pdf_path, ground_truth, dpi, use_fast_mode, use_parallel, workers, args.lang,
+                                       preprocess, args.native_image)
+                    result = {"document": profile["name"], "dpi": dpi, "fast": use_fast_mode,
+                              "parallel": use_parallel, "preprocess": preprocess,
+                              "native_image": args.native_image, **metrics}
+                    results.append(result)
+                    native_note = (f"  скан без рендера: {result['native_image_pages']}/{result['pages']} стр., DPI не влиял"
+                                   if result["native_image_pages"] else "")
+                    print(f"{config_key(result):56s} {result['pages_per_sec']:7.2f} стр/с  "
+                          f"p50 {result['latency_p50']:6.2f} с  p95 {result['latency_p95']:6.2f} с  "
+                          f"RSS {result['peak_rss_mb']:7.1f} МБ  точность {result['char_accuracy']:.3f}{native_note}")
+
+    reset_process_pool()
+    report = {"meta": collect_metadata(workers), "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты: {os.path.abspath(args.output)}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance, args.accuracy_tolerance)
+        if regressions:
+            print("\n❌ Регрессии:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("✅ Регрессий нет")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
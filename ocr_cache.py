@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# ==================== КЭШ РЕЗУЛЬТАТОВ OCR ====================
+# Постраничный кэш на диске: ключ - хэш документа, страница, DPI, язык и режим.
+# Общий для всех сессий и переживает перезапуск приложения.
+
+CACHE_DIR = os.environ.get("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdf_ocr_cache"))
+DEFAULT_CACHE_LIMIT_MB = int(os.environ.get("OCR_CACHE_MAX_MB", "256"))
+
+# Версия конвейера в ключе: увеличивается, когда меняется способ получения текста страницы
+CACHE_VERSION = 3
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_cache_limit_bytes = DEFAULT_CACHE_LIMIT_MB * 1024 * 1024
+
+def _cache_path():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, "pages.sqlite3")
+
+@contextmanager
+def _connect():
+    conn = sqlite3.connect(_cache_path(), timeout=30)
+    try:
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    details TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages(last_access)")
+            # Общий размер кэша ведут триггеры: запись не пересчитывает всю таблицу,
+            # а сумма верна и при нескольких процессах с одним файлом
+            conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)")
+            if conn.execute("SELECT 1 FROM totals").fetchone() is None:
+                conn.execute("INSERT OR IGNORE INTO totals VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM pages))")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS pages_insert AFTER INSERT ON pages
+                BEGIN UPDATE totals SET size = size + NEW.size; END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS pages_delete AFTER DELETE ON pages
+                BEGIN UPDATE totals SET size = size - OLD.size; END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS pages_update AFTER UPDATE OF size ON pages
+                BEGIN UPDATE totals SET size = size + NEW.size - OLD.size; END
+            """)
+            yield conn
+    finally:
+        conn.close()
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _options_parts(options):
+    # Настройки, от которых зависит текст страницы
+    if options.get("adaptive"):
+        mode = "adaptive"
+    else:
+        mode = "fast" if options["use_fast_mode"] else "accurate"
+    parts = [str(options["dpi"]), options["lang"], mode, "text" if options["use_text_layer"] else "ocr"]
+    if options.get("preprocess"):
+        parts.append("preprocess")
+    if not options.get("skip_blank", True):
+        parts.append("keep_blank")
+    if options.get("word_boxes"):
+        parts.append("word_boxes")
+    if options.get("rotation"):
+        parts.append(f"rotate{options['rotation']}")
+    if not options.get("native_image", True):
+        parts.append("render")
+    return parts
+
+def page_cache_key(doc_hash, page_num, options):
+    parts = [str(CACHE_VERSION), doc_hash, str(page_num)] + _options_parts(options)
+    return hashlib.sha256(":".join(parts).encode()).hexdigest()
+
+def document_key(doc_hash, options, page_numbers=()):
+    # Ключ документа с теми же настройками и набором страниц - для журнала заданий
+    parts = [str(CACHE_VERSION), doc_hash, "document"] + _options_parts(options)
+    parts += ["pages"] + [str(page_num) for page_num in page_numbers]
+    return hashlib.sha256(":".join(parts).encode()).hexdigest()
+
+def language_cache_key(doc_hash, sample_pages, lang):
+    # Результат определения языка и поворота по пробным страницам документа для набора языков lang
+    parts = [str(CACHE_VERSION), doc_hash, "language", lang] + [str(page_num) for page_num in sample_pages]
+    return hashlib.sha256(":".join(parts).encode()).hexdigest()
+
+def set_cache_limit(limit_mb):
+    global _cache_limit_bytes
+    _cache_limit_bytes = max(1, int(limit_mb)) * 1024 * 1024
+
+def cache_get(key):
+    try:
+        with _connect() as conn:
+            row = conn.execute("SELECT text, details FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE pages SET last_access = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error:
+        row = None
+
+    with _stats_lock:
+        _stats["hits" if row is not None else "misses"] += 1
+
+    if row is None:
+        return None
+    return row[0], json.loads(row[1])
+
+def cache_put(key, text, details):
+    payload = json.dumps(details, ensure_ascii=False)
+    size = len(text.encode()) + len(payload.encode())
+
+    try:
+        with _connect() as conn:
+            # Не INSERT OR REPLACE: замена строки удаляет ее без триггера и сбивает общий размер
+            conn.execute(
+                "INSERT INTO pages (key, text, details, size, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET text = excluded.text, details = excluded.details, "
+                "size = excluded.size, last_access = excluded.last_access",
+                (key, text, payload, size, time.time()))
+            _evict(conn)
+    except sqlite3.Error:
+        pass
+
+def _evict(conn):
+    # LRU: удаляем по одной самой давно не использованной странице (по индексу last_access),
+    # пока не уложимся в лимит; обычно это одна-две строки
+    evicted = 0
+    while conn.execute("SELECT size FROM totals").fetchone()[0] > _cache_limit_bytes:
+        deleted = conn.execute(
+            "DELETE FROM pages WHERE key = (SELECT key FROM pages ORDER BY last_access LIMIT 1)").rowcount
+        if not deleted:
+            break
+        evicted += 1
+
+    with _stats_lock:
+        _stats["evictions"] += evicted
+
+def cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+
+    try:
+        with _connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            size = conn.execute("SELECT size FROM totals").fetchone()[0]
+    except sqlite3.Error:
+        entries, size = 0, 0
+
+    stats["entries"] = entries
+    stats["size_mb"] = size / (1024 * 1024)
+    stats["limit_mb"] = _cache_limit_bytes / (1024 * 1024)
+    return stats
+
+def clear_cache():
+    try:
+        with _connect() as conn:
+            conn.execute("DELETE FROM pages")
+    except sqlite3.Error:
+        pass
@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import pyzipper
+
+from ocr_engine import (
+    ENGINE_AUTO,
+    ENGINE_API,
+    ENGINE_CLI,
+    MODE_DPI,
+    MODE_ADAPTIVE,
+    PAGE_TIMEOUT,
+    is_auto_language,
+    is_api_engine_available,
+    setup_tesseract,
+    resolve_auto_language,
+    make_ocr_options,
+    count_pages,
+    get_worker_count,
+    summarize_routes,
+    count_escalated,
+    blank_page_numbers,
+    format_result_block,
+    iter_documents_results,
+    job_peak_rss_mb,
+    ROUTE_NATIVE,
+    ROUTE_BLANK,
+)
+from ocr_cache import file_sha256, set_cache_limit
+from ocr_scheduler import set_slot_capacity
+from ocr_results import write_zip_archive
+from ocr_metrics import render_prometheus, summarize_stage_timings, reset_peak_rss
+from ocr_formats import FORMATS, write_format
+from ocr_estimate import record_job_timing
+
+# ==================== ПАКЕТНАЯ ОБРАБОТКА ИЗ КОМАНДНОЙ СТРОКИ ====================
+# Пример:
+#   python ocr_cli.py scans/ archive.zip doc.pdf -o out --per-page --workers 8
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Пакетное извлечение текста из PDF (файлы, папки, ZIP-архивы)")
+    parser.add_argument("inputs", nargs="+", help="PDF-файлы, папки или ZIP-архивы с PDF")
+    parser.add_argument("-o", "--output", default="ocr_output", help="Папка для результатов")
+    parser.add_argument("--mode", choices=sorted(MODE_DPI), default="fast",
+                        help="fast - 200 DPI, balanced - 250 DPI, accurate - 300 DPI и полная конфигурация, "
+                             "adaptive - быстрый проход и точный повтор неуверенных страниц и строк")
+    parser.add_argument("--dpi", type=int, help="Переопределить DPI режима")
+    parser.add_argument("--lang", default="rus+eng",
+                        help="Языки Tesseract, например rus+eng. auto или auto:fra+eng - определить поворот и "
+                             "сузить набор (по умолчанию rus+eng) до письменностей документа")
+    parser.add_argument("--workers", type=int, help="Число рабочих процессов (по умолчанию - число ядер)")
+    parser.add_argument("--engine", choices=[ENGINE_AUTO, ENGINE_API, ENGINE_CLI], default=ENGINE_AUTO)
+    parser.add_argument("--per-page", action="store_true", help="Дополнительно сохранить ZIP со страницами")
+    parser.add_argument("--no-text-layer", action="store_true", help="Распознавать все страницы через OCR")
+    parser.add_argument("--no-cache", action="store_true", help="Не использовать кэш результатов")
+    parser.add_argument("--cache-max-mb", type=int,
+                        help="Лимит кэша результатов, МБ (по умолчанию OCR_CACHE_MAX_MB или 256)")
+    parser.add_argument("--keep-blank", action="store_true",
+                        help="Распознавать и пустые страницы (по умолчанию они пропускаются)")
+    parser.add_argument("--preprocess", action="store_true",
+                        help="Предобработка сканов OpenCV: наклон, бинаризация, шум, поля")
+    parser.add_argument("--page-timeout", type=int, default=PAGE_TIMEOUT,
+                        help="Лимит времени на страницу, с (0 - без ограничения)")
+    parser.add_argument("--formats", nargs="+", choices=sorted(FORMATS), default=[],
+                        help="Дополнительные форматы с координатами слов: tsv, hocr, alto, pdf (PDF с текстовым слоем)")
+    parser.add_argument("--metrics-file", help="Записать метрики Prometheus (для textfile collector)")
+    parser.add_argument("--password", default=os.environ.get("OCR_ZIP_PASSWORD"),
+                        help="Пароль зашифрованных ZIP (или переменная OCR_ZIP_PASSWORD)")
+    return parser.parse_args(argv)
+
+def extract_zip_pdfs(zip_path, target_dir, password=None):
+    # pyzipper читает и обычные, и AES-зашифрованные архивы
+    extracted = []
+    with pyzipper.AESZipFile(zip_path) as archive:
+        if password:
+            archive.setpassword(password.encode())
+        for index, info in enumerate(archive.infolist()):
+            if info.is_dir() or not info.filename.lower().endswith(".pdf"):
+                continue
+            name = f"{index:04d}_{os.path.basename(info.filename)}"
+            path = os.path.join(target_dir, name)
+            with open(path, "wb") as f:
+                f.write(archive.read(info))
+            extracted.append((f"{os.path.basename(zip_path)}/{info.filename}", path))
+    return extracted
+
+def collect_documents(inputs, temp_dir, password=None):
+    # Возвращает пары (имя для отчета, путь к PDF)
+    documents = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if name.lower().endswith(".pdf"):
+                        documents.append((os.path.relpath(path, item), path))
+                    elif name.lower().endswith(".zip"):
+                        documents.extend(extract_zip_pdfs(path, temp_dir, password))
+        elif item.lower().endswith(".zip"):
+            documents.extend(extract_zip_pdfs(item, temp_dir, password))
+        elif os.path.isfile(item):
+            documents.append((os.path.basename(item), item))
+        else:
+            print(f"⚠️ Пропущено: {item} не найден", file=sys.stderr)
+    return documents
+
+def output_stem(name, used):
+    stem = os.path.splitext(name.replace("/", "_").replace(os.sep, "_"))[0]
+    candidate = stem
+    counter = 2
+    while candidate in used:
+        candidate = f"{stem}_{counter}"
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+def write_document(output_dir, stem, page_texts, page_details, per_page, pdf_path=None, formats=()):
+    # Слова с рамками забираются из деталей, чтобы не копиться в итоговой статистике пакета
+    pages = [(page_num, details, details.pop("word_boxes", []))
+             for page_num, details in enumerate(page_details)]
+    full_text = "".join(format_result_block(page_num, text, details)
+                        for page_num, (text, details) in enumerate(zip(page_texts, page_details)))
+    with open(os.path.join(output_dir, f"{stem}.txt"), "w", encoding="utf-8") as f:
+        f.write(full_text)
+
+    if per_page:
+        write_zip_archive(os.path.join(output_dir, f"{stem}_страницы.zip"),
+                          enumerate(page_texts), blank_page_numbers(page_details))
+
+    for fmt in formats:
+        write_format(fmt, os.path.join(output_dir, stem + FORMATS[fmt]["suffix"]), pdf_path, pages)
+
+def run_batch(args):
+    if not setup_tesseract() and not is_api_engine_available():
+        # Страницы с текстовым слоем и пустые обрабатываются и без него
+        print("⚠️ Tesseract не найден: страницы, которым нужен OCR, завершатся с ошибкой", file=sys.stderr)
+
+    dpi = args.dpi or MODE_DPI[args.mode]
+    options = make_ocr_options(dpi=dpi,
+                               lang=args.lang,
+                               use_fast_mode=args.mode != "accurate",
+                               use_text_layer=not args.no_text_layer,
+                               engine=args.engine,
+                               use_cache=not args.no_cache,
+                               adaptive=args.mode == MODE_ADAPTIVE,
+                               preprocess=args.preprocess,
+                               skip_blank=not args.keep_blank,
+                               page_timeout=args.page_timeout,
+                               word_boxes=bool(args.formats))
+    os.makedirs(args.output, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="ocr_cli_") as temp_dir:
+        documents = []
+        for name, path in collect_documents(args.inputs, temp_dir, args.password):
+            try:
+                documents.append((name, path, count_pages(path)))
+            except Exception as e:
+                print(f"❌ {name}: не удалось открыть PDF ({e})", file=sys.stderr)
+
+        if not documents:
+            print("❌ Нет PDF для обработки", file=sys.stderr)
+            return 1
+
+        total_pages = sum(pages for _, _, pages in documents)
+        # --workers задает число слотов планировщика, а с ним и размер пула
+        set_slot_capacity(args.workers)
+        if args.cache_max_mb:
+            set_cache_limit(args.cache_max_mb)
+        workers = get_worker_count(args.workers)
+        print(f"📄 Документов: {len(documents)}, страниц: {total_pages}, процессов: {workers}")
+
+        doc_options = None
+        if is_auto_language(options["lang"]):
+            # Язык и поворот - свои у каждого документа
+            doc_options = []
+            for name, path, pages in documents:
+                doc_hash = file_sha256(path) if options["use_cache"] else None
+                document_options, language = resolve_auto_language(path, options, range(pages), doc_hash)
+                doc_options.append(document_options)
+                cost = "из кэша" if language.get("cached") else f"{language['seconds']:.2f} с"
+                print(f"🌐 {name}: язык {language['lang']}, поворот {language['rotation']}° ({cost})")
+
+        used_stems = set()
+        stems = [output_stem(name, used_stems) for name, _, _ in documents]
+        page_texts = {}
+        page_details = {}
+        remaining = {doc_id: pages for doc_id, (_, _, pages) in enumerate(documents)}
+        all_details = []
+        errors = 0
+        completed = 0
+        # Пик памяти основного процесса считается с начала обработки
+        reset_peak_rss()
+        start_time = time.time()
+
+        for doc_id, (_, path, pages) in enumerate(documents):
+            if pages == 0:
+                write_document(args.output, stems[doc_id], [], [], args.per_page, path, args.formats)
+
+        for doc_id, page_num, text, details in iter_documents_results(
+                [path for _, path, _ in documents], options, args.workers, doc_options=doc_options):
+            page_count = documents[doc_id][2]
+            page_texts.setdefault(doc_id, [""] * page_count)[page_num] = text
+            page_details.setdefault(doc_id, [None] * page_count)[page_num] = details
+            all_details.append(details)
+            errors += bool(details.get("error"))
+            completed += 1
+            remaining[doc_id] -= 1
+
+            if remaining[doc_id] == 0:
+                # Документ готов: пишем результаты и освобождаем память
+                write_document(args.output, stems[doc_id], page_texts.pop(doc_id), page_details.pop(doc_id),
+                               args.per_page, documents[doc_id][1], args.formats)
+                elapsed = time.time() - start_time
+                print(f"✅ {documents[doc_id][0]}: {page_count} стр. "
+                      f"({completed}/{total_pages}, {completed / max(elapsed, 1e-6):.2f} стр/с)")
+
+        elapsed = time.time() - start_time
+        record_job_timing(options, all_details, elapsed, workers)
+        routes = summarize_routes(all_details)
+        cached = sum(1 for d in all_details if d.get("cached"))
+
+        print("\n==================== ИТОГО ====================")
+        print(f"Документов: {len(documents)}")
+        print(f"Страниц: {total_pages} (текстовый слой: {routes[ROUTE_NATIVE]}, пустых: {routes[ROUTE_BLANK]}, "
+              f"из кэша: {cached}, ошибок: {errors})")
+        if options["adaptive"]:
+            print(f"Повторено точным проходом: {count_escalated(all_details)} стр.")
+        stage_totals = summarize_stage_timings(all_details)
+        if stage_totals["preprocess"]:
+            print(f"Предобработка: {stage_totals['preprocess']:.1f} с (OCR: {stage_totals['ocr']:.1f} с)")
+        capped = sum(1 for d in all_details if d.get("dpi_capped"))
+        if capped:
+            print(f"Уменьшен DPI под бюджет памяти: {capped} стр.")
+        print(f"Время: {elapsed:.1f} с")
+        print(f"Пик памяти: {job_peak_rss_mb(all_details):.0f} МБ")
+        print(f"Производительность: {total_pages / max(elapsed, 1e-6):.2f} стр/с")
+        print(f"Результаты: {os.path.abspath(args.output)}")
+
+    if args.metrics_file:
+        with open(args.metrics_file, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+
+    return 1 if errors else 0
+
+def main(argv=None):
+    return run_batch(parse_args(argv))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1578 @@
+import os
+import re
+import math
+import time
+import signal
+import subprocess
+import threading
+import multiprocessing
+import weakref
+import itertools
+import concurrent.futures
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ocr_lazy import lazy_import, lazy_import_optional
+from ocr_cache import file_sha256, page_cache_key, language_cache_key, cache_get, cache_put
+from ocr_results import create_result_dir, write_details, spool_page_results
+from ocr_metrics import stage_timer, record_page_metrics, reset_peak_rss, read_peak_rss_mb
+from ocr_preprocess import is_preprocess_available, preprocess_pixmap, detect_blank_page, BLANK_CHECK_DPI
+from ocr_journal import open_journal, journal_files, read_journal, journal_writer, append_journal, finish_journal
+from ocr_estimate import record_job_timing
+from ocr_scheduler import (get_worker_count, get_slot_capacity, new_session_id,
+                           try_acquire_slot, acquire_slot, release_slot, withdraw_slot_request, end_session, ocr_slot,
+                           get_max_page_pixels, estimate_page_bytes)
+
+# Тяжелые модули загружаются при первом обращении (ocr_lazy)
+fitz = lazy_import("fitz")  # PyMuPDF
+pytesseract = lazy_import("pytesseract")
+Image = lazy_import("PIL.Image")
+
+# Tesseract однопоточный и в основном процессе: параллелизм дают слоты планировщика,
+# а число слотов считается по OMP_THREAD_LIMIT (до загрузки tesserocr)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+tesserocr = lazy_import_optional("tesserocr")
+
+# ==================== КОНФИГУРАЦИЯ TESSERACT И ОПТИМИЗАЦИЯ ====================
+TESSERACT_CONFIG_FAST = '--oem 1 --psm 3 -c tessedit_do_invert=0'
+TESSERACT_CONFIG_ACCURATE = '--oem 1 --psm 3'
+
+# Режимы качества: DPI рендера
+MODE_ADAPTIVE = "adaptive"
+MODE_DPI = {"fast": 200, "balanced": 250, "accurate": 300, MODE_ADAPTIVE: 200}
+
+# Адаптивный режим: быстрый проход везде, точный повтор только там, где Tesseract не уверен
+ADAPTIVE_MIN_CONFIDENCE = 70      # средняя уверенность слов строки/страницы, 0-100
+ADAPTIVE_ESCALATION_DPI = 300     # DPI повторного распознавания
+ADAPTIVE_MAX_REGIONS = 8          # больше неуверенных строк - повторяем страницу целиком
+ADAPTIVE_REGION_PADDING = 4       # поля вокруг строки при повторе, пт
+
+# Страница-скан из одного изображения распознается в его исходном разрешении,
+# если оно в полезном диапазоне; иначе страница растеризуется с DPI режима
+NATIVE_IMAGE_MIN_COVERAGE = 0.9   # доля страницы под изображением
+NATIVE_DPI_MIN = 150
+NATIVE_DPI_MAX = 400
+
+ESCALATED_PAGE = "page"
+ESCALATED_REGIONS = "regions"
+
+# Лимит времени на страницу, с (0 - без ограничения). После него OCR прерывается и страница
+# один раз повторяется с TIMEOUT_RETRY_DPI, а если не уложилась и так - помечается ошибкой
+PAGE_TIMEOUT = int(os.environ.get("OCR_PAGE_TIMEOUT", "120"))
+TIMEOUT_RETRY_DPI = 150
+
+# Страница считается зависшей, если распознается дольше двух лимитов (с повтором) и этого
+# запаса: прерывается ее tesseract, а если и после этого она не вернулась за тот же запас -
+# ее рабочий процесс. Страницы других сеансов повторяются на новом пуле без штрафа
+HUNG_WORKER_GRACE = 30
+MAX_PAGE_ATTEMPTS = 2
+MAX_POOL_RESTARTS = 5             # перезапусков пула на задание; дальше оставшиеся страницы - с ошибкой
+WAIT_POLL_INTERVAL = 0.5          # как часто проверяются отмена и зависание
+
+class PageTimeout(Exception):
+    pass
+
+class OCRCancelled(Exception):
+    pass
+
+# Движки распознавания
+ENGINE_AUTO = "auto"   # API в процессе, если tesserocr установлен, иначе CLI
+ENGINE_API = "api"     # постоянный экземпляр Tesseract API на поток/процесс
+ENGINE_CLI = "cli"     # pytesseract: отдельный процесс tesseract на страницу
+
+ENGINE_LABELS = {
+    ENGINE_AUTO: "Авто",
+    ENGINE_API: "Tesseract API",
+    ENGINE_CLI: "pytesseract (CLI)",
+}
+
+# Языки: "auto" или "auto:fra+eng" - сузить набор (по умолчанию LANG_DEFAULT)
+# по нескольким страницам документа
+LANG_AUTO = "auto"
+LANG_DEFAULT = "rus+eng"
+
+# Письменности режима "auto" и языки Tesseract, которые ими пишутся. Языки одной
+# письменности по буквам не различить, поэтому набор сужается только по письменностям
+AUTO_SCRIPTS = {
+    "Cyrillic": re.compile("[А-Яа-яЁё]"),
+    "Latin": re.compile("[A-Za-zÀ-ÖØ-öø-ÿ]"),
+}
+LANGUAGE_SCRIPTS = {"rus": "Cyrillic", "eng": "Latin", "fra": "Latin", "deu": "Latin", "spa": "Latin"}
+AUTO_SAMPLE_PAGES = 3             # сколько страниц пробуется при определении языка
+AUTO_DETECT_DPI = 150             # уменьшенный рендер для OSD и пробного распознавания
+AUTO_MIN_LETTERS = 40             # меньше букв в пробе - язык не определить, берется LANG_DEFAULT
+AUTO_MIN_SHARE = 0.03             # доля букв, начиная с которой язык остается в наборе
+ORIENTATION_MIN_CONFIDENCE = 5.0  # уверенность OSD, с которой поворот принимается
+
+# Маршруты обработки страницы
+ROUTE_NATIVE = "native"   # текстовый слой PDF, без OCR
+ROUTE_OCR = "ocr"         # растеризация + Tesseract
+ROUTE_BOTH = "both"       # текстовый слой + OCR с объединением
+ROUTE_BLANK = "blank"     # пустая страница или только печать, OCR пропущен
+
+ROUTE_LABELS = {
+    ROUTE_NATIVE: "текстовый слой",
+    ROUTE_OCR: "OCR",
+    ROUTE_BOTH: "текст + OCR",
+    ROUTE_BLANK: "пустая страница",
+}
+
+# Пороги классификатора страниц
+MIN_NATIVE_GLYPHS = 50          # меньше символов - слоя фактически нет
+MIN_TEXT_COVERAGE = 0.02        # доля площади страницы под словами текстового слоя
+MAX_IMAGE_RATIO_NATIVE = 0.5    # при большей доле картинок возможен скан поверх текста
+
+# Сколько документов держит открытыми один рабочий процесс
+MAX_OPEN_DOCUMENTS = 4
+
+# Сеанс, ждущий дополнительный слот планировщика, проверяет его чаще, чтобы слот не простаивал
+SLOT_POLL_INTERVAL = 0.05
+
+# Режим "сначала предпросмотр": столько первых страниц распознается сразу в основном
+# процессе, пока пул берется за остальные
+PREVIEW_FIRST_PAGES = 3
+
+# Оценка времени при загрузке: столько страниц документа классифицируется
+ESTIMATE_SAMPLE_PAGES = 12
+
+# ==================== ПОИСК И ПРОВЕРКА TESSERACT ====================
+# Путь, версия и установленные языки Tesseract проверяются один раз на процесс:
+# перезапуски скрипта Streamlit, задания сервиса и определение языка берут готовый ответ
+
+_tesseract_lock = threading.Lock()
+_tesseract_info = None
+
+def find_tesseract():
+    possible_paths = [
+        '/usr/bin/tesseract',
+        '/usr/local/bin/tesseract',
+        '/bin/tesseract',
+        '/nix/store/*/bin/tesseract',
+    ]
+
+    for path in possible_paths:
+        if os.path.exists(path):
+            return path
+
+    try:
+        result = subprocess.run(['which', 'tesseract'],
+                                capture_output=True,
+                                text=True)
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except:
+        pass
+
+    return None
+
+def probe_tesseract():
+    # {"path", "version", "languages"}; найденный путь сразу назначается pytesseract
+    global _tesseract_info
+
+    with _tesseract_lock:
+        if _tesseract_info is None:
+            info = {"path": find_tesseract(), "version": None, "languages": []}
+            if info["path"]:
+                pytesseract.pytesseract.tesseract_cmd = info["path"]
+                try:
+                    info["version"] = str(pytesseract.get_tesseract_version())
+                except Exception:
+                    pass
+                try:
+                    info["languages"] = sorted(pytesseract.get_languages(config=""))
+                except Exception:
+                    pass
+            _tesseract_info = info
+        return _tesseract_info
+
+def tesseract_probed():
+    # Проверка уже выполнена (не запускает ее): для /health, который не должен ждать
+    return _tesseract_info
+
+def setup_tesseract():
+    return probe_tesseract()["path"]
+
+def make_ocr_options(dpi=200, lang="rus+eng", use_fast_mode=True, use_text_layer=True, engine=ENGINE_AUTO, use_cache=True, adaptive=False, preprocess=False, skip_blank=True, page_timeout=PAGE_TIMEOUT, word_boxes=False, rotation=0, native_image=True):
+    return {
+        "dpi": dpi,
+        "lang": lang,
+        "use_fast_mode": use_fast_mode,
+        "use_text_layer": use_text_layer,
+        "engine": engine,
+        "use_cache": use_cache,
+        "adaptive": adaptive,
+        # Без OpenCV предобработка молча отключается
+        "preprocess": preprocess and is_preprocess_available(),
+        "skip_blank": skip_blank,
+        "page_timeout": page_timeout,
+        # Слова с рамками и уверенностью из того же прохода OCR - для TSV, hOCR, ALTO и PDF с текстом
+        "word_boxes": word_boxes,
+        # Поворот сканов по часовой стрелке (0/90/180/270), найденный при определении языка
+        "rotation": rotation,
+        # False - всегда рендерить страницу с заданным DPI, даже если встроенный скан можно взять как есть
+        "native_image": native_image,
+    }
+
+def is_api_engine_available():
+    return tesserocr is not None
+
+# ==================== КЛАССИФИКАЦИЯ СТРАНИЦ ====================
+
+def classify_page(page):
+    page_area = abs(page.rect) or 1.0
+
+    words = page.get_text("words")
+    glyph_count = sum(len(w[4].strip()) for w in words)
+    text_area = sum(abs(fitz.Rect(w[:4]) & page.rect) for w in words)
+    text_coverage = min(1.0, text_area / page_area)
+
+    image_area = 0.0
+    for info in page.get_image_info():
+        image_area += abs(fitz.Rect(info["bbox"]) & page.rect)
+    image_ratio = min(1.0, image_area / page_area)
+
+    if glyph_count < MIN_NATIVE_GLYPHS or text_coverage < MIN_TEXT_COVERAGE:
+        route = ROUTE_OCR
+    elif image_ratio > MAX_IMAGE_RATIO_NATIVE:
+        route = ROUTE_BOTH
+    else:
+        route = ROUTE_NATIVE
+
+    stats = {
+        "glyphs": glyph_count,
+        "text_coverage": round(text_coverage, 3),
+        "image_ratio": round(image_ratio, 3),
+    }
+    return route, stats
+
+def words_outside_layer(native_rects, ocr_words):
+    # Слова OCR, не попадающие на слова текстового слоя: на скане с невидимым текстом
+    # Tesseract распознает тот же текст с другими разбиениями строк, сравнение строк его не отсеет
+    return [word for word in ocr_words if not any(fitz.Rect(word[:4]).intersects(rect) for rect in native_rects)]
+
+def words_to_text(words):
+    # Слова [x0, y0, x1, y1, уверенность, блок, абзац, строка, текст] в текст как у lines_to_text
+    paragraphs = []
+    last_paragraph = last_line = None
+    for word in words:
+        paragraph, line = tuple(word[5:7]), tuple(word[5:8])
+        if paragraph != last_paragraph:
+            paragraphs.append([])
+            last_paragraph = paragraph
+        if line != last_line:
+            paragraphs[-1].append([])
+            last_line = line
+        paragraphs[-1][-1].append(word[8])
+    return "\n\n".join("\n".join(" ".join(line) for line in paragraph)
+                       for paragraph in paragraphs) + ("\n" if paragraphs else "")
+
+def merge_texts(native_text, native_rects, ocr_words):
+    # К текстовому слою добавляются только слова OCR вне рамок его слов (как в ocr_formats)
+    extra_text = words_to_text(words_outside_layer(native_rects, ocr_words))
+    if not extra_text:
+        return native_text
+    return native_text.rstrip() + "\n\n" + extra_text
+
+def format_page_block(page_num, text, route=None, error=None):
+    if error:
+        return f"\n{'='*50}\n📄 СТРАНИЦА {page_num + 1} - ОШИБКА\n{'='*50}\n\n{error}\n"
+    label = f" [{ROUTE_LABELS[route]}]" if route else ""
+    return f"\n{'='*50}\n📄 СТРАНИЦА {page_num + 1}{label}\n{'='*50}\n\n{text}\n"
+
+def summarize_routes(page_details):
+    counts = {ROUTE_NATIVE: 0, ROUTE_OCR: 0, ROUTE_BOTH: 0, ROUTE_BLANK: 0}
+    for details in page_details:
+        if details:
+            counts[details["route"]] = counts.get(details["route"], 0) + 1
+    return counts
+
+def count_escalated(page_details):
+    return sum(1 for details in page_details if details and details.get("escalated"))
+
+def blank_page_numbers(page_details):
+    return {details["page"] - 1 for details in page_details
+            if details and details["route"] == ROUTE_BLANK}
+
+def parse_page_range(spec, total_pages):
+    # "1-5,12,40-" -> номера страниц с нуля по возрастанию; пустая строка - весь документ.
+    # Страницы за концом документа отбрасываются
+    spec = (spec or "").replace(" ", "")
+    if not spec:
+        return list(range(total_pages))
+
+    pages = set()
+    for part in spec.split(","):
+        if not part:
+            continue
+        start, dash, end = part.partition("-")
+        try:
+            first = int(start) if start else 1
+            last = (int(end) if end else total_pages) if dash else first
+        except ValueError:
+            raise ValueError(f"Неверный диапазон страниц: {part}")
+        if first < 1 or (end and last < first):
+            raise ValueError(f"Неверный диапазон страниц: {part}")
+        pages.update(range(first - 1, min(last, total_pages)))
+
+    if not pages:
+        raise ValueError(f"В документе нет страниц из диапазона {spec} (всего страниц: {total_pages})")
+    return sorted(pages)
+
+def check_blank_page(page):
+    # Уменьшенный одноканальный рендер стоит доли процента от OCR страницы
+    pix = page.get_pixmap(dpi=BLANK_CHECK_DPI, colorspace=fitz.csGRAY)
+    return detect_blank_page(pix)
+
+# ==================== ЛИМИТ ВРЕМЕНИ СТРАНИЦЫ ====================
+
+# Срок текущей страницы: у каждого потока (рабочего процесса или сессии) свой
+_page_deadline = threading.local()
+
+def set_page_deadline(seconds):
+    _page_deadline.value = time.monotonic() + seconds if seconds else None
+    _page_deadline.seconds = seconds
+
+def page_time_left():
+    # Сколько секунд осталось у страницы (0 - без ограничения); если срок вышел - PageTimeout
+    deadline = getattr(_page_deadline, "value", None)
+    if deadline is None:
+        return 0
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise PageTimeout(f"Превышено время на страницу ({_page_deadline.seconds} с)")
+    return left
+
+# ==================== ДВИЖКИ РАСПОЗНАВАНИЯ ====================
+
+# Экземпляры API не потокобезопасны: у каждого потока (сессии Streamlit) свои
+_tess_local = threading.local()
+
+def get_tesseract_api(lang, use_fast_mode):
+    apis = getattr(_tess_local, "apis", None)
+    if apis is None:
+        apis = _tess_local.apis = {}
+
+    key = (lang, use_fast_mode)
+    if key not in apis:
+        # Те же параметры, что и в TESSERACT_CONFIG_FAST / TESSERACT_CONFIG_ACCURATE
+        kwargs = {"lang": lang, "psm": tesserocr.PSM.AUTO, "oem": tesserocr.OEM.LSTM_ONLY}
+        if os.environ.get("TESSDATA_PREFIX"):
+            kwargs["path"] = os.environ["TESSDATA_PREFIX"]
+        try:
+            api = tesserocr.PyTessBaseAPI(**kwargs)
+        except Exception:
+            # Запоминаем неудачу, чтобы не пытаться заново на каждой странице
+            apis[key] = None
+            raise
+        if use_fast_mode:
+            api.SetVariable("tessedit_do_invert", "0")
+        apis[key] = api
+
+    api = apis[key]
+    if api is None:
+        raise RuntimeError(f"Tesseract API не инициализирован для языка {lang}")
+    return api
+
+def pixmap_to_image(pix):
+    # PIL-изображение поверх памяти pixmap без копирования: pixmap должен жить, пока нужно изображение
+    mode = "L" if pix.n == 1 else "RGB"
+    return Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, pix.stride, 1)
+
+def recognize_with_api(pix, lang, use_fast_mode, timings, with_data=False, single_line=False):
+    # Сырые пиксели рендера идут в API без временных файлов и запуска процесса
+    # (SetImageBytes принимает только bytes, поэтому здесь одна копия буфера).
+    # with_data - вместо текста вернуть TSV со словами и их уверенностью
+    with stage_timer(timings, "ocr"):
+        timeout = page_time_left()
+        api = get_tesseract_api(lang, use_fast_mode)
+        if single_line:
+            api.SetPageSegMode(tesserocr.PSM.SINGLE_LINE)
+        try:
+            api.SetImageBytes(pix.samples, pix.width, pix.height, pix.n, pix.stride)
+            api.SetSourceResolution(pix.xres or 300)
+            # Recognize с лимитом прерывает распознавание внутри Tesseract
+            if timeout and not api.Recognize(int(timeout * 1000)):
+                raise PageTimeout(f"Превышено время на страницу ({_page_deadline.seconds} с)")
+            result = api.GetTSVText(0) if with_data else api.GetUTF8Text()
+        finally:
+            api.Clear()
+            if single_line:
+                api.SetPageSegMode(tesserocr.PSM.AUTO)
+    return result
+
+def recognize_with_cli(pix, lang, use_fast_mode, timings, with_data=False, single_line=False):
+    with stage_timer(timings, "convert"):
+        img = pixmap_to_image(pix)
+
+        # В быстром режиме рендер уже в оттенках серого; RGB бывает только у исходных изображений
+        if use_fast_mode and img.mode != "L":
+            img = img.convert('L')
+
+    config = TESSERACT_CONFIG_FAST if use_fast_mode else TESSERACT_CONFIG_ACCURATE
+    if single_line:
+        config = config.replace("--psm 3", "--psm 7")
+    with stage_timer(timings, "ocr"):
+        # pytesseract убивает процесс tesseract, не уложившийся в оставшееся время
+        timeout = page_time_left()
+        try:
+            if with_data:
+                return pytesseract.image_to_data(img, lang=lang, config=config, timeout=timeout)
+            return pytesseract.image_to_string(img, lang=lang, config=config, timeout=timeout)
+        except pytesseract.TesseractNotFoundError:
+            # Без Tesseract ошибкой завершаются только страницы, которым нужен OCR
+            raise RuntimeError("Tesseract не найден: страница требует OCR")
+        except RuntimeError as e:
+            if "timeout" not in str(e).lower():
+                raise
+            raise PageTimeout(f"Превышено время на страницу ({_page_deadline.seconds} с)")
+
+def resolve_engine(engine):
+    if engine == ENGINE_CLI or tesserocr is None:
+        return ENGINE_CLI
+    return ENGINE_API
+
+# ==================== ИЗОБРАЖЕНИЕ СТРАНИЦЫ ====================
+
+def extract_page_image(page):
+    # Изображение скана без повторной растеризации: одно изображение без поворота на всю страницу.
+    # Возвращает (pixmap, разрешение) или None, если страницу нужно рендерить
+    if page.rotation:
+        return None
+
+    infos = page.get_image_info(xrefs=True)
+    if len(infos) != 1 or not infos[0].get("xref"):
+        return None
+
+    info = infos[0]
+    a, b, c, d, _, _ = info["transform"]
+    if b or c or a <= 0 or d <= 0:
+        return None
+
+    bbox = fitz.Rect(info["bbox"])
+    page_area = abs(page.rect) or 1.0
+    if abs(bbox & page.rect) < NATIVE_IMAGE_MIN_COVERAGE * page_area or abs(bbox) > page_area / NATIVE_IMAGE_MIN_COVERAGE:
+        return None
+
+    image_dpi = min(info["width"] * 72 / bbox.width, info["height"] * 72 / bbox.height)
+    if not NATIVE_DPI_MIN <= image_dpi <= NATIVE_DPI_MAX:
+        return None
+    if info["width"] * info["height"] > get_max_page_pixels():
+        # Скан не помещается в бюджет памяти: страница рендерится с уменьшенным DPI
+        return None
+
+    try:
+        pix = fitz.Pixmap(page.parent, info["xref"])
+        # Tesseract ждет оттенки серого или RGB без альфа-канала
+        if pix.alpha:
+            pix = fitz.Pixmap(pix, 0)
+        if pix.colorspace is None or pix.colorspace.n not in (1, 3):
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+    except Exception:
+        return None
+
+    if (pix.width, pix.height) != (info["width"], info["height"]):
+        return None
+    pix.set_dpi(round(image_dpi), round(image_dpi))
+    return pix, bbox
+
+def cap_page_dpi(page, dpi):
+    # DPI, при котором рендер страницы помещается в бюджет памяти (чертежи A0, длинные чеки)
+    pixels = abs(page.rect) * (dpi / 72) ** 2
+    limit = get_max_page_pixels()
+    if pixels <= limit:
+        return dpi
+    return max(1, int(dpi * math.sqrt(limit / pixels)))
+
+def estimate_page_memory(pdf, page_num, dpi):
+    # Оценка памяти страницы до ее загрузки: рендер с этим DPI или встроенный скан, если он крупнее
+    try:
+        pixels = abs(pdf.page_cropbox(page_num)) * (dpi / 72) ** 2
+        for image in pdf.get_page_images(page_num):
+            pixels = max(pixels, image[2] * image[3])
+    except Exception:
+        return 0
+    return estimate_page_bytes(pixels)
+
+def ocr_memory_dpi(options):
+    # Самый крупный рендер страницы при этих настройках (в адаптивном режиме - повтор страницы)
+    return max(options["dpi"], ADAPTIVE_ESCALATION_DPI) if options.get("adaptive") else options["dpi"]
+
+def render_page_pixmap(page, dpi, gray=False, native_image=True):
+    # Возвращает изображение страницы, матрицу из его пикселей в координаты страницы и сведения об источнике.
+    # gray - сразу одноканальный рендер: втрое меньше памяти и без конвертации перед OCR
+    native = extract_page_image(page) if native_image else None
+    if native:
+        pix, bbox = native
+        if gray and pix.n != 1:
+            pix = fitz.Pixmap(fitz.csGRAY, pix)
+        to_page = fitz.Matrix(bbox.width / pix.width, 0, 0, bbox.height / pix.height, bbox.x0, bbox.y0)
+        return pix, to_page, {"source": "image", "image_dpi": pix.xres}
+
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if gray else fitz.csRGB)
+    return pix, fitz.Matrix(72 / dpi, 72 / dpi), {}
+
+def prepare_page_pixmap(page, dpi, gray, preprocess, timings, native_image=True):
+    with stage_timer(timings, "render"):
+        pix, to_page, report = render_page_pixmap(page, dpi, gray, native_image)
+    # Объем OCR для оценки времени следующих заданий
+    report["megapixels"] = round(pix.width * pix.height / 1e6, 3)
+    page_time_left()
+
+    if preprocess:
+        with stage_timer(timings, "preprocess"):
+            pix, to_source, preprocess_report = preprocess_pixmap(pix)
+        to_page = to_source * to_page
+        report.update(preprocess_report)
+
+    return pix, to_page, report
+
+def recognize_pixmap(pix, lang, use_fast_mode, engine, timings, with_data=False, single_line=False):
+    if resolve_engine(engine) == ENGINE_API:
+        try:
+            return recognize_with_api(pix, lang, use_fast_mode, timings, with_data, single_line), ENGINE_API
+        except PageTimeout:
+            raise
+        except Exception:
+            # Нет языковой модели для API или сбой биндинга - работаем через CLI
+            pass
+
+    return recognize_with_cli(pix, lang, use_fast_mode, timings, with_data, single_line), ENGINE_CLI
+
+def parse_tsv_lines(tsv):
+    # Слова TSV Tesseract, собранные в строки: текст, уверенность и рамка в пикселях рендера,
+    # а также сами слова строки с их рамками
+    lines = {}
+    for row in tsv.splitlines():
+        fields = row.split("\t")
+        if len(fields) < 12 or fields[0] != "5":
+            continue
+        word = fields[11].strip()
+        conf = float(fields[10])
+        if not word or conf < 0:
+            continue
+
+        left, top, width, height = (int(value) for value in fields[6:10])
+        key = tuple(int(value) for value in fields[1:5])  # страница, блок, абзац, строка
+        line = lines.get(key)
+        if line is None:
+            line = lines[key] = {"key": key, "words": [], "bbox": [left, top, left + width, top + height]}
+        line["words"].append({"text": word, "conf": conf, "bbox": (left, top, left + width, top + height)})
+        bbox = line["bbox"]
+        bbox[0], bbox[1] = min(bbox[0], left), min(bbox[1], top)
+        bbox[2], bbox[3] = max(bbox[2], left + width), max(bbox[3], top + height)
+
+    result = []
+    for line in lines.values():
+        words = line["words"]
+        result.append({"key": line["key"], "text": " ".join(word["text"] for word in words),
+                       "conf": sum(word["conf"] for word in words) / len(words),
+                       "size": len(words), "bbox": tuple(line["bbox"]), "words": words})
+    return result
+
+def lines_to_words(lines, to_page):
+    # Слова в координатах страницы PDF без учета поворота (как у page.get_text("words")):
+    # [x0, y0, x1, y1, уверенность, блок, абзац, строка, текст]
+    words = []
+    for line in lines:
+        _, block, paragraph, line_num = line["key"]
+        for word in line["words"]:
+            rect = fitz.Rect(word["bbox"]) * to_page
+            words.append([round(rect.x0, 2), round(rect.y0, 2), round(rect.x1, 2), round(rect.y1, 2),
+                          round(word["conf"], 1), block, paragraph, line_num, word["text"]])
+    return words
+
+def lines_confidence(lines):
+    # Средняя уверенность по словам страницы
+    words = sum(line["size"] for line in lines)
+    if not words:
+        return 0.0
+    return sum(line["conf"] * line["size"] for line in lines) / words
+
+def lines_to_text(lines):
+    # Строки одного абзаца - через перевод строки, абзацы - через пустую строку
+    paragraphs = []
+    last_paragraph = None
+    for line in lines:
+        paragraph = line["key"][:3]
+        if paragraph != last_paragraph:
+            paragraphs.append([])
+            last_paragraph = paragraph
+        paragraphs[-1].append(line["text"])
+    return "\n\n".join("\n".join(paragraph) for paragraph in paragraphs) + ("\n" if paragraphs else "")
+
+def recognize_page_adaptive(page, dpi, lang, engine=ENGINE_AUTO, timings=None, preprocess=False, with_words=False, native_image=True):
+    # Быстрый проход по всей странице; точный повтор с большим DPI только для неуверенных
+    # строк, а если их много или страница в целом плохая - для всей страницы.
+    # with_words - добавить в отчет слова с рамками (report["word_boxes"])
+    timings = {} if timings is None else timings
+    escalation_dpi = cap_page_dpi(page, max(dpi, ADAPTIVE_ESCALATION_DPI))
+
+    pix, to_page, report = prepare_page_pixmap(page, dpi, True, preprocess, timings, native_image)
+    tsv, used_engine = recognize_pixmap(pix, lang, True, engine, timings, with_data=True)
+    lines = parse_tsv_lines(tsv)
+    confidence = lines_confidence(lines)
+    report["confidence"] = round(confidence, 1)
+
+    weak_lines = [line for line in lines if line["conf"] < ADAPTIVE_MIN_CONFIDENCE]
+    if not weak_lines:
+        if with_words:
+            report["word_boxes"] = lines_to_words(lines, to_page * page.derotation_matrix)
+        return lines_to_text(lines), used_engine, report
+
+    with stage_timer(timings, "escalate"):
+        if confidence < ADAPTIVE_MIN_CONFIDENCE or len(weak_lines) > ADAPTIVE_MAX_REGIONS:
+            pix = page.get_pixmap(dpi=escalation_dpi)
+            tsv, used_engine = recognize_pixmap(pix, lang, False, engine, {}, with_data=True)
+            accurate_lines = parse_tsv_lines(tsv)
+            if lines_confidence(accurate_lines) >= confidence:
+                lines = accurate_lines
+                to_page = fitz.Matrix(72 / escalation_dpi, 72 / escalation_dpi)
+            report["escalated"] = ESCALATED_PAGE
+        else:
+            for line in weak_lines:
+                clip = fitz.Rect(line["bbox"]) * to_page
+                clip = (clip + (-ADAPTIVE_REGION_PADDING, -ADAPTIVE_REGION_PADDING,
+                                ADAPTIVE_REGION_PADDING, ADAPTIVE_REGION_PADDING)) & page.rect
+                if clip.is_empty:
+                    continue
+                pix = page.get_pixmap(dpi=escalation_dpi, clip=clip)
+                tsv, _ = recognize_pixmap(pix, lang, False, engine, {}, with_data=True, single_line=True)
+                region_lines = parse_tsv_lines(tsv)
+                region_confidence = lines_confidence(region_lines)
+                if region_lines and region_confidence > line["conf"]:
+                    line["text"] = " ".join(region["text"] for region in region_lines)
+                    line["conf"] = region_confidence
+                    line["size"] = sum(region["size"] for region in region_lines)
+                    # Рамки слов повтора - в пиксели основного рендера
+                    to_render = fitz.Matrix(72 / escalation_dpi, 0, 0, 72 / escalation_dpi, clip.x0, clip.y0) * ~to_page
+                    line["words"] = [dict(word, bbox=tuple(fitz.Rect(word["bbox"]) * to_render))
+                                     for region in region_lines for word in region["words"]]
+            report["escalated"] = ESCALATED_REGIONS
+            report["escalated_regions"] = len(weak_lines)
+
+    report["confidence_final"] = round(lines_confidence(lines), 1)
+    if with_words:
+        report["word_boxes"] = lines_to_words(lines, to_page * page.derotation_matrix)
+    return lines_to_text(lines), used_engine, report
+
+# ==================== ЯЗЫК И ПОВОРОТ ====================
+# Режим lang="auto": несколько страниц рендерятся в уменьшенном виде, Tesseract OSD
+# определяет поворот, а пробное распознавание - какими буквами написан документ.
+# Из заданного набора убираются только языки письменностей, которых в пробе нет.
+
+def is_auto_language(lang):
+    return lang == LANG_AUTO or lang.startswith(LANG_AUTO + ":")
+
+def auto_candidates(lang):
+    return (lang.partition(":")[2] or LANG_DEFAULT).split("+")
+
+def get_available_languages():
+    languages = probe_tesseract()["languages"]
+    return set(languages) if languages else set(LANGUAGE_SCRIPTS)
+
+def detect_page_orientation(pix):
+    # Поворот по часовой стрелке, после которого текст стоит прямо, уверенность и письменность
+    try:
+        osd = pytesseract.image_to_osd(pixmap_to_image(pix), output_type=pytesseract.Output.DICT,
+                                       timeout=page_time_left())
+    except Exception:
+        # Нет osd.traineddata или на странице слишком мало текста
+        return None
+    return {"rotation": int(osd["orientation"]) % 360, "confidence": float(osd["orientation_conf"]),
+            "script": osd["script"]}
+
+def count_script_letters(text):
+    return {script: len(pattern.findall(text)) for script, pattern in AUTO_SCRIPTS.items()}
+
+def choose_languages(letters, candidates, available):
+    # Языки набора по убыванию числа букв их письменности; редкие вкрапления другой
+    # письменности не добавляют модель. Языки неизвестной письменности остаются всегда
+    fallback = "+".join(candidates)
+    total = sum(letters.values())
+    if total < AUTO_MIN_LETTERS:
+        return fallback
+    scripts = [script for script, count in sorted(letters.items(), key=lambda item: -item[1])
+               if count >= AUTO_MIN_SHARE * total]
+    chosen = [lang for script in scripts for lang in candidates
+              if LANGUAGE_SCRIPTS.get(lang) == script and lang in available]
+    chosen += [lang for lang in candidates if lang not in LANGUAGE_SCRIPTS]
+    return "+".join(chosen) or fallback
+
+def sample_page_numbers(page_numbers, count=AUTO_SAMPLE_PAGES):
+    # Страницы для пробы равномерно по выбранному диапазону
+    page_numbers = list(page_numbers)
+    if len(page_numbers) <= count:
+        return page_numbers
+    return sorted({page_numbers[i * len(page_numbers) // count] for i in range(count)})
+
+def detect_document_language(pdf_path, page_numbers, engine=ENGINE_AUTO, page_timeout=None, lang=LANG_AUTO):
+    start_time = time.perf_counter()
+    available = get_available_languages()
+    candidates = auto_candidates(lang)
+    sample_lang = "+".join(code for code in candidates if code in available) or LANG_DEFAULT
+    sampled = sample_page_numbers(page_numbers)
+    letters = dict.fromkeys(AUTO_SCRIPTS, 0)
+    rotations = Counter()
+    scripts = Counter()
+
+    with fitz.open(pdf_path) as pdf:
+        for page_num in sampled:
+            page = pdf.load_page(page_num)
+            route, _ = classify_page(page)
+            if route == ROUTE_NATIVE:
+                # Текстовый слой читается бесплатно, OCR не нужен
+                text = page.get_text("text")
+            elif check_blank_page(page)[0]:
+                continue
+            else:
+                set_page_deadline(page_timeout)
+                dpi = cap_page_dpi(page, AUTO_DETECT_DPI)
+                try:
+                    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+                    orientation = detect_page_orientation(pix)
+                    if orientation:
+                        scripts[orientation["script"]] += 1
+                        if orientation["confidence"] >= ORIENTATION_MIN_CONFIDENCE:
+                            rotations[orientation["rotation"]] += 1
+                            if orientation["rotation"]:
+                                page.set_rotation((page.rotation + orientation["rotation"]) % 360)
+                                pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+                    text, _ = recognize_pixmap(pix, sample_lang, True, engine, {})
+                except Exception:
+                    # Страница без пробы не мешает определить язык по остальным
+                    continue
+                finally:
+                    set_page_deadline(None)
+
+            for script, count in count_script_letters(text).items():
+                letters[script] += count
+
+    # Поворот применяется ко всему документу, если за него большинство уверенных проб
+    rotation = 0
+    if rotations:
+        best, votes = rotations.most_common(1)[0]
+        if votes * 2 > sum(rotations.values()):
+            rotation = best
+
+    return {
+        "lang": choose_languages(letters, candidates, available),
+        "rotation": rotation,
+        "script": scripts.most_common(1)[0][0] if scripts else None,
+        "letters": letters,
+        "pages": [page_num + 1 for page_num in sampled],
+        "seconds": round(time.perf_counter() - start_time, 3),
+    }
+
+def resolve_auto_language(pdf_path, options, page_numbers, doc_hash=None, session=None, cancel_event=None, on_queue=None):
+    # Для lang="auto[:набор]" возвращает настройки с выбранными языком и поворотом и отчет определения.
+    # Результат запоминается в кэше: повторная загрузка документа не платит за пробу.
+    # Проба занимает слот планировщика сеанса session, как и распознавание страниц
+    if not is_auto_language(options["lang"]):
+        return options, None
+
+    key = (language_cache_key(doc_hash, sample_page_numbers(page_numbers), options["lang"])
+           if options["use_cache"] and doc_hash else None)
+    cached = cache_get(key) if key else None
+    if cached:
+        detection = dict(cached[1], cached=True)
+    else:
+        with fitz.open(pdf_path) as pdf:
+            nbytes = max((estimate_page_memory(pdf, page_num, AUTO_DETECT_DPI)
+                          for page_num in sample_page_numbers(page_numbers)), default=0)
+        with ocr_slot(session, cancel_event, on_queue, nbytes) as acquired:
+            if not acquired:
+                raise OCRCancelled("Обработка остановлена")
+            detection = detect_document_language(pdf_path, page_numbers, options["engine"], options.get("page_timeout"),
+                                                 options["lang"])
+        if key:
+            cache_put(key, "", detection)
+
+    return dict(options, lang=detection["lang"], rotation=detection["rotation"]), detection
+
+# ==================== ОБРАБОТКА СТРАНИЦЫ ====================
+
+def recognize_page_image(page, dpi, lang, use_fast_mode, engine=ENGINE_AUTO, timings=None, preprocess=False, with_words=False, native_image=True):
+    # with_words - один проход с TSV: текст собирается из тех же слов, что уходят в report["word_boxes"]
+    timings = {} if timings is None else timings
+
+    pix, to_page, report = prepare_page_pixmap(page, dpi, use_fast_mode, preprocess, timings, native_image)
+    if not with_words:
+        text, used_engine = recognize_pixmap(pix, lang, use_fast_mode, engine, timings)
+        return text, used_engine, report
+
+    tsv, used_engine = recognize_pixmap(pix, lang, use_fast_mode, engine, timings, with_data=True)
+    lines = parse_tsv_lines(tsv)
+    report["word_boxes"] = lines_to_words(lines, to_page * page.derotation_matrix)
+    return lines_to_text(lines), used_engine, report
+
+def process_page(page, page_num, options, timings=None):
+    start_time = time.perf_counter()
+    timings = {} if timings is None else timings
+    route = ROUTE_OCR
+    stats = {}
+
+    def page_details(**extra):
+        return {"page": page_num + 1, "route": route,
+                "seconds": round(time.perf_counter() - start_time + timings.get("load", 0.0), 4),
+                "timings": timings, "worker": os.getpid(), **stats, **extra}
+
+    try:
+        native_rects = []
+        if options["use_text_layer"]:
+            with stage_timer(timings, "classify"):
+                route, stats = classify_page(page)
+                native_text = page.get_text("text") if route != ROUTE_OCR else ""
+                if route == ROUTE_BOTH:
+                    native_rects = [fitz.Rect(word[:4]) for word in page.get_text("words")]
+        else:
+            native_text = ""
+
+        if route == ROUTE_OCR and options.get("skip_blank"):
+            with stage_timer(timings, "blank"):
+                blank, report = check_blank_page(page)
+            stats.update(report)
+            if blank:
+                route = ROUTE_BLANK
+                stats["blank"] = blank
+
+        ocr_text = ""
+        if route in (ROUTE_OCR, ROUTE_BOTH):
+            rotation = options.get("rotation", 0)
+            source_rotation = page.rotation
+            if rotation:
+                # Скан рендерится уже повернутым; рамки слов остаются в координатах исходной страницы
+                page.set_rotation((source_rotation + rotation) % 360)
+            # Крупный формат рендерится с меньшим DPI, чтобы страница поместилась в бюджет памяти
+            dpi = cap_page_dpi(page, options["dpi"])
+            if dpi < options["dpi"]:
+                stats["dpi_capped"] = dpi
+            # Смешанной странице рамки слов нужны всегда: по ним OCR сверяется с текстовым слоем
+            with_words = options.get("word_boxes") or route == ROUTE_BOTH
+            native_image = options.get("native_image", True)
+            set_page_deadline(options.get("page_timeout"))
+            try:
+                if options.get("adaptive"):
+                    ocr_text, used_engine, report = recognize_page_adaptive(
+                        page, dpi, options["lang"], options["engine"], timings, options.get("preprocess"),
+                        with_words, native_image)
+                else:
+                    ocr_text, used_engine, report = recognize_page_image(
+                        page, dpi, options["lang"], options["use_fast_mode"], options["engine"], timings,
+                        options.get("preprocess"), with_words, native_image)
+            except PageTimeout:
+                if dpi <= TIMEOUT_RETRY_DPI:
+                    raise
+                # Один повтор с меньшим DPI и быстрой конфигурацией, с новым лимитом
+                set_page_deadline(options.get("page_timeout"))
+                ocr_text, used_engine, report = recognize_page_image(
+                    page, TIMEOUT_RETRY_DPI, options["lang"], True, options["engine"], timings,
+                    with_words=with_words, native_image=native_image)
+                report["timeout_retry_dpi"] = TIMEOUT_RETRY_DPI
+            finally:
+                set_page_deadline(None)
+                if rotation:
+                    page.set_rotation(source_rotation)
+            if rotation:
+                report["rotation"] = rotation
+            stats.update(report, engine=used_engine)
+
+        if route == ROUTE_NATIVE:
+            text = native_text
+        elif route == ROUTE_BLANK:
+            text = ""
+        elif route == ROUTE_BOTH:
+            with stage_timer(timings, "merge"):
+                text = merge_texts(native_text, native_rects, stats.get("word_boxes", []))
+            if not options.get("word_boxes"):
+                stats.pop("word_boxes", None)
+        else:
+            text = ocr_text
+
+        return page_num, text, page_details()
+
+    except PageTimeout as e:
+        return page_num, "", page_details(error=str(e), timed_out=True)
+    except Exception as e:
+        return page_num, "", page_details(error=str(e))
+
+# ==================== РАБОЧИЕ ПРОЦЕССЫ ====================
+
+_worker_documents = {}
+_started_pages = None   # очередь пула: (номер задачи, pid) в момент, когда процесс взял страницу
+
+def _init_worker(tesseract_cmd, started_pages=None):
+    global _started_pages
+    # Tesseract внутри процесса однопоточный: параллелизм дают сами процессы
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    # Своя группа процессов: при остановке процесса вместе с ним завершается и его tesseract
+    if hasattr(os, "setpgid"):
+        os.setpgid(0, 0)
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    _started_pages = started_pages
+
+def _open_worker_document(pdf_path):
+    # Каждый процесс открывает документ сам; ключ учитывает mtime на случай повторного имени
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_mtime_ns, stat.st_size)
+
+    doc = _worker_documents.get(key)
+    if doc is None:
+        while len(_worker_documents) >= MAX_OPEN_DOCUMENTS:
+            oldest = next(iter(_worker_documents))
+            _worker_documents.pop(oldest).close()
+        doc = fitz.open(pdf_path)
+        _worker_documents[key] = doc
+    return doc
+
+def process_single_page(args):
+    pdf_path, page_num, options, submitted_at, task_id = args
+    if _started_pages is not None:
+        # Основной процесс узнает, какой процесс распознает страницу: зависшую останавливают одну
+        _started_pages.put((task_id, os.getpid()))
+    # Время ожидания в очереди пула: от отправки задачи до начала работы процесса
+    queue_wait = round(max(0.0, time.time() - submitted_at), 4)
+    timings = {}
+    # Пик памяти процесса считается заново на каждую страницу
+    reset_peak_rss()
+
+    try:
+        with stage_timer(timings, "load"):
+            page = _open_worker_document(pdf_path).load_page(page_num)
+    except Exception as e:
+        return page_num, "", {"page": page_num + 1, "route": ROUTE_OCR, "error": str(e),
+                              "worker": os.getpid(), "queue_wait": queue_wait, "timings": timings}
+
+    page_num, text, details = process_page(page, page_num, options, timings)
+    details["queue_wait"] = queue_wait
+    details["peak_rss_mb"] = read_peak_rss_mb()
+    return page_num, text, details
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_workers = 0
+# Состояние каждого пула: какие страницы в каком процессе начаты и какой сеанс его остановил
+_pool_states = weakref.WeakKeyDictionary()
+_task_ids = itertools.count()
+
+def get_process_pool(workers):
+    # Общий пул на весь процесс: переживает перезапуски скрипта Streamlit
+    global _pool, _pool_workers
+
+    with _pool_lock:
+        if _pool is not None and (_pool_workers != workers or _pool._broken):
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+        if _pool is None:
+            context = multiprocessing.get_context("spawn")
+            started_pages = context.SimpleQueue()
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(pytesseract.pytesseract.tesseract_cmd, started_pages))
+            _pool_workers = workers
+            _pool_states[_pool] = {"started": started_pages, "pages": {}, "forgotten": set(),
+                                   "lock": threading.Lock(), "killed_by": None, "culprits": set()}
+
+        return _pool
+
+def warm_process_pool(workers):
+    # Запускает все рабочие процессы заранее, чтобы старт пула не попадал в замеры
+    executor = get_process_pool(workers)
+    for future in [executor.submit(time.sleep, 0.05) for _ in range(workers)]:
+        future.result()
+
+def get_worker_pids():
+    with _pool_lock:
+        if _pool is None:
+            return []
+        return [process.pid for process in (_pool._processes or {}).values()]
+
+def job_peak_rss_mb(page_details):
+    # Пик памяти задания, МБ: пик основного процесса с reset_peak_rss() в начале задания и наибольший
+    # пик рабочего процесса на одной странице (его VmHWM сбрасывается перед каждой страницей)
+    worker_peak = max((details["peak_rss_mb"] for details in page_details if details and "peak_rss_mb" in details),
+                      default=0.0)
+    return read_peak_rss_mb() + worker_peak
+
+def reset_process_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def new_task_id():
+    return next(_task_ids)
+
+def get_pool_state(executor):
+    return _pool_states.get(executor) or {"killed_by": None, "culprits": set()}
+
+def get_page_worker(executor, task_id):
+    # (pid, момент начала) процесса, который распознает задачу; None - страница еще в очереди пула
+    state = _pool_states.get(executor)
+    if state is None:
+        return None
+    with state["lock"]:
+        started = state["started"]
+        while not started.empty():
+            started_id, pid = started.get()
+            if started_id in state["forgotten"]:
+                state["forgotten"].discard(started_id)
+            else:
+                state["pages"][started_id] = (pid, time.monotonic())
+        return state["pages"].get(task_id)
+
+def forget_page(executor, task_id):
+    state = _pool_states.get(executor)
+    if state is None:
+        return
+    with state["lock"]:
+        if state["pages"].pop(task_id, None) is None:
+            # Процесс мог взять страницу, но еще не сообщить об этом
+            state["forgotten"].add(task_id)
+
+def retire_process_pool(executor):
+    # Пул сломался или уже остановлен: следующие страницы идут в новый
+    global _pool
+
+    with _pool_lock:
+        if _pool is executor:
+            _pool = None
+    executor.shutdown(wait=False)
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def _child_pids(pid):
+    # Все потомки процесса (tesseract может быть запущен через обертку)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(value) for value in f.read().split()]
+    except (OSError, ValueError):
+        return []
+    return children + [grandchild for child in children for grandchild in _child_pids(child)]
+
+def stop_page_ocr(executor, task_id):
+    # Прерывает tesseract страницы, не трогая сам рабочий процесс: страница завершится ошибкой,
+    # пул и страницы других сеансов продолжают работу. False - прерывать нечего (страница
+    # в очереди, движок API внутри процесса или нет /proc)
+    worker = get_page_worker(executor, task_id)
+    children = _child_pids(worker[0]) if worker else []
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    return bool(children)
+
+def kill_page_worker(executor, task_id, session):
+    # Останавливает процесс зависшей страницы. ProcessPoolExecutor после этого считается сломанным
+    # и завершает все свои задачи с BrokenProcessPool; отметка причины позволяет другим сеансам
+    # повторить свои страницы на новом пуле, не засчитывая ни попытку, ни перезапуск
+    global _pool
+
+    worker = get_page_worker(executor, task_id)
+    state = _pool_states.get(executor)
+    with _pool_lock:
+        if _pool is executor:
+            _pool = None
+        if state is not None and state["killed_by"] in (None, session):
+            state["killed_by"] = session
+            state["culprits"].add(task_id)
+
+    if worker:
+        _kill_group(worker[0])
+    # Остальные процессы сломанного пула останавливаем вместе с их tesseract
+    for process in list((executor._processes or {}).values()):
+        _kill_group(process.pid)
+    executor.shutdown(wait=False)
+
+# ==================== ПРОГРЕВ ====================
+# Необязательный (OCR_WARMUP): после старта в фоне загружаются PyMuPDF и pytesseract,
+# проверяется Tesseract, запускается пул, а модели языка читаются с диска в основном процессе
+# и в каждом рабочем процессе (экземпляр API рабочего процесса остается загруженным).
+# Значение OCR_WARMUP - языки для прогрева; "1" - языки по умолчанию
+
+WARMUP_IMAGE_SIZE = 64
+
+def get_warm_up_lang():
+    value = os.environ.get("OCR_WARMUP", "").strip()
+    if value.lower() in ("", "0", "no", "false"):
+        return None
+    return LANG_DEFAULT if value.lower() in ("1", "yes", "true") else value
+
+def _warm_up_models(lang, engine):
+    # Пустое изображение через выбранный движок: Tesseract загружает модели языка
+    pix = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE), False)
+    pix.clear_with(255)
+    pix.set_dpi(300, 300)
+    set_page_deadline(0)
+    try:
+        recognize_pixmap(pix, lang, True, engine, {})
+    except Exception:
+        pass
+    return os.getpid()
+
+def warm_up_ocr(lang=LANG_DEFAULT, engine=ENGINE_AUTO, workers=None):
+    # Возвращает сведения о прогреве или None, если Tesseract не найден
+    start_time = time.perf_counter()
+    if not probe_tesseract()["path"]:
+        return None
+
+    # В основном процессе страницы распознают потоки get_page_threads: модели грузятся там
+    get_page_threads().submit(_warm_up_models, lang, engine).result()
+    workers = workers or get_slot_capacity()
+    executor = get_process_pool(workers)
+    pids = {future.result() for future in [executor.submit(_warm_up_models, lang, engine) for _ in range(workers)]}
+    return {"lang": lang, "workers": len(pids), "seconds": round(time.perf_counter() - start_time, 2)}
+
+# ==================== ИЗВЛЕЧЕНИЕ ТЕКСТА ====================
+
+def count_pages(pdf_path):
+    with fitz.open(pdf_path) as pdf:
+        return len(pdf)
+
+def analyze_pages(pdf):
+    # Для оценки времени: площадь каждой страницы (пт²) и по выборке - доля страниц без
+    # текстового слоя и доля пустых среди всех (пропущенные пустые страницы почти ничего не стоят)
+    areas = [abs(pdf.page_cropbox(page_num)) for page_num in range(len(pdf))]
+    sampled = sample_page_numbers(range(len(pdf)), ESTIMATE_SAMPLE_PAGES)
+    ocr_pages = blank_pages = 0
+    for page_num in sampled:
+        page = pdf.load_page(page_num)
+        route, _ = classify_page(page)
+        if route != ROUTE_NATIVE:
+            ocr_pages += 1
+            if route == ROUTE_OCR and check_blank_page(page)[0]:
+                blank_pages += 1
+    count = max(len(sampled), 1)
+    return {"page_areas": areas, "ocr_share": ocr_pages / count if sampled else 1.0, "blank_share": blank_pages / count}
+
+def read_document_info(data):
+    # Число страниц, метаданные и разбор для оценки времени прямо из байтов загрузки, без записи на диск
+    with fitz.open(stream=data, filetype="pdf") as pdf:
+        return {"pages": len(pdf), "metadata": dict(pdf.metadata or {}), **analyze_pages(pdf)}
+
+def _lookup_cached_page(doc_hash, page_num, options):
+    if not doc_hash:
+        return None, None
+
+    key = page_cache_key(doc_hash, page_num, options)
+    cached = cache_get(key)
+    if cached is None:
+        return key, None
+
+    text, details = cached
+    details["cached"] = True
+    return key, (text, details)
+
+def _store_cached_page(key, text, details):
+    if key and not details.get("error"):
+        cache_put(key, text, details)
+
+def _iter_parallel(tasks, options, max_workers=None, window=None, foreground=None, cancel_event=None, doc_options=None, session=None, on_queue=None, foreground_bytes=0):
+    # tasks: (doc_id, pdf_path, page_num, cache_key); страницы разных документов идут в один пул,
+    # doc_options - настройки по индексу документа вместо общих options.
+    # foreground - результаты (страница, текст, детали), которые считаются в основном процессе
+    # уже после отправки окна в пул и отдаются первыми (foreground_bytes - их оценка памяти).
+    # Каждая страница в работе занимает слот планировщика сеанса session и оценку своей памяти;
+    # пока свободных слотов нет, on_queue получает позицию в очереди
+    session = session or new_session_id()
+    # Не больше window страниц сеанса в работе: память не растет с размером документа
+    window = window or get_worker_count(max_workers)
+    page_timeout = options.get("page_timeout")
+    hang_limit = 2 * page_timeout + HUNG_WORKER_GRACE if page_timeout else None
+
+    queue = deque(tasks)
+    retries = []
+    in_flight = {}
+    estimate_docs = {}
+
+    def next_bytes():
+        # Оценка памяти следующей страницы; открыт только документ текущей страницы
+        doc_id, pdf_path, page_num, _ = retries[0][0] if retries else queue[0]
+        if pdf_path not in estimate_docs:
+            for doc in estimate_docs.values():
+                doc.close()
+            estimate_docs.clear()
+            estimate_docs[pdf_path] = fitz.open(pdf_path)
+        page_options = doc_options[doc_id] if doc_options else options
+        return estimate_page_memory(estimate_docs[pdf_path], page_num, ocr_memory_dpi(page_options))
+
+    def submit(task, attempt, nbytes):
+        doc_id, pdf_path, page_num, _ = task
+        page_options = doc_options[doc_id] if doc_options else options
+        task_id = new_task_id()
+        executor = get_process_pool(get_slot_capacity())
+        try:
+            future = executor.submit(process_single_page, (pdf_path, page_num, page_options, time.time(), task_id))
+        except (BrokenProcessPool, RuntimeError):
+            # Пул только что сломался или его остановил другой сеанс: берем новый
+            retire_process_pool(executor)
+            executor = get_process_pool(get_slot_capacity())
+            future = executor.submit(process_single_page, (pdf_path, page_num, page_options, time.time(), task_id))
+        in_flight[future] = (task, attempt, executor, time.monotonic(), nbytes, task_id)
+
+    def submit_next(nbytes):
+        # Вызывается под уже полученный слот
+        if retries:
+            submit(*retries.pop(0), nbytes)
+        else:
+            submit(queue.popleft(), 1, nbytes)
+
+    def fill():
+        # Отправляет страницы, пока планировщик дает слоты и память; True - сеанс ждет еще слот
+        while len(in_flight) < window and (retries or queue):
+            nbytes = next_bytes()
+            if not try_acquire_slot(session, nbytes):
+                return True
+            submit_next(nbytes)
+        withdraw_slot_request(session)
+        return False
+
+    def wait_for_slot(nbytes):
+        if not acquire_slot(session, cancel_event, on_queue, nbytes):
+            check_cancelled()
+
+    stopping = {}
+
+    def stop_hung_pages():
+        # Страница распознается дольше hang_limit: сначала прерывается ее tesseract, а если она
+        # не вернулась и через HUNG_WORKER_GRACE (или прерывать нечего) - останавливается ее процесс
+        now = time.monotonic()
+        for future, (_, _, executor, _, _, task_id) in list(in_flight.items()):
+            worker = get_page_worker(executor, task_id)
+            if future.done() or worker is None or now - worker[1] <= hang_limit:
+                continue
+            if future not in stopping and stop_page_ocr(executor, task_id):
+                stopping[future] = now
+            elif now - stopping.get(future, now - HUNG_WORKER_GRACE - 1) > HUNG_WORKER_GRACE:
+                kill_page_worker(executor, task_id, session)
+                stopping[future] = math.inf
+
+    restarts = 0
+    lost_pools = set()
+
+    def requeue_lost(lost):
+        # Страницы пула, который упал или был остановлен. Остановил другой сеанс (его страница
+        # зависла) или пул заменен - повторяем без штрафа. Иначе попытка засчитывается зависшей
+        # странице, а при падении - каждой уже начатой. Возвращает [(задача, ошибка)]
+        nonlocal restarts
+        failed = []
+        for future in lost:
+            task, attempt, executor, _, nbytes, task_id = in_flight.pop(future)
+            stopping.pop(future, None)
+            release_slot(session, nbytes=nbytes)
+            state = get_pool_state(executor)
+            started = get_page_worker(executor, task_id) is not None
+            forget_page(executor, task_id)
+            if future.cancelled() or state["killed_by"] not in (None, session):
+                retries.append((task, attempt))
+                continue
+            if executor not in lost_pools:
+                lost_pools.add(executor)
+                restarts += 1
+            counted = task_id in state["culprits"] if state["killed_by"] == session else started
+            if not counted:
+                # Страница ждала в очереди или шла рядом с зависшей - попытка не засчитывается
+                retries.append((task, attempt))
+            elif attempt >= MAX_PAGE_ATTEMPTS:
+                failed.append((task, "Рабочий процесс завис или завершился аварийно на этой странице"))
+            else:
+                retries.append((task, attempt + 1))
+
+        if restarts > MAX_POOL_RESTARTS:
+            # Процессы не запускаются или падают снова и снова: оставшиеся страницы не ждут бесконечно
+            error = "Пул процессов OCR слишком часто перезапускался, страница не распознана"
+            failed.extend((task, error) for task, _ in retries)
+            failed.extend((task, error) for task in queue)
+            retries.clear()
+            queue.clear()
+        retries.sort(key=lambda retry: retry[0][2])
+        return failed
+
+    def check_cancelled():
+        if cancel_event is not None and cancel_event.is_set():
+            raise OCRCancelled("Обработка остановлена")
+
+    try:
+        if foreground:
+            # Страницы предпросмотра тоже занимают слот: основной процесс распознает их сам
+            wait_for_slot(foreground_bytes)
+            try:
+                fill()
+                for page_num, text, details in foreground:
+                    yield None, page_num, text, details
+                    check_cancelled()
+            finally:
+                release_slot(session, nbytes=foreground_bytes)
+
+        while in_flight or retries or queue:
+            check_cancelled()
+            wants_slot = fill()
+            if not in_flight:
+                # Все слоты (или память) заняты другими сеансами: ждем своей очереди
+                nbytes = next_bytes()
+                wait_for_slot(nbytes)
+                submit_next(nbytes)
+                continue
+
+            done, _ = concurrent.futures.wait(in_flight, timeout=SLOT_POLL_INTERVAL if wants_slot else WAIT_POLL_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            lost = []
+            for future in done:
+                if future.cancelled() or isinstance(future.exception(), BrokenProcessPool):
+                    # Процесс упал, пул остановлен из-за зависшей страницы или заменен
+                    lost.append(future)
+                    continue
+                (doc_id, _, page_num, key), _, executor, submitted, nbytes, task_id = in_flight.pop(future)
+                stopping.pop(future, None)
+                forget_page(executor, task_id)
+                release_slot(session, time.monotonic() - submitted, nbytes=nbytes)
+                page_num, text, details = future.result()
+                _store_cached_page(key, text, details)
+                yield doc_id, page_num, text, details
+
+            for (doc_id, _, page_num, _), error in requeue_lost(lost):
+                yield doc_id, page_num, "", {"page": page_num + 1, "route": ROUTE_OCR, "timed_out": True,
+                                             "error": error}
+            if hang_limit:
+                stop_hung_pages()
+
+    finally:
+        # Отменяются только страницы этого сеанса: пул и страницы других сеансов продолжают работу
+        cancelled = cancel_event is not None and cancel_event.is_set()
+        for future, (_, _, executor, _, _, task_id) in in_flight.items():
+            if not future.cancel() and cancelled:
+                # Страница уже распознается: ее tesseract прерывается, результат не нужен
+                stop_page_ocr(executor, task_id)
+            forget_page(executor, task_id)
+        for doc in estimate_docs.values():
+            doc.close()
+        end_session(session)
+
+# Страницы основного процесса (предпросмотр и последовательный режим) распознаются в этих
+# потоках, а сеанс ждет их, проверяя отмену: остановка не ждет страницу в работе
+_page_threads = None
+_page_threads_lock = threading.Lock()
+
+def get_page_threads():
+    global _page_threads
+
+    with _page_threads_lock:
+        if _page_threads is None:
+            _page_threads = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="ocr-page")
+        return _page_threads
+
+def _wait_page(future, cancel_event):
+    while True:
+        done, _ = concurrent.futures.wait([future], timeout=WAIT_POLL_INTERVAL)
+        if done:
+            return future.result()
+        if cancel_event.is_set():
+            raise OCRCancelled("Обработка остановлена")
+
+def _iter_sequential(pdf_path, pending, options, cancel_event=None, session=None, on_queue=None):
+    # session - каждая страница занимает слот планировщика (без него слот уже взят вызывающим).
+    # При отмене страница в работе дорабатывает в фоне не дольше своего лимита времени
+    pdf = fitz.open(pdf_path)
+    page_future = None
+
+    def recognize(page, page_num, timings):
+        nonlocal page_future
+        if cancel_event is None:
+            return process_page(page, page_num, options, timings)
+        page_future = get_page_threads().submit(process_page, page, page_num, options, timings)
+        return _wait_page(page_future, cancel_event)
+
+    try:
+        for page_num, key in pending:
+            if cancel_event is not None and cancel_event.is_set():
+                raise OCRCancelled("Обработка остановлена")
+
+            timings = {}
+            try:
+                with stage_timer(timings, "load"):
+                    page = pdf.load_page(page_num)
+            except Exception as page_error:
+                yield page_num, "", {"page": page_num + 1, "route": ROUTE_OCR, "error": str(page_error),
+                                     "worker": os.getpid(), "timings": timings}
+                continue
+
+            if session is None:
+                _, text, details = recognize(page, page_num, timings)
+            else:
+                nbytes = estimate_page_memory(pdf, page_num, ocr_memory_dpi(options))
+                with ocr_slot(session, cancel_event, on_queue, nbytes) as acquired:
+                    if not acquired:
+                        raise OCRCancelled("Обработка остановлена")
+                    _, text, details = recognize(page, page_num, timings)
+            _store_cached_page(key, text, details)
+            yield page_num, text, details
+    finally:
+        if page_future is not None and not page_future.done():
+            # Брошенная страница еще читает документ: он закроется, когда она закончит
+            page_future.add_done_callback(lambda _: pdf.close())
+        else:
+            pdf.close()
+
+def iter_page_results(pdf_path, options, page_numbers=None, use_parallel=True, max_workers=None, window=None, doc_hash=None, use_journal=False, preview_first=False, cancel_event=None, session=None, on_queue=None):
+    # Результаты страниц отдаются по мере готовности (не по порядку): сначала из журнала
+    # прерванного запуска и кэша, затем OCR. doc_hash - уже известный хэш файла, чтобы не читать его заново.
+    # preview_first - первые страницы распознаются в основном процессе, не дожидаясь запуска пула.
+    # cancel_event (threading.Event) останавливает обработку с OCRCancelled.
+    # session - сеанс в планировщике слотов (по умолчанию свой на вызов), on_queue(статус) -
+    # позиция в очереди, пока все слоты заняты другими сеансами
+    if page_numbers is None:
+        page_numbers = range(count_pages(pdf_path))
+    if options["use_cache"] or use_journal:
+        doc_hash = doc_hash or file_sha256(pdf_path)
+
+    journal_dir = open_journal(doc_hash, options, page_numbers) if use_journal else None
+    journal_paths = journal_files(journal_dir) if journal_dir else []
+    journaled = read_journal(journal_paths)
+
+    pending = []
+    for page_num in page_numbers:
+        if page_num in journaled:
+            text, details = journaled[page_num]
+            details["resumed"] = True
+            record_page_metrics(details)
+            yield page_num, text, details
+            continue
+
+        key, cached = _lookup_cached_page(doc_hash if options["use_cache"] else None, page_num, options)
+        if cached:
+            record_page_metrics(cached[1])
+            yield (page_num, *cached)
+        else:
+            pending.append((page_num, key))
+
+    session = session or new_session_id()
+    if use_parallel and len(pending) > 1:
+        preview = pending[:PREVIEW_FIRST_PAGES] if preview_first and len(pending) > PREVIEW_FIRST_PAGES else []
+        foreground = _iter_sequential(pdf_path, preview, options, cancel_event) if preview else None
+        foreground_bytes = 0
+        if preview:
+            with fitz.open(pdf_path) as pdf:
+                foreground_bytes = max(estimate_page_memory(pdf, page_num, ocr_memory_dpi(options))
+                                       for page_num, _ in preview)
+        tasks = ((None, pdf_path, page_num, key) for page_num, key in pending[len(preview):])
+        results = ((page_num, text, details)
+                   for _, page_num, text, details in _iter_parallel(tasks, options, max_workers, window,
+                                                                    foreground, cancel_event,
+                                                                    session=session, on_queue=on_queue,
+                                                                    foreground_bytes=foreground_bytes))
+    else:
+        results = _iter_sequential(pdf_path, pending, options, cancel_event, session, on_queue)
+
+    journal = journal_writer(journal_dir) if journal_dir and pending else None
+    if journal:
+        journal_paths.append(journal.name)
+    try:
+        for page_num, text, details in results:
+            # Страницы с ошибкой в журнал не попадают: при продолжении они распознаются заново
+            if journal and not details.get("error"):
+                append_journal(journal, page_num, text, details)
+            record_page_metrics(details)
+            yield page_num, text, details
+    finally:
+        if journal:
+            journal.close()
+        end_session(session)
+
+    # Сюда доходим только после последней страницы: прерванный запуск оставляет журнал
+    if journal_dir:
+        finish_journal(journal_dir, journal_paths)
+
+def iter_documents_results(pdf_paths, options, max_workers=None, window=None, doc_options=None, on_queue=None):
+    # Пакетная обработка: страницы всех документов планируются в общем пуле.
+    # Отдает (индекс документа, страница, текст, детали) по мере готовности.
+    # doc_options - свои настройки для каждого документа (например, после определения языка)
+    tasks = []
+    for doc_id, pdf_path in enumerate(pdf_paths):
+        page_options = doc_options[doc_id] if doc_options else options
+        doc_hash = file_sha256(pdf_path) if page_options["use_cache"] else None
+        for page_num in range(count_pages(pdf_path)):
+            key, cached = _lookup_cached_page(doc_hash, page_num, page_options)
+            if cached:
+                record_page_metrics(cached[1])
+                yield (doc_id, page_num, *cached)
+            else:
+                tasks.append((doc_id, pdf_path, page_num, key))
+
+    if not tasks:
+        return
+
+    for doc_id, page_num, text, details in _iter_parallel(tasks, options, max_workers, window, doc_options=doc_options,
+                                                          on_queue=on_queue):
+        record_page_metrics(details)
+        yield doc_id, page_num, text, details
+
+def format_result_block(page_num, text, details):
+    return format_page_block(page_num, text, details["route"], details.get("error"))
+
+def extract_text_from_pdf_optimized(pdf_path, dpi=200, lang="rus+eng", use_parallel=True, use_fast_mode=True, use_text_layer=True, max_workers=None, engine=ENGINE_AUTO, use_cache=True, result_dir=None, on_update=None, adaptive=False, preprocess=False, skip_blank=True, doc_hash=None, total_pages=None, use_journal=False, page_numbers=None, preview_first=False, page_timeout=PAGE_TIMEOUT, cancel_event=None, word_boxes=False, session=None, on_queue=None, native_image=True):
+    # Проход по документу (или по выбранным страницам page_numbers) с записью результатов
+    # в папку; без привязки к интерфейсу. on_queue(статус) - позиция в очереди планировщика
+    start_time = time.time()
+
+    options = make_ocr_options(dpi=dpi, lang=lang, use_fast_mode=use_fast_mode, use_text_layer=use_text_layer, engine=engine, use_cache=use_cache, adaptive=adaptive, preprocess=preprocess, skip_blank=skip_blank, page_timeout=page_timeout, word_boxes=word_boxes, native_image=native_image)
+
+    total_pages = total_pages or count_pages(pdf_path)
+    page_numbers = list(range(total_pages)) if page_numbers is None else list(page_numbers)
+    position = {page_num: i for i, page_num in enumerate(page_numbers)}
+    result_dir = result_dir or create_result_dir()
+
+    if is_auto_language(lang) and use_cache:
+        doc_hash = doc_hash or file_sha256(pdf_path)
+    session = session or new_session_id()
+    options, language = resolve_auto_language(pdf_path, options, page_numbers, doc_hash, session, cancel_event, on_queue)
+
+    # Детали идут в порядке page_numbers, номер страницы - в details["page"]
+    page_details = [None] * len(page_numbers)
+    # Пик памяти основного процесса считается с начала задания
+    reset_peak_rss()
+    snapshot = {"completed": 0, "total": len(page_numbers), "prefix_pages": 0, "chars": 0, "words": 0}
+    results = iter_page_results(pdf_path, options, page_numbers, use_parallel, max_workers,
+                                doc_hash=doc_hash, use_journal=use_journal, preview_first=preview_first,
+                                cancel_event=cancel_event, session=session, on_queue=on_queue)
+
+    for page_num, details, snapshot in spool_page_results(results, result_dir, page_numbers, format_result_block):
+        page_details[position[page_num]] = details
+        if on_update:
+            on_update(result_dir, snapshot)
+
+    write_details(result_dir, page_details)
+    # Модель оценки времени учится на каждом задании; определение языка - отдельная стоимость
+    processing_time = time.time() - start_time
+    language_seconds = language["seconds"] if language and not language.get("cached") else 0.0
+    record_job_timing(options, page_details, processing_time - language_seconds,
+                      get_worker_count(max_workers) if use_parallel else 1)
+
+    return {
+        "result_dir": result_dir,
+        "pdf_path": pdf_path,
+        "word_boxes": options["word_boxes"],
+        "lang": options["lang"],
+        "language": language,
+        "total_pages": total_pages,
+        "page_numbers": page_numbers,
+        "page_details": page_details,
+        "chars": snapshot["chars"],
+        "words": snapshot["words"],
+        "peak_rss_mb": round(job_peak_rss_mb(page_details), 1),
+        "processing_time": processing_time,
+    }
@@ -0,0 +1,140 @@
+import os
+import json
+import threading
+
+from ocr_cache import CACHE_DIR
+
+# ==================== ОЦЕНКА ВРЕМЕНИ ОБРАБОТКИ ====================
+# Модель учится на завершенных заданиях этого развертывания (файл рядом с кэшем):
+#   - секунды OCR на мегапиксель рендера - для каждого режима (DPI, быстрый/точный,
+#     адаптивный, предобработка);
+#   - накладные расходы страницы (загрузка, классификация, страницы с текстовым слоем);
+#   - эффективность параллельной обработки - доля от идеального ускорения на N процессов.
+# Новые замеры входят скользящим средним: модель подстраивается под смену хостинга.
+
+TIMING_MODEL_PATH = os.path.join(CACHE_DIR, "timing_model.json")
+
+DEFAULT_SECONDS_PER_MEGAPIXEL = 1.3   # ~5 с на страницу A4 при 200 DPI
+DEFAULT_PAGE_OVERHEAD = 0.1
+DEFAULT_PARALLEL_EFFICIENCY = 0.7
+DEFAULT_PAGE_AREA = 595 * 842         # A4 в пт², если размер страницы неизвестен
+TIMING_SMOOTHING = 0.3                # вес нового задания
+MIN_OCR_MEGAPIXELS = 2.0              # задание с меньшим объемом OCR не меняет секунды на мегапиксель
+LIVE_ETA_MIN_PAGES = 2                # с этого числа готовых страниц остаток считается по их скорости
+
+_model_lock = threading.Lock()
+
+def timing_mode_key(options):
+    key = f"{options['dpi']}dpi"
+    if options.get("adaptive"):
+        key += "-adaptive"
+    elif not options.get("use_fast_mode", True):
+        key += "-accurate"
+    if options.get("preprocess"):
+        key += "-preprocess"
+    return key
+
+def load_timing_model():
+    try:
+        with open(TIMING_MODEL_PATH, encoding="utf-8") as f:
+            model = json.load(f)
+    except (OSError, ValueError):
+        model = {}
+    model.setdefault("modes", {})
+    model.setdefault("page_overhead", DEFAULT_PAGE_OVERHEAD)
+    model.setdefault("parallel_efficiency", DEFAULT_PARALLEL_EFFICIENCY)
+    model.setdefault("jobs", 0)
+    return model
+
+def _save_timing_model(model):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{TIMING_MODEL_PATH}.{os.getpid()}.part"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(model, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, TIMING_MODEL_PATH)
+
+def _smooth(old, new):
+    return old + TIMING_SMOOTHING * (new - old)
+
+def _seconds_per_megapixel(model, key):
+    # Режим без замеров - среднее по измеренным режимам, иначе значение по умолчанию
+    if key in model["modes"]:
+        return model["modes"][key]
+    if model["modes"]:
+        return sum(model["modes"].values()) / len(model["modes"])
+    return DEFAULT_SECONDS_PER_MEGAPIXEL
+
+def estimate_processing_time(page_areas, ocr_share, options, workers=1, blank_share=0.0):
+    # page_areas - площади выбранных страниц в пт²; ocr_share - доля страниц без текстового слоя,
+    # blank_share - доля пустых из них (при пропуске пустых страниц OCR им не нужен)
+    model = load_timing_model()
+    page_areas = [area or DEFAULT_PAGE_AREA for area in page_areas]
+    if not page_areas:
+        return 0.0
+
+    share = ocr_share if options.get("use_text_layer", True) else 1.0
+    if options.get("skip_blank", True):
+        share = max(0.0, share - blank_share)
+    megapixels = sum(page_areas) * (options["dpi"] / 72) ** 2 / 1e6
+    ocr_megapixels = megapixels * share
+    work = (len(page_areas) * model["page_overhead"]
+            + ocr_megapixels * _seconds_per_megapixel(model, timing_mode_key(options)))
+
+    parallel = min(workers, len(page_areas))
+    speedup = 1 + (parallel - 1) * model["parallel_efficiency"]
+    return work / speedup
+
+def record_job_timing(options, page_details, wall_seconds, workers=1):
+    # Уточняет модель по завершенному заданию; страницы из кэша, журнала и с ошибкой не учитываются
+    measured = [d for d in page_details
+                if d and "seconds" in d and not (d.get("cached") or d.get("resumed") or d.get("error"))]
+    if not measured or wall_seconds <= 0:
+        return
+
+    with _model_lock:
+        model = load_timing_model()
+
+        light = [d["seconds"] for d in measured if "megapixels" not in d]
+        if light:
+            model["page_overhead"] = round(_smooth(model["page_overhead"], sum(light) / len(light)), 4)
+
+        ocr_pages = [d for d in measured if "megapixels" in d]
+        ocr_megapixels = sum(d["megapixels"] for d in ocr_pages)
+        if ocr_megapixels >= MIN_OCR_MEGAPIXELS:
+            ocr_seconds = sum(max(0.0, d["seconds"] - model["page_overhead"]) for d in ocr_pages)
+            key = timing_mode_key(options)
+            old = _seconds_per_megapixel(model, key)
+            model["modes"][key] = round(_smooth(old, ocr_seconds / ocr_megapixels), 4)
+
+        # Реальное ускорение: суммарное время страниц против времени задания
+        parallel = min(workers, len(measured))
+        if parallel > 1 and len(measured) >= 2 * parallel:
+            speedup = sum(d["seconds"] for d in measured) / wall_seconds
+            efficiency = min(1.0, max(0.05, (speedup - 1) / (parallel - 1)))
+            model["parallel_efficiency"] = round(_smooth(model["parallel_efficiency"], efficiency), 4)
+
+        model["jobs"] += 1
+        try:
+            _save_timing_model(model)
+        except OSError:
+            pass
+
+def live_eta(estimate, elapsed, completed, total):
+    # Остаток времени: сначала по модели, затем все больше по наблюдаемой скорости страниц
+    remaining_pages = max(0, total - completed)
+    model_left = max(0.0, estimate - elapsed) if estimate is not None else None
+    if completed < LIVE_ETA_MIN_PAGES or not elapsed:
+        return model_left
+
+    observed_left = elapsed / completed * remaining_pages
+    if model_left is None:
+        return observed_left
+    weight = completed / max(total, 1)
+    return weight * observed_left + (1 - weight) * model_left
+
+def format_duration(seconds):
+    seconds = max(0, round(seconds))
+    if seconds < 120:
+        return f"~{seconds} с"
+    minutes, seconds = divmod(seconds, 60)
+    return f"~{minutes} мин {seconds} с" if minutes < 10 else f"~{minutes} мин"
@@ -0,0 +1,198 @@
+import os
+from itertools import groupby
+from xml.sax.saxutils import escape, quoteattr
+
+from ocr_lazy import lazy_import
+from ocr_engine import ROUTE_NATIVE, ROUTE_BOTH, words_outside_layer
+from ocr_results import read_page_words
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+# ==================== ФОРМАТЫ С КООРДИНАТАМИ СЛОВ ====================
+# TSV, hOCR, ALTO и PDF с невидимым текстовым слоем собираются из слов, сохраненных
+# при распознавании (page_XXXXX.words.json), без повторного OCR. Слова текстового
+# слоя PDF берутся из самого документа.
+#
+# Слово: [x0, y0, x1, y1, уверенность, блок, абзац, строка, текст], координаты - пт страницы
+# без учета ее поворота (как у page.get_text("words")).
+
+FORMAT_TSV = "tsv"
+FORMAT_HOCR = "hocr"
+FORMAT_ALTO = "alto"
+FORMAT_PDF = "pdf"
+
+FORMATS = {
+    FORMAT_TSV: {"file": "words.tsv", "suffix": ".tsv", "resource": "result.tsv", "mime": "text/tab-separated-values",
+                 "label": "TSV (слова, рамки, уверенность)"},
+    FORMAT_HOCR: {"file": "result.hocr", "suffix": ".hocr", "resource": "result.hocr", "mime": "text/html",
+                  "label": "hOCR"},
+    FORMAT_ALTO: {"file": "alto.xml", "suffix": ".alto.xml", "resource": "result.alto.xml", "mime": "application/xml",
+                  "label": "ALTO XML"},
+    FORMAT_PDF: {"file": "searchable.pdf", "suffix": "_searchable.pdf", "resource": "result.pdf", "mime": "application/pdf",
+                 "label": "PDF с текстовым слоем"},
+}
+
+NATIVE_CONFIDENCE = 100.0   # слова текстового слоя PDF
+HOCR_DPI = 300              # hOCR - в пикселях: координаты переводятся в 300 DPI
+ALTO_UNITS_PER_PT = 1200 / 72  # ALTO - в единицах inch1200
+
+def split_page_words(page, route, ocr_words):
+    # Слова текстового слоя и слова OCR; на смешанных страницах слова OCR поверх слоя отбрасываются
+    native_words = []
+    if route in (ROUTE_NATIVE, ROUTE_BOTH):
+        for x0, y0, x1, y1, text, block, line, _ in page.get_text("words"):
+            native_words.append([round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2),
+                                 NATIVE_CONFIDENCE, block, 0, line, text])
+
+    if not native_words:
+        return native_words, list(ocr_words)
+
+    native_rects = [fitz.Rect(word[:4]) for word in native_words]
+    block_offset = max(word[5] for word in native_words) + 1
+    extra_words = [word[:5] + [word[5] + block_offset] + word[6:]
+                   for word in words_outside_layer(native_rects, ocr_words)]
+    return native_words, extra_words
+
+def _union(words):
+    return (min(word[0] for word in words), min(word[1] for word in words),
+            max(word[2] for word in words), max(word[3] for word in words))
+
+def _page_bounds(page):
+    # Прямоугольник страницы в тех же координатах, что и слова
+    return page.rect * page.derotation_matrix
+
+def _group(words, index):
+    return [list(group) for _, group in groupby(words, key=lambda word: tuple(word[5:index]))]
+
+def _write_tsv(f, pdf, pages):
+    f.write("page\tblock\tpar\tline\tword\tleft\ttop\twidth\theight\tconf\ttext\n")
+    for page_num, page, words, _ in pages:
+        for line in _group(words, 8):
+            for word_num, (x0, y0, x1, y1, conf, block, paragraph, line_num, text) in enumerate(line, start=1):
+                f.write(f"{page_num + 1}\t{block}\t{paragraph}\t{line_num}\t{word_num}\t"
+                        f"{x0:.2f}\t{y0:.2f}\t{x1 - x0:.2f}\t{y1 - y0:.2f}\t{conf:.1f}\t{text}\n")
+
+def _hocr_bbox(bbox):
+    scale = HOCR_DPI / 72
+    return "bbox " + " ".join(str(round(value * scale)) for value in bbox)
+
+def _write_hocr(f, pdf, pages):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+            '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n<title></title>\n'
+            '<meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>\n'
+            '<meta name="ocr-system" content="tesseract"/>\n'
+            '<meta name="ocr-capabilities" content="ocr_page ocr_carea ocr_par ocr_line ocrx_word"/>\n'
+            '</head>\n<body>\n')
+    for page_num, page, words, _ in pages:
+        page_id = page_num + 1
+        f.write(f'<div class="ocr_page" id="page_{page_id}" title="{_hocr_bbox(_page_bounds(page))}; '
+                f'ppageno {page_num}; scan_res {HOCR_DPI} {HOCR_DPI}">\n')
+        word_id = 0
+        for block in _group(words, 6):
+            f.write(f' <div class="ocr_carea" id="block_{page_id}_{block[0][5]}" title="{_hocr_bbox(_union(block))}">\n')
+            for paragraph in _group(block, 7):
+                f.write(f'  <p class="ocr_par" title="{_hocr_bbox(_union(paragraph))}">\n')
+                for line in _group(paragraph, 8):
+                    f.write(f'   <span class="ocr_line" title="{_hocr_bbox(_union(line))}">')
+                    for word in line:
+                        word_id += 1
+                        f.write(f'<span class="ocrx_word" id="word_{page_id}_{word_id}" '
+                                f'title="{_hocr_bbox(word[:4])}; x_wconf {round(word[4])}">{escape(word[8])}</span> ')
+                    f.write('</span>\n')
+                f.write('  </p>\n')
+            f.write(' </div>\n')
+        f.write('</div>\n')
+    f.write('</body>\n</html>\n')
+
+def _alto_box(bbox):
+    x0, y0, x1, y1 = (round(value * ALTO_UNITS_PER_PT) for value in bbox)
+    return f'HPOS="{x0}" VPOS="{y0}" WIDTH="{x1 - x0}" HEIGHT="{y1 - y0}"'
+
+def _write_alto(f, pdf, pages):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#">\n'
+            '<Description>\n<MeasurementUnit>inch1200</MeasurementUnit>\n</Description>\n<Layout>\n')
+    for page_num, page, words, _ in pages:
+        page_id = page_num + 1
+        bounds = _page_bounds(page)
+        box = _alto_box(bounds)
+        f.write(f'<Page ID="page_{page_id}" PHYSICAL_IMG_NR="{page_id}" '
+                f'WIDTH="{round(bounds.width * ALTO_UNITS_PER_PT)}" HEIGHT="{round(bounds.height * ALTO_UNITS_PER_PT)}">\n'
+                f'<PrintSpace {box}>\n')
+        string_id = 0
+        for block_index, block in enumerate(_group(words, 7), start=1):
+            f.write(f'<TextBlock ID="block_{page_id}_{block_index}" {_alto_box(_union(block))}>\n')
+            for line_index, line in enumerate(_group(block, 8), start=1):
+                f.write(f'<TextLine ID="line_{page_id}_{block_index}_{line_index}" {_alto_box(_union(line))}>\n')
+                for index, word in enumerate(line):
+                    if index:
+                        f.write('<SP/>\n')
+                    string_id += 1
+                    f.write(f'<String ID="string_{page_id}_{string_id}" {_alto_box(word[:4])} '
+                            f'WC="{word[4] / 100:.2f}" CONTENT={quoteattr(word[8])}/>\n')
+                f.write('</TextLine>\n')
+            f.write('</TextBlock>\n')
+        f.write('</PrintSpace>\n</Page>\n')
+    f.write('</Layout>\n</alto>\n')
+
+def _write_searchable_pdf(target, pdf, pages):
+    # Невидимый текст (render_mode=3) по рамкам слов OCR; ширина слова подгоняется размером шрифта.
+    # На повернутых страницах (в том числе после исправления поворота скана) строки пишутся
+    # в направлении чтения: текст поворачивается вокруг начала координат на угол страницы
+    font = fitz.Font("helv")
+    for _, page, words, rotation in pages:
+        if not words:
+            continue
+        source_rotation = page.rotation
+        angle = (source_rotation + rotation) % 360
+        page.set_rotation(angle)
+        to_reading, to_page = page.rotation_matrix, page.derotation_matrix
+        page.set_rotation(source_rotation)
+
+        writer = fitz.TextWriter(page.rect)
+        for *bbox, _, _, _, _, text in words:
+            rect = fitz.Rect(bbox) * to_reading
+            length = font.text_length(text, fontsize=1)
+            if length <= 0 or rect.is_empty:
+                continue
+            fontsize = min(rect.width / length, 2 * rect.height)
+            # morph поворачивает текст в обратную сторону относительно fitz.Matrix(angle) (ось y PDF смотрит вверх)
+            origin = fitz.Point(rect.x0, rect.y1 - 0.2 * rect.height) * to_page * fitz.Matrix(angle)
+            writer.append(origin, text, font=font, fontsize=fontsize)
+        writer.write_text(page, render_mode=3, morph=(fitz.Point(0, 0), fitz.Matrix(angle)) if angle else None)
+    pdf.save(target, garbage=3, deflate=True)
+
+def write_format(fmt, target, pdf_path, pages):
+    # pages - (страница, детали страницы, слова OCR) в порядке страниц
+    with fitz.open(pdf_path) as pdf:
+        def iter_pages(ocr_only):
+            # (страница, объект страницы, слова, исправленный поворот скана)
+            for page_num, details, ocr_words in pages:
+                page = pdf[page_num]
+                native_words, extra_words = split_page_words(page, details.get("route"), ocr_words)
+                yield (page_num, page, extra_words if ocr_only else native_words + extra_words,
+                       details.get("rotation", 0))
+
+        if fmt == FORMAT_PDF:
+            _write_searchable_pdf(target, pdf, iter_pages(ocr_only=True))
+            return
+
+        writer = {FORMAT_TSV: _write_tsv, FORMAT_HOCR: _write_hocr, FORMAT_ALTO: _write_alto}[fmt]
+        with open(target, "w", encoding="utf-8") as f:
+            writer(f, pdf, iter_pages(ocr_only=False))
+
+def format_path(result_dir, fmt):
+    return os.path.join(result_dir, FORMATS[fmt]["file"])
+
+def build_format_file(result_dir, fmt, pdf_path, page_numbers, page_details):
+    # Файл формата собирается на диске один раз на результат, как архив страниц
+    path = format_path(result_dir, fmt)
+    if not os.path.exists(path):
+        pages = ((page_num, details or {}, read_page_words(result_dir, page_num))
+                 for page_num, details in zip(page_numbers, page_details))
+        temp_path = path + ".part"
+        write_format(fmt, temp_path, pdf_path, pages)
+        os.replace(temp_path, path)
+    return path
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from ocr_cache import document_key
+
+# ==================== ЖУРНАЛ ЗАДАНИЙ ====================
+# Каждая готовая страница сразу дописывается в журнал на диске. Если контейнер
+# перезапустился или соединение оборвалось, повторная отправка того же документа
+# с теми же настройками и страницами продолжит работу с недостающих страниц.
+# Каждый запуск пишет свой файл: одновременные задания не мешают друг другу,
+# а завершенный запуск удаляет только свой файл и файлы, с которых продолжил.
+
+JOURNAL_DIR = os.environ.get("OCR_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "pdf_ocr_journal"))
+JOURNAL_MAX_AGE = 72 * 3600     # брошенный журнал без изменений удаляется через трое суток
+
+JOURNAL_PREFIX = "journal_"
+JOURNAL_SUFFIX = ".jsonl"
+META_NAME = "meta.json"
+
+def open_journal(doc_hash, options, page_numbers):
+    journal_dir = os.path.join(JOURNAL_DIR, document_key(doc_hash, options, page_numbers))
+    os.makedirs(journal_dir, exist_ok=True)
+
+    meta_path = os.path.join(journal_dir, META_NAME)
+    if not os.path.exists(meta_path):
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"doc_hash": doc_hash, "options": options, "total_pages": len(page_numbers),
+                       "created": time.time()}, f, ensure_ascii=False)
+    return journal_dir
+
+def journal_files(journal_dir):
+    try:
+        names = os.listdir(journal_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(journal_dir, name) for name in sorted(names)
+            if name.startswith(JOURNAL_PREFIX) and name.endswith(JOURNAL_SUFFIX)]
+
+def read_journal(paths):
+    # Возвращает {страница: (текст, детали)} по файлам прерванных запусков;
+    # оборванная при сбое последняя строка пропускается
+    pages = {}
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    pages[record["page"]] = (record["text"], record["details"])
+        except FileNotFoundError:
+            pass
+    return pages
+
+def journal_writer(journal_dir):
+    fd, path = tempfile.mkstemp(prefix=JOURNAL_PREFIX, suffix=JOURNAL_SUFFIX, dir=journal_dir)
+    os.close(fd)
+    return open(path, "a", encoding="utf-8")
+
+def append_journal(journal, page_num, text, details):
+    # Запись считается сделанной только после fsync: страница переживет перезапуск
+    journal.write(json.dumps({"page": page_num, "text": text, "details": details}, ensure_ascii=False) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+def finish_journal(journal_dir, paths):
+    # Запуск дошел до конца: его страницы больше не нужны. Файлы, появившиеся у других
+    # заданий после старта, остаются; папка удаляется, когда журналов в ней не осталось.
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    if not journal_files(journal_dir):
+        shutil.rmtree(journal_dir, ignore_errors=True)
+
+def cleanup_journals(max_age=JOURNAL_MAX_AGE):
+    if not os.path.isdir(JOURNAL_DIR):
+        return
+    deadline = time.time() - max_age
+    for name in os.listdir(JOURNAL_DIR):
+        journal_dir = os.path.join(JOURNAL_DIR, name)
+        try:
+            updated = max([os.path.getmtime(path) for path in journal_files(journal_dir)]
+                          + [os.path.getmtime(journal_dir)])
+            if updated < deadline:
+                shutil.rmtree(journal_dir, ignore_errors=True)
+        except OSError:
+            pass
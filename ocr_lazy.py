@@ -0,0 +1,29 @@
+import importlib
+import importlib.util
+
+# ==================== ОТЛОЖЕННЫЙ ИМПОРТ ====================
+# PyMuPDF, pytesseract (он тянет pandas), PIL, OpenCV и tesserocr загружаются при первом обращении к ним,
+# а не при импорте модулей OCR: интерфейс и /health сервиса отвечают сразу после старта
+# контейнера, а модули грузятся вместе с первой страницей или прогревом.
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Вызывается только для атрибутов самого модуля; import_module потокобезопасен
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = "загружен" if self._module is not None else "не загружен"
+        return f"<модуль {self._name} ({state})>"
+
+def lazy_import(name):
+    return LazyModule(name)
+
+def lazy_import_optional(name):
+    # Необязательная зависимость: None, если модуль не установлен (find_spec его не загружает)
+    return LazyModule(name) if importlib.util.find_spec(name) is not None else None
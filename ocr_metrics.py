@@ -0,0 +1,181 @@
+import sys
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+from ocr_cache import cache_stats
+from ocr_scheduler import scheduler_stats
+
+# ==================== МЕТРИКИ ОБРАБОТКИ ====================
+# Поэтапные таймеры страниц и агрегированные счетчики процесса в формате Prometheus.
+
+STAGES = ("load", "classify", "blank", "render", "preprocess", "convert", "ocr", "escalate", "merge")
+
+STAGE_LABELS = {
+    "load": "Загрузка",
+    "classify": "Классификация",
+    "blank": "Проверка пустоты",
+    "render": "Рендер",
+    "preprocess": "Предобработка",
+    "convert": "Конвертация",
+    "ocr": "OCR",
+    "escalate": "Повтор",
+    "merge": "Объединение",
+}
+
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics_lock = threading.Lock()
+_page_counters = {}
+_histograms = {}
+_escalations = {}
+
+@contextmanager
+def stage_timer(timings, name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round(timings.get(name, 0.0) + time.perf_counter() - start_time, 4)
+
+def _observe(name, labels, value):
+    key = (name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = {"buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0}
+
+    for i, bound in enumerate(HISTOGRAM_BUCKETS):
+        if value <= bound:
+            histogram["buckets"][i] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+def record_page_metrics(details):
+    if details.get("cached"):
+        status = "cached"
+    elif details.get("resumed"):
+        status = "resumed"
+    elif details.get("error"):
+        status = "error"
+    else:
+        status = "ok"
+
+    labels = (("route", details.get("route", "")), ("engine", details.get("engine", "none")), ("status", status))
+
+    with _metrics_lock:
+        _page_counters[labels] = _page_counters.get(labels, 0) + 1
+        if status in ("cached", "resumed"):
+            return
+
+        if details.get("escalated"):
+            _escalations[details["escalated"]] = _escalations.get(details["escalated"], 0) + 1
+
+        if "seconds" in details:
+            _observe("ocr_page_seconds", (), details["seconds"])
+        if "queue_wait" in details:
+            _observe("ocr_queue_wait_seconds", (), details["queue_wait"])
+        for stage, seconds in details.get("timings", {}).items():
+            _observe("ocr_stage_seconds", (("stage", stage),), seconds)
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+def render_prometheus():
+    with _metrics_lock:
+        counters = dict(_page_counters)
+        histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                      for key, h in _histograms.items()}
+        escalations = dict(_escalations)
+
+    lines = [
+        "# HELP ocr_pages_total Обработанные страницы по маршруту, движку и статусу",
+        "# TYPE ocr_pages_total counter",
+    ]
+    for labels, value in sorted(counters.items()):
+        lines.append(f"ocr_pages_total{_format_labels(labels)} {value}")
+
+    lines.append("# HELP ocr_pages_escalated_total Страницы адаптивного режима, повторенные точным проходом")
+    lines.append("# TYPE ocr_pages_escalated_total counter")
+    for scope, value in sorted(escalations.items()):
+        lines.append(f"ocr_pages_escalated_total{_format_labels([('scope', scope)])} {value}")
+
+    help_texts = {
+        "ocr_page_seconds": "Полное время обработки страницы в рабочем процессе",
+        "ocr_queue_wait_seconds": "Ожидание страницы в очереди пула до начала обработки",
+        "ocr_stage_seconds": "Время этапов обработки страницы",
+    }
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# HELP {name} {help_texts.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(HISTOGRAM_BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.4f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    cache = cache_stats()
+    for key, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter")):
+        lines.append(f"# TYPE ocr_cache_{key}_total {kind}")
+        lines.append(f"ocr_cache_{key}_total {cache[key]}")
+    lines.append("# TYPE ocr_cache_size_bytes gauge")
+    lines.append(f"ocr_cache_size_bytes {int(cache['size_mb'] * 1024 * 1024)}")
+
+    slots = scheduler_stats()
+    for key, help_text in (("capacity", "Слоты OCR на процесс"), ("in_use", "Занятые слоты OCR"),
+                           ("sessions", "Сеансы со страницами в работе"), ("waiting", "Сеансы, ждущие слот")):
+        lines.append(f"# HELP ocr_slots_{key} {help_text}")
+        lines.append(f"# TYPE ocr_slots_{key} gauge")
+        lines.append(f"ocr_slots_{key} {slots[key]}")
+    for key, help_text in (("in_flight", "Оценка памяти страниц в работе"), ("budget", "Бюджет памяти страниц в работе")):
+        lines.append(f"# HELP ocr_memory_{key}_bytes {help_text}")
+        lines.append(f"# TYPE ocr_memory_{key}_bytes gauge")
+        lines.append(f"ocr_memory_{key}_bytes {int(slots[f'memory_{key}_mb'] * 1024 * 1024)}")
+
+    return "\n".join(lines) + "\n"
+
+# ==================== ПАМЯТЬ ====================
+
+def _read_status_mb(pid, field):
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    # Linux: сброс VmHWM текущего процесса, чтобы пик считался на каждый прогон
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def read_peak_rss_mb(pid=None):
+    peak = _read_status_mb(pid, "VmHWM")
+    if peak is not None:
+        return peak
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+    return 0.0
+
+def summarize_stage_timings(page_details):
+    totals = {stage: 0.0 for stage in STAGES}
+    totals["queue_wait"] = 0.0
+    for details in page_details:
+        if not details or details.get("cached") or details.get("resumed"):
+            continue
+        for stage, seconds in details.get("timings", {}).items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        totals["queue_wait"] += details.get("queue_wait", 0.0)
+    return totals
@@ -0,0 +1,159 @@
+from ocr_lazy import lazy_import, lazy_import_optional
+
+cv2 = lazy_import_optional("cv2")
+np = lazy_import("numpy")
+fitz = lazy_import("fitz")  # PyMuPDF
+
+# ==================== ПРЕДОБРАБОТКА ИЗОБРАЖЕНИЯ ====================
+# Необязательный этап между рендером и OCR: адаптивная бинаризация, удаление мелкого
+# шума, выравнивание наклона и обрезка пустых полей. Все операции - над массивом
+# страницы целиком, без попиксельных циклов в Python.
+
+THRESHOLD_BLOCK_INCH = 0.1      # окно адаптивного порога
+THRESHOLD_OFFSET = 15           # насколько пиксель должен быть темнее окрестности
+SPECKLE_MAX_INCH = 0.007        # пятна меньше этого размера считаются шумом
+DESKEW_MAX_ANGLE = 5.0          # градусов в каждую сторону
+DESKEW_STEP = 0.25
+DESKEW_MIN_ANGLE = 0.2          # меньший наклон не исправляем
+DESKEW_MIN_POINTS = 2000        # на почти пустой странице наклон не оцениваем
+DESKEW_SAMPLE_POINTS = 20000    # сколько точек текста участвует в оценке наклона
+DESKEW_MIN_GAIN = 1.05          # найденный угол должен быть заметно лучше нулевого
+CROP_MARGIN_INCH = 0.1          # поле, оставляемое вокруг текста после обрезки
+
+def is_preprocess_available():
+    return cv2 is not None
+
+def pixmap_to_gray_array(pix):
+    # Для одноканального pixmap - представление его памяти без копирования
+    rows = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)
+    if pix.n == 1:
+        return rows[:, :pix.width]
+    pixels = rows[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    return cv2.cvtColor(pixels[:, :, :3], cv2.COLOR_RGB2GRAY)
+
+def binarize(gray, dpi):
+    block = max(3, int(dpi * THRESHOLD_BLOCK_INCH) | 1)
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block, THRESHOLD_OFFSET)
+
+def remove_speckles(binary, dpi):
+    ink = (binary == 0).astype(np.uint8)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    max_size = max(1, int(dpi * SPECKLE_MAX_INCH))
+    speckles = ((stats[:, cv2.CC_STAT_WIDTH] <= max_size) & (stats[:, cv2.CC_STAT_HEIGHT] <= max_size))
+    speckles[0] = False  # фон
+    binary[speckles[labels]] = 255
+    return binary, int(speckles.sum())
+
+def estimate_skew(binary):
+    # Проекции точек текста на вертикаль для каждого угла сразу: при верном угле
+    # строки дают самые острые пики гистограммы
+    ys, xs = np.nonzero(binary == 0)
+    if len(xs) < DESKEW_MIN_POINTS:
+        return 0.0
+    if len(xs) > DESKEW_SAMPLE_POINTS:
+        sample = np.linspace(0, len(xs) - 1, DESKEW_SAMPLE_POINTS).astype(np.int64)
+        ys, xs = ys[sample], xs[sample]
+
+    angles = np.deg2rad(np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + DESKEW_STEP / 2, DESKEW_STEP))
+    rows = ys[None, :] * np.cos(angles)[:, None] - xs[None, :] * np.sin(angles)[:, None]
+    rows = np.round(rows - rows.min()).astype(np.int64)
+    height = int(rows.max()) + 1
+
+    offsets = np.arange(len(angles))[:, None] * height
+    histograms = np.bincount((rows + offsets).ravel(), minlength=len(angles) * height).reshape(len(angles), height)
+    scores = (histograms.astype(np.float64) ** 2).sum(axis=1)
+    best = scores.argmax()
+    if scores[best] < scores[len(angles) // 2] * DESKEW_MIN_GAIN:
+        return 0.0
+    return float(np.rad2deg(angles[best]))
+
+def rotate(binary, angle):
+    height, width = binary.shape
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    rotated = cv2.warpAffine(binary, rotation, (width, height), flags=cv2.INTER_NEAREST, borderValue=255)
+    return rotated, rotation
+
+def crop_margins(binary, dpi):
+    ink = binary == 0
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if not len(rows):
+        return binary, (0, 0), 0.0
+
+    margin = int(dpi * CROP_MARGIN_INCH)
+    height, width = binary.shape
+    y0, y1 = max(0, rows[0] - margin), min(height, rows[-1] + margin + 1)
+    x0, x1 = max(0, cols[0] - margin), min(width, cols[-1] + margin + 1)
+    cropped_share = 1 - (y1 - y0) * (x1 - x0) / (height * width)
+    return binary[y0:y1, x0:x1], (int(x0), int(y0)), cropped_share
+
+def preprocess_pixmap(pix):
+    # Возвращает одноканальный обработанный pixmap, матрицу из его пикселей в пиксели
+    # исходного изображения и отчет о найденном наклоне, шуме и обрезке
+    dpi = pix.xres or 300
+    binary = binarize(pixmap_to_gray_array(pix), dpi)
+    binary, speckles = remove_speckles(binary, dpi)
+
+    to_source = fitz.Matrix(1, 0, 0, 1, 0, 0)
+    angle = estimate_skew(binary)
+    if abs(angle) >= DESKEW_MIN_ANGLE:
+        binary, rotation = rotate(binary, angle)
+        inverse = cv2.invertAffineTransform(rotation)
+        to_source = fitz.Matrix(inverse[0, 0], inverse[1, 0], inverse[0, 1], inverse[1, 1], inverse[0, 2], inverse[1, 2])
+    else:
+        angle = 0.0
+
+    binary, (x0, y0), cropped_share = crop_margins(binary, dpi)
+    to_source = fitz.Matrix(1, 0, 0, 1, x0, y0) * to_source
+
+    height, width = binary.shape
+    result = fitz.Pixmap(fitz.csGRAY, width, height, np.ascontiguousarray(binary).tobytes(), 0)
+    result.set_dpi(pix.xres, pix.yres)
+
+    report = {"skew": round(angle, 2), "speckles": speckles, "cropped": round(float(cropped_share), 3)}
+    return result, to_source, report
+
+# ==================== ПУСТЫЕ СТРАНИЦЫ ====================
+# Дешевая проверка на уменьшенном рендере до OCR: разделители, пустые обороты
+# при двустороннем сканировании и страницы, на которых только печать или подпись.
+
+BLANK_CHECK_DPI = 50
+BLANK_MAX_STD = 4.0             # разброс яркости почти однотонного листа
+BLANK_INK_CONTRAST = 60         # насколько пиксель темнее фона, чтобы считаться краской
+BLANK_MIN_COMPONENT_INCH = 0.03 # пятна меньше - пыль и шум сканера
+BLANK_MAX_INK_RATIO = 0.001     # доля краски на пустом листе
+BLANK_STAMP_MAX_COMPONENTS = 3  # печать или подпись - несколько крупных пятен
+BLANK_STAMP_MIN_INCH = 0.4      # меньшие пятна похожи на буквы и слова
+
+BLANK_EMPTY = "empty"
+BLANK_STAMP = "stamp"
+
+def detect_blank_page(pix):
+    # Возвращает (BLANK_EMPTY | BLANK_STAMP | None, отчет) по одноканальному рендеру
+    dpi = pix.xres or BLANK_CHECK_DPI
+    gray = pixmap_to_gray_array(pix)
+    if gray.std() < BLANK_MAX_STD:
+        return BLANK_EMPTY, {"ink_ratio": 0.0}
+
+    ink = gray < np.median(gray) - BLANK_INK_CONTRAST
+    components = None
+    if cv2 is not None:
+        _, _, stats, _ = cv2.connectedComponentsWithStats(ink.astype(np.uint8), connectivity=8)
+        stats = stats[1:]
+        min_size = max(1, int(dpi * BLANK_MIN_COMPONENT_INCH))
+        components = stats[(stats[:, cv2.CC_STAT_WIDTH] > min_size) | (stats[:, cv2.CC_STAT_HEIGHT] > min_size)]
+        ink_pixels = int(components[:, cv2.CC_STAT_AREA].sum())
+    else:
+        ink_pixels = int(ink.sum())
+
+    ink_ratio = ink_pixels / gray.size
+    report = {"ink_ratio": round(ink_ratio, 5)}
+    if ink_ratio < BLANK_MAX_INK_RATIO:
+        return BLANK_EMPTY, report
+
+    if components is not None and len(components) <= BLANK_STAMP_MAX_COMPONENTS:
+        min_stamp = dpi * BLANK_STAMP_MIN_INCH
+        if ((components[:, cv2.CC_STAT_WIDTH] >= min_stamp) & (components[:, cv2.CC_STAT_HEIGHT] >= min_stamp)).all():
+            return BLANK_STAMP, report
+
+    return None, report
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import shutil
+import zipfile
+import tempfile
+
+# ==================== ХРАНЕНИЕ РЕЗУЛЬТАТОВ НА ДИСКЕ ====================
+# Текст страниц пишется на диск по мере готовности: в памяти остаются только
+# счетчики и начало документа для предпросмотра.
+
+RESULTS_DIR = os.environ.get("OCR_RESULTS_DIR", os.path.join(tempfile.gettempdir(), "pdf_ocr_results"))
+RESULT_MAX_AGE = 24 * 3600
+PREVIEW_CHARS = 2000
+
+UPLOADS_DIR = os.environ.get("OCR_UPLOADS_DIR", os.path.join(tempfile.gettempdir(), "pdf_ocr_uploads"))
+
+FULL_TEXT_NAME = "full.txt"
+DETAILS_NAME = "details.json"
+PAGES_ZIP_NAME = "pages.zip"
+
+def create_result_dir():
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix="job_", dir=RESULTS_DIR)
+
+def remove_result_dir(result_dir):
+    if result_dir and os.path.isdir(result_dir):
+        shutil.rmtree(result_dir, ignore_errors=True)
+
+def cleanup_result_dirs(max_age=RESULT_MAX_AGE):
+    if not os.path.isdir(RESULTS_DIR):
+        return
+    deadline = time.time() - max_age
+    for name in os.listdir(RESULTS_DIR):
+        path = os.path.join(RESULTS_DIR, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+def spool_upload(data, upload_hash):
+    # Один файл на содержимое загрузки: повторные запуски и обработки его не переписывают
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    path = os.path.join(UPLOADS_DIR, f"{upload_hash}.pdf")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=UPLOADS_DIR)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+def cleanup_uploads(max_age=RESULT_MAX_AGE):
+    if not os.path.isdir(UPLOADS_DIR):
+        return
+    deadline = time.time() - max_age
+    for name in os.listdir(UPLOADS_DIR):
+        path = os.path.join(UPLOADS_DIR, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                os.unlink(path)
+        except OSError:
+            pass
+
+def full_text_path(result_dir):
+    return os.path.join(result_dir, FULL_TEXT_NAME)
+
+def page_text_path(result_dir, page_num):
+    return os.path.join(result_dir, f"page_{page_num + 1:05d}.txt")
+
+def read_page_text(result_dir, page_num):
+    try:
+        with open(page_text_path(result_dir, page_num), encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+def page_words_path(result_dir, page_num):
+    return os.path.join(result_dir, f"page_{page_num + 1:05d}.words.json")
+
+def read_page_words(result_dir, page_num):
+    try:
+        with open(page_words_path(result_dir, page_num), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def iter_page_texts(result_dir, page_numbers):
+    for page_num in page_numbers:
+        yield page_num, read_page_text(result_dir, page_num)
+
+def read_text_prefix(result_dir, limit=PREVIEW_CHARS):
+    try:
+        with open(full_text_path(result_dir), encoding="utf-8") as f:
+            return f.read(limit)
+    except FileNotFoundError:
+        return ""
+
+def write_details(result_dir, page_details):
+    with open(os.path.join(result_dir, DETAILS_NAME), "w", encoding="utf-8") as f:
+        json.dump(page_details, f, ensure_ascii=False)
+
+def read_details(result_dir):
+    try:
+        with open(os.path.join(result_dir, DETAILS_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def zip_member_name(page_num, blank=False):
+    suffix = "_пустая" if blank else ""
+    return f"страница_{page_num + 1:03d}{suffix}.txt"
+
+def zip_member_page(name):
+    return int(name.split("_")[1].split(".")[0]) - 1
+
+def write_zip_archive(target, pages, blank_pages=()):
+    # Страницы (номер, текст) пишутся в архив по одной: в памяти не бывает всего архива.
+    # blank_pages - номера пустых страниц (с нуля): их файлы помечаются в имени
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for page_num, text in pages:
+            zip_file.writestr(zip_member_name(page_num, page_num in blank_pages), text)
+
+def pages_zip_path(result_dir):
+    return os.path.join(result_dir, PAGES_ZIP_NAME)
+
+def build_pages_zip(result_dir, page_numbers, blank_pages=()):
+    # Архив собирается на диске один раз на результат и дальше отдается готовым
+    path = pages_zip_path(result_dir)
+    if not os.path.exists(path):
+        temp_path = path + ".part"
+        write_zip_archive(temp_path, iter_page_texts(result_dir, page_numbers), blank_pages)
+        os.replace(temp_path, path)
+    return path
+
+def spool_page_results(results, result_dir, page_numbers, format_block):
+    # Пишет страницы в порядке завершения, а полный текст - непрерывным префиксом
+    # в порядке страниц. Слова с рамками уходят из деталей в отдельный файл страницы.
+    # Отдает снимок прогресса после каждой страницы.
+    order = list(page_numbers)
+    position = {page_num: i for i, page_num in enumerate(order)}
+    ready = {}
+    next_index = 0
+    snapshot = {"completed": 0, "total": len(order), "prefix_pages": 0, "chars": 0, "words": 0}
+
+    with open(full_text_path(result_dir), "w", encoding="utf-8") as full_text:
+        for page_num, text, details in results:
+            with open(page_text_path(result_dir, page_num), "w", encoding="utf-8") as f:
+                f.write(text)
+            word_boxes = details.pop("word_boxes", None)
+            if word_boxes is not None:
+                with open(page_words_path(result_dir, page_num), "w", encoding="utf-8") as f:
+                    json.dump(word_boxes, f, ensure_ascii=False)
+
+            ready[position[page_num]] = format_block(page_num, text, details)
+            while next_index in ready:
+                block = ready.pop(next_index)
+                full_text.write(block)
+                snapshot["chars"] += len(block)
+                snapshot["words"] += len(block.split())
+                next_index += 1
+            full_text.flush()
+
+            snapshot["completed"] += 1
+            snapshot["prefix_pages"] = next_index
+            yield page_num, details, dict(snapshot)
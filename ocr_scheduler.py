@@ -0,0 +1,231 @@
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+# ==================== ПЛАНИРОВЩИК СЛОТОВ OCR ====================
+# Один на процесс: сеансы Streamlit, задания сервиса и пакеты CLI делят общие слоты.
+# Слот - одна распознаваемая страница (в рабочем процессе пула или в основном процессе).
+# Число слотов - ядра CPU, деленные на потоки одного tesseract (OMP_THREAD_LIMIT), чтобы
+# несколько пользователей не перегружали процессор. Освободившийся слот получает сеанс,
+# у которого сейчас меньше всего страниц в работе (при равенстве - ждущий дольше):
+# документ на 1000 страниц не задерживает короткий, они идут одновременно.
+#
+# Кроме слотов ограничена память: каждая страница в работе занимает оценку своих байтов
+# (пиксели рендера при ее DPI), и сумма не выходит за бюджет OCR_MEMORY_BUDGET_MB.
+# По умолчанию бюджет - половина памяти контейнера (лимит cgroup) или машины.
+
+SLOT_WAIT_INTERVAL = 0.5        # как часто ждущий сеанс проверяет отмену и обновляет позицию
+SLOT_SECONDS_DEFAULT = 5.0      # оценка времени страницы до первых замеров, с
+SLOT_SECONDS_SMOOTHING = 0.2    # вес нового замера в скользящем среднем
+
+# Сколько байт памяти занимает пиксель рендера при распознавании: сам рендер, его копия
+# для Tesseract и внутренние изображения Tesseract (бинаризация, строки)
+PAGE_BYTES_PER_PIXEL = 12
+MEMORY_BUDGET_SHARE = 0.5
+MIN_MEMORY_BUDGET_MB = 64
+
+_slots = threading.Condition()
+_capacity = None                # None - по числу ядер
+_active = {}                    # сеанс -> занятые слоты
+_waiting = {}                   # сеанс -> с какого момента ждет слот
+_slot_seconds = SLOT_SECONDS_DEFAULT
+_held_bytes = {}                # сеанс -> оценка памяти его страниц в работе
+_memory_budget = None
+
+def get_tesseract_threads():
+    value = os.environ.get("OMP_THREAD_LIMIT", "1")
+    return max(1, int(value)) if value.isdigit() else 1
+
+def get_worker_count(requested=None):
+    if requested:
+        return max(1, int(requested))
+
+    env_value = os.environ.get("OCR_WORKERS")
+    if env_value and env_value.isdigit() and int(env_value) > 0:
+        return int(env_value)
+
+    # Учитываем ограничение CPU контейнера, а не число ядер хоста, и потоки самого tesseract
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus // get_tesseract_threads())
+
+def _read_memory_limit():
+    # Лимит памяти контейнера (cgroup v2 и v1), иначе объем памяти машины
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = int(value)
+            break
+    else:
+        limit = None
+
+    try:
+        physical = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        physical = None
+    # В v1 без лимита там огромное число - берем меньшее из двух
+    known = [value for value in (limit, physical) if value]
+    return min(known) if known else None
+
+def get_memory_budget():
+    # Байты на страницы в работе на весь процесс (рабочие процессы пула считают так же)
+    global _memory_budget
+
+    if _memory_budget is None:
+        env_value = os.environ.get("OCR_MEMORY_BUDGET_MB")
+        if env_value and env_value.isdigit() and int(env_value) > 0:
+            budget_mb = int(env_value)
+        else:
+            limit = _read_memory_limit()
+            budget_mb = limit * MEMORY_BUDGET_SHARE / (1024 * 1024) if limit else 2048
+        _memory_budget = int(max(MIN_MEMORY_BUDGET_MB, budget_mb) * 1024 * 1024)
+    return _memory_budget
+
+def get_max_page_pixels():
+    # Больше пикселей одна страница не получает: крупный формат уменьшается под бюджет
+    return get_memory_budget() // PAGE_BYTES_PER_PIXEL
+
+def estimate_page_bytes(pixels):
+    # Память распознавания изображения; больше бюджета не бывает - такие страницы уменьшаются
+    return int(min(pixels, get_max_page_pixels()) * PAGE_BYTES_PER_PIXEL)
+
+def set_slot_capacity(capacity):
+    # Явное число слотов (--workers в CLI и бенчмарке); None - снова по числу ядер
+    global _capacity
+
+    with _slots:
+        _capacity = max(1, int(capacity)) if capacity else None
+        _slots.notify_all()
+
+def get_slot_capacity():
+    return _capacity or get_worker_count()
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+def _queue_order():
+    return sorted(_waiting, key=lambda session: (_active.get(session, 0), _waiting[session]))
+
+def _grant(session, nbytes):
+    # Под замком: слот выдается, если он свободен, страница помещается в бюджет памяти (одна
+    # страница проходит всегда) и впереди в очереди нет сеанса с меньшим числом страниц в работе
+    in_use = sum(_active.values())
+    if in_use >= get_slot_capacity():
+        return False
+    if in_use and sum(_held_bytes.values()) + nbytes > get_memory_budget():
+        return False
+    mine = (_active.get(session, 0), _waiting.get(session, time.monotonic()))
+    if any((_active.get(other, 0), since) < mine for other, since in _waiting.items() if other != session):
+        return False
+    _active[session] = mine[0] + 1
+    _held_bytes[session] = _held_bytes.get(session, 0) + nbytes
+    _waiting.pop(session, None)
+    return True
+
+def try_acquire_slot(session, nbytes=0):
+    # Не блокирует; отказ ставит сеанс в очередь, пока он не получит слот или не снимет заявку.
+    # nbytes - оценка памяти страницы (estimate_page_bytes)
+    with _slots:
+        if _grant(session, nbytes):
+            return True
+        _waiting.setdefault(session, time.monotonic())
+        return False
+
+def acquire_slot(session, cancel_event=None, on_wait=None, nbytes=0):
+    # Ждет слот; on_wait(статус очереди) вызывается, пока сеанс ждет. False - ожидание отменено
+    while True:
+        with _slots:
+            if _grant(session, nbytes):
+                return True
+            _waiting.setdefault(session, time.monotonic())
+            if cancel_event is None or not cancel_event.is_set():
+                _slots.wait(SLOT_WAIT_INTERVAL)
+            if _grant(session, nbytes):
+                return True
+            status = _queue_status(session)
+
+        if cancel_event is not None and cancel_event.is_set():
+            withdraw_slot_request(session)
+            return False
+        if on_wait and status:
+            on_wait(status)
+
+def release_slot(session, seconds=None, count=1, nbytes=0):
+    # seconds - сколько страница занимала слот: по нему оценивается ожидание в очереди;
+    # nbytes - память, взятая вместе со слотами
+    global _slot_seconds
+
+    with _slots:
+        left = _active.get(session, 0) - count
+        if left > 0:
+            _active[session] = left
+            _held_bytes[session] = max(0, _held_bytes.get(session, 0) - nbytes)
+        else:
+            _active.pop(session, None)
+            _held_bytes.pop(session, None)
+        if seconds is not None:
+            _slot_seconds += SLOT_SECONDS_SMOOTHING * (seconds - _slot_seconds)
+        _slots.notify_all()
+
+def withdraw_slot_request(session):
+    with _slots:
+        if _waiting.pop(session, None) is not None:
+            _slots.notify_all()
+
+def end_session(session):
+    # Сеанс закончил (или прерван): его слоты и заявка освобождаются
+    with _slots:
+        _active.pop(session, None)
+        _held_bytes.pop(session, None)
+        _waiting.pop(session, None)
+        _slots.notify_all()
+
+@contextmanager
+def ocr_slot(session=None, cancel_event=None, on_wait=None, nbytes=0):
+    # Один слот на время блока; отмена ожидания - yield False
+    session = session or new_session_id()
+    acquired = acquire_slot(session, cancel_event, on_wait, nbytes)
+    start_time = time.monotonic()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            release_slot(session, time.monotonic() - start_time, nbytes=nbytes)
+
+def _queue_status(session):
+    # Под замком: позиция в очереди и оценка ожидания слота
+    if session not in _waiting:
+        return None
+    capacity = get_slot_capacity()
+    position = _queue_order().index(session) + 1
+    return {
+        "position": position,
+        "waiting": len(_waiting),
+        "sessions": len(_active),
+        "capacity": capacity,
+        "eta": round(position * _slot_seconds / capacity, 1),
+    }
+
+def slot_queue_status(session):
+    with _slots:
+        return _queue_status(session)
+
+def scheduler_stats():
+    with _slots:
+        return {
+            "capacity": get_slot_capacity(),
+            "in_use": sum(_active.values()),
+            "sessions": len(_active),
+            "waiting": len(_waiting),
+            "slot_seconds": round(_slot_seconds, 2),
+            "memory_in_flight_mb": round(sum(_held_bytes.values()) / (1024 * 1024), 1),
+            "memory_budget_mb": round(get_memory_budget() / (1024 * 1024), 1),
+        }
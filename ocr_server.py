@@ -0,0 +1,492 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import shutil
+import zipfile
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ocr_engine import (
+    ENGINE_AUTO,
+    MODE_DPI,
+    MODE_ADAPTIVE,
+    setup_tesseract,
+    tesseract_probed,
+    get_warm_up_lang,
+    warm_up_ocr,
+    make_ocr_options,
+    count_pages,
+    format_result_block,
+    iter_page_results,
+    blank_page_numbers,
+    parse_page_range,
+    resolve_auto_language,
+    get_worker_count,
+    OCRCancelled,
+    PAGE_TIMEOUT,
+)
+from ocr_metrics import render_prometheus, reset_peak_rss, read_peak_rss_mb
+from ocr_cache import file_sha256
+from ocr_journal import cleanup_journals
+from ocr_results import (
+    RESULT_MAX_AGE,
+    create_result_dir,
+    remove_result_dir,
+    full_text_path,
+    page_text_path,
+    read_text_prefix,
+    write_details,
+    build_pages_zip,
+    pages_zip_path,
+    zip_member_page,
+    spool_page_results,
+)
+from ocr_formats import FORMATS, build_format_file
+from ocr_scheduler import slot_queue_status, scheduler_stats
+from ocr_estimate import record_job_timing
+
+# ==================== ЛОКАЛЬНЫЙ HTTP-СЕРВИС ЗАДАНИЙ OCR ====================
+# Задания обрабатываются в фоновых потоках и не зависят от сессии браузера.
+#
+#   POST /jobs?name=doc.pdf&mode=fast&lang=rus+eng   (тело - PDF)  -> {"job_id": ...}
+#   POST /jobs/<id>/cancel     остановить задание (страницы в работе прерываются)
+#   GET  /jobs/<id>            статус и прогресс
+#   GET  /jobs/<id>/pages      состояние каждой страницы
+#   GET  /jobs/<id>/result     полный текст (?partial=1 - готовый префикс)
+#   GET  /jobs/<id>/result.zip текст по страницам
+#   GET  /jobs/<id>/result.tsv, result.hocr, result.alto.xml, result.pdf
+#                              слова с рамками и PDF с текстовым слоем (задание с word_boxes=1)
+#   GET  /health
+#   GET  /metrics              счетчики и гистограммы в формате Prometheus
+
+JOBS_DIR = os.environ.get("OCR_JOBS_DIR", os.path.join(tempfile.gettempdir(), "pdf_ocr_jobs"))
+# Задания идут одновременно и делят слоты планировщика поровну: большое задание не держит очередь
+DEFAULT_CONCURRENCY = int(os.environ.get("OCR_JOB_CONCURRENCY", "4"))
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+FORMAT_RESOURCES = {info["resource"]: fmt for fmt, info in FORMATS.items()}
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_queue = queue.Queue()
+# Старт сервиса: порт открывается сразу, проверка Tesseract и прогрев идут в фоне
+_startup = {"ready": False, "warm_up": None}
+
+# ==================== ЗАДАНИЯ ====================
+
+def options_from_query(params):
+    mode = params.get("mode", "fast")
+    if mode not in MODE_DPI:
+        raise ValueError(f"Неизвестный режим: {mode}")
+
+    return make_ocr_options(
+        dpi=int(params.get("dpi") or MODE_DPI[mode]),
+        lang=params.get("lang", "rus+eng"),
+        use_fast_mode=mode != "accurate",
+        use_text_layer=params.get("text_layer", "1") != "0",
+        engine=params.get("engine", ENGINE_AUTO),
+        use_cache=params.get("cache", "1") != "0",
+        adaptive=mode == MODE_ADAPTIVE,
+        preprocess=params.get("preprocess", "0") == "1",
+        skip_blank=params.get("skip_blank", "1") != "0",
+        page_timeout=int(params.get("page_timeout") or PAGE_TIMEOUT),
+        word_boxes=params.get("word_boxes", "0") == "1")
+
+def job_snapshot(job):
+    keys = ("id", "name", "status", "created", "started", "finished", "document_pages",
+            "pages_total", "pages_done", "pages_escalated", "pages_resumed", "prefix_pages", "chars", "words", "error", "options",
+            "language", "peak_rss_mb")
+    snapshot = {key: job.get(key) for key in keys}
+    if job["started"] and job["pages_done"]:
+        elapsed = (job["finished"] or time.time()) - job["started"]
+        snapshot["pages_per_sec"] = round(job["pages_done"] / max(elapsed, 1e-6), 3)
+    with _jobs_lock:
+        snapshot["queue_position"] = _queue_position(job["id"])
+    # Задание запущено, но все слоты OCR заняты другими заданиями
+    snapshot["slot_queue"] = slot_queue_status(job["id"]) if job["status"] == STATUS_RUNNING else None
+    return snapshot
+
+def _queue_position(job_id):
+    queued = sorted((j for j in _jobs.values() if j["status"] == STATUS_QUEUED), key=lambda j: j["created"])
+    for position, job in enumerate(queued, start=1):
+        if job["id"] == job_id:
+            return position
+    return 0
+
+def submit_job(pdf_bytes, name, options, pages=None, preview_first=False):
+    # pages - диапазон вида "1-5,12,40-"; pages_total - число выбранных страниц
+    cleanup_jobs()
+
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    pdf_path = os.path.join(job_dir, "input.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(pdf_bytes)
+
+    try:
+        document_pages = count_pages(pdf_path)
+        page_numbers = parse_page_range(pages, document_pages)
+    except Exception:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+    job = {
+        "id": job_id,
+        "name": name,
+        "status": STATUS_QUEUED,
+        "created": time.time(),
+        "started": None,
+        "finished": None,
+        "document_pages": document_pages,
+        "page_numbers": page_numbers,
+        "preview_first": preview_first,
+        "pages_total": len(page_numbers),
+        "pages_done": 0,
+        "pages_escalated": 0,
+        "pages_resumed": 0,
+        "prefix_pages": 0,
+        "chars": 0,
+        "words": 0,
+        "error": None,
+        "options": options,
+        "pdf_path": pdf_path,
+        "job_dir": job_dir,
+        "result_dir": None,
+        "page_details": [],
+        "cancel_event": threading.Event(),
+        "language": None,
+        "peak_rss_mb": None,
+    }
+    with _jobs_lock:
+        _jobs[job_id] = job
+    _job_queue.put(job_id)
+    return job
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def run_job(job):
+    job["status"] = STATUS_RUNNING
+    job["started"] = time.time()
+    job["result_dir"] = create_result_dir()
+    page_numbers = job["page_numbers"]
+    position = {page_num: i for i, page_num in enumerate(page_numbers)}
+    job["page_details"] = [None] * len(page_numbers)
+    # Пик памяти задания: основной процесс с начала задания и наибольший пик рабочего процесса на странице
+    reset_peak_rss()
+    worker_peak = 0.0
+    job["peak_rss_mb"] = round(read_peak_rss_mb(), 1)
+
+    try:
+        # Если задание пришло до конца проверки Tesseract при старте - дожидаемся ее
+        setup_tesseract()
+        # lang=auto: язык и поворот определяются до распознавания и попадают в статус задания
+        doc_hash = file_sha256(job["pdf_path"])
+        options, job["language"] = resolve_auto_language(job["pdf_path"], job["options"], page_numbers, doc_hash,
+                                                         job["id"], job["cancel_event"])
+        ocr_started = time.time()
+        # Журнал: повторная отправка того же файла после перезапуска сервиса продолжит работу
+        results = iter_page_results(job["pdf_path"], options, page_numbers, doc_hash=doc_hash, use_journal=True,
+                                    preview_first=job["preview_first"], cancel_event=job["cancel_event"],
+                                    session=job["id"])
+        for page_num, details, snapshot in spool_page_results(
+                results, job["result_dir"], page_numbers, format_result_block):
+            job["page_details"][position[page_num]] = details
+            job["pages_done"] = snapshot["completed"]
+            job["pages_escalated"] += bool(details.get("escalated"))
+            job["pages_resumed"] += bool(details.get("resumed"))
+            job["prefix_pages"] = snapshot["prefix_pages"]
+            job["chars"] = snapshot["chars"]
+            job["words"] = snapshot["words"]
+            worker_peak = max(worker_peak, details.get("peak_rss_mb", 0.0))
+            job["peak_rss_mb"] = round(read_peak_rss_mb() + worker_peak, 1)
+
+        write_details(job["result_dir"], job["page_details"])
+        record_job_timing(options, job["page_details"], time.time() - ocr_started, get_worker_count())
+        job["status"] = STATUS_DONE
+    except OCRCancelled:
+        job["status"] = STATUS_CANCELLED
+    except Exception as e:
+        job["error"] = str(e)
+        job["status"] = STATUS_FAILED
+    finally:
+        job["finished"] = time.time()
+
+def cancel_job(job):
+    # Задание в очереди снимается сразу, выполняющееся останавливается в своем потоке
+    job["cancel_event"].set()
+    with _jobs_lock:
+        if job["status"] == STATUS_QUEUED:
+            job["status"] = STATUS_CANCELLED
+            job["finished"] = time.time()
+
+def _job_runner():
+    while True:
+        job_id = _job_queue.get()
+        job = get_job(job_id)
+        if job is not None and job["status"] == STATUS_QUEUED:
+            run_job(job)
+        _job_queue.task_done()
+
+def start_job_runners(concurrency):
+    for index in range(max(1, concurrency)):
+        threading.Thread(target=_job_runner, name=f"ocr-job-runner-{index}", daemon=True).start()
+
+def cleanup_jobs(max_age=RESULT_MAX_AGE):
+    deadline = time.time() - max_age
+    with _jobs_lock:
+        expired = [job for job in _jobs.values() if job["finished"] and job["finished"] < deadline]
+        for job in expired:
+            del _jobs[job["id"]]
+
+    for job in expired:
+        remove_result_dir(job["result_dir"])
+        shutil.rmtree(job["job_dir"], ignore_errors=True)
+    cleanup_journals()
+
+def render_metrics():
+    with _jobs_lock:
+        statuses = [job["status"] for job in _jobs.values()]
+
+    lines = ["# HELP ocr_jobs Задания сервиса по состоянию", "# TYPE ocr_jobs gauge"]
+    for status in (STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED):
+        lines.append(f'ocr_jobs{{status="{status}"}} {statuses.count(status)}')
+    return render_prometheus() + "\n".join(lines) + "\n"
+
+# ==================== HTTP ====================
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    server_version = "PDFOCRJobs/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json; charset=utf-8", filename=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if filename:
+            quoted = urllib.parse.quote(filename)
+            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quoted}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, path, content_type, filename):
+        # Файл уходит клиенту кусками, не загружаясь в память целиком
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}")
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+
+    def _error(self, status, message):
+        self._send(status, {"error": message})
+
+    def _route(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        parts = [p for p in parsed.path.split("/") if p]
+        return parts, params
+
+    def do_POST(self):
+        parts, params = self._route()
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+            job = get_job(parts[1])
+            if job is None:
+                return self._error(404, "задание не найдено")
+            cancel_job(job)
+            return self._send(202, job_snapshot(job))
+        if parts != ["jobs"]:
+            return self._error(404, "not found")
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            return self._error(400, "пустое тело запроса: ожидается PDF")
+        if length > MAX_UPLOAD_BYTES:
+            return self._error(413, "файл слишком большой")
+
+        pdf_bytes = self.rfile.read(length)
+        try:
+            options = options_from_query(params)
+            job = submit_job(pdf_bytes, params.get("name", "document.pdf"), options,
+                             pages=params.get("pages"), preview_first=params.get("preview") == "1")
+        except Exception as e:
+            return self._error(400, str(e))
+
+        self._send(202, {"job_id": job["id"], "pages_total": job["pages_total"]})
+
+    def do_GET(self):
+        parts, params = self._route()
+
+        if parts == ["health"]:
+            # Не ждет загрузки OCR: до конца проверки Tesseract ready=false
+            tesseract = tesseract_probed()
+            return self._send(200, {"status": "ok", "ready": _startup["ready"],
+                                    "tesseract": tesseract["version"] if tesseract else None,
+                                    "warm_up": _startup["warm_up"], "queued": _job_queue.qsize(),
+                                    "slots": scheduler_stats()})
+
+        if parts == ["metrics"]:
+            return self._send(200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+
+        if len(parts) < 2 or parts[0] != "jobs":
+            return self._error(404, "not found")
+
+        job = get_job(parts[1])
+        if job is None:
+            return self._error(404, "задание не найдено")
+
+        if len(parts) == 2:
+            return self._send(200, job_snapshot(job))
+
+        resource = parts[2]
+        if resource == "pages":
+            pages = [{"page": page_num + 1, "status": "done" if details else "pending", **(details or {})}
+                     for page_num, details in zip(job["page_numbers"], job["page_details"])]
+            return self._send(200, pages)
+
+        if job["status"] != STATUS_DONE and not (resource == "result" and params.get("partial") == "1"):
+            return self._error(409, f"задание в состоянии {job['status']}")
+
+        base_name = os.path.splitext(job["name"])[0]
+        if resource == "result":
+            if job["status"] != STATUS_DONE:
+                return self._send(200, read_text_prefix(job["result_dir"], limit=None) if job["result_dir"] else "",
+                                  "text/plain; charset=utf-8")
+            return self._send_file(full_text_path(job["result_dir"]), "text/plain; charset=utf-8",
+                                   f"{base_name}_текст.txt")
+
+        if resource == "result.zip":
+            zip_path = build_pages_zip(job["result_dir"], job["page_numbers"],
+                                       blank_page_numbers(job["page_details"]))
+            return self._send_file(zip_path, "application/zip", f"{base_name}_страницы.zip")
+
+        fmt = FORMAT_RESOURCES.get(resource)
+        if fmt:
+            if not job["options"].get("word_boxes"):
+                return self._error(409, "задание выполнено без координат слов (word_boxes=1)")
+            path = build_format_file(job["result_dir"], fmt, job["pdf_path"], job["page_numbers"], job["page_details"])
+            return self._send_file(path, FORMATS[fmt]["mime"], f"{base_name}_{FORMATS[fmt]['file']}")
+
+        return self._error(404, "not found")
+
+def start_up(warm_up_lang=None):
+    # В фоне после открытия порта: поиск Tesseract (он же загружает pytesseract) и прогрев
+    if not setup_tesseract():
+        print("⚠️ Tesseract не найден: доступны только страницы с текстовым слоем", file=sys.stderr)
+    elif warm_up_lang:
+        try:
+            _startup["warm_up"] = warm_up_ocr(warm_up_lang)
+            print(f"🔥 Прогрев: {_startup['warm_up']['seconds']:.1f} с (языки {warm_up_lang})")
+        except Exception as e:
+            print(f"⚠️ Прогрев не удался: {e}", file=sys.stderr)
+    _startup["ready"] = True
+
+def serve(host, port, concurrency, warm_up_lang=None):
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    start_job_runners(concurrency)
+
+    server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    threading.Thread(target=start_up, args=(warm_up_lang,), name="ocr-start-up", daemon=True).start()
+    print(f"🚀 Сервис OCR: http://{host}:{port} (параллельных заданий: {concurrency})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# ==================== КЛИЕНТ ====================
+# Используется интерфейсом Streamlit, когда задан OCR_API_URL.
+
+def _request(url, data=None, content_type=None, timeout=30):
+    request = urllib.request.Request(url, data=data)
+    if content_type:
+        request.add_header("Content-Type", content_type)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+def client_submit(api_url, pdf_bytes, name, mode="fast", lang="rus+eng", use_text_layer=True, engine=ENGINE_AUTO, use_cache=True, dpi=None, preprocess=False, skip_blank=True, pages=None, preview_first=False, page_timeout=PAGE_TIMEOUT, word_boxes=False):
+    params = {"name": name, "mode": mode, "lang": lang, "engine": engine,
+              "text_layer": "1" if use_text_layer else "0", "cache": "1" if use_cache else "0",
+              "preprocess": "1" if preprocess else "0", "skip_blank": "1" if skip_blank else "0",
+              "page_timeout": str(page_timeout)}
+    if dpi:
+        params["dpi"] = str(dpi)
+    if pages:
+        params["pages"] = pages
+    if preview_first:
+        params["preview"] = "1"
+    if word_boxes:
+        params["word_boxes"] = "1"
+    url = f"{api_url.rstrip('/')}/jobs?{urllib.parse.urlencode(params)}"
+    return json.loads(_request(url, pdf_bytes, "application/pdf", timeout=300))["job_id"]
+
+def client_cancel(api_url, job_id):
+    return json.loads(_request(f"{api_url.rstrip('/')}/jobs/{job_id}/cancel", data=b""))
+
+def client_status(api_url, job_id):
+    return json.loads(_request(f"{api_url.rstrip('/')}/jobs/{job_id}"))
+
+def client_pages(api_url, job_id):
+    return json.loads(_request(f"{api_url.rstrip('/')}/jobs/{job_id}/pages"))
+
+def client_download_to(api_url, job_id, resource, path):
+    with urllib.request.urlopen(f"{api_url.rstrip('/')}/jobs/{job_id}/{resource}", timeout=300) as response:
+        with open(path, "wb") as f:
+            shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+
+def client_fetch_result(api_url, job_id, result_dir):
+    # Переносит готовый результат задания в локальную папку результатов, не держа его в памяти
+    client_download_to(api_url, job_id, "result", full_text_path(result_dir))
+
+    zip_path = pages_zip_path(result_dir)
+    client_download_to(api_url, job_id, "result.zip", zip_path)
+    with zipfile.ZipFile(zip_path) as archive:
+        for name in archive.namelist():
+            with archive.open(name) as source, open(page_text_path(result_dir, zip_member_page(name)), "wb") as f:
+                shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+
+    page_details = []
+    for page in client_pages(api_url, job_id):
+        page.pop("status", None)
+        page_details.append(page)
+    write_details(result_dir, page_details)
+    return page_details
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный HTTP-сервис заданий OCR")
+    parser.add_argument("--host", default=os.environ.get("OCR_API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("OCR_API_PORT", "8765")))
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Сколько заданий обрабатывается одновременно")
+    parser.add_argument("--warmup", default=get_warm_up_lang(),
+                        help="Языки для прогрева моделей после старта, например rus+eng (или OCR_WARMUP)")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.concurrency, args.warmup)
+
+if __name__ == "__main__":
+    main()